@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки TemplateManager и поиска на синтетических библиотеках.
+
+Примеры:
+    python benchmarks/bench_core.py --sizes 1000,10000 --output bench_core.json
+    python benchmarks/bench_core.py --sizes 1000000 --content-profile tiny
+    python benchmarks/bench_core.py --compare old.json --output new.json
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.report import finish, make_report, measure  # noqa: E402
+from benchmarks.synthetic import (  # noqa: E402
+    CONTENT_PROFILES,
+    LibraryGenerator,
+    LibrarySpec,
+    iter_nodes,
+)
+from textpaster_core import TemplateHistory, TemplateManager, TemplateNode, TemplateSearchIndex  # noqa: E402
+
+SAMPLE_SIZE = 1000
+
+
+def _largest_folder(root):
+    best = root
+    for node in iter_nodes(root):
+        if node.is_folder and len(node.children) > len(best.children):
+            best = node
+    return best
+
+
+def run_size(spec, repeat, workdir):
+    """Прогнать все операции на библиотеке одного размера"""
+    results = {}
+    prefix = f"{spec.templates}"
+
+    started = time.perf_counter()
+    generator = LibraryGenerator(spec)
+    root = generator.build()
+    print(f"[{prefix}] библиотека сгенерирована за {time.perf_counter() - started:.2f} с")
+
+    data_file = os.path.join(workdir, f"templates_{spec.templates}.json")
+    manager = TemplateManager(data_file)
+    manager.root = root
+
+    # Сохранение и загрузка
+    results[f"{prefix}/save_templates"] = measure(manager.save_templates, repeat)
+    results[f"{prefix}/load_templates"] = measure(manager.load_templates, repeat)
+    root = manager.root
+
+    nodes = list(iter_nodes(root))
+    templates = [node for node in nodes if not node.is_folder]
+    rng = random.Random(spec.seed)
+    sample_nodes = rng.sample(nodes, min(SAMPLE_SIZE, len(nodes)))
+    sample_paths = [node.get_path() for node in sample_nodes]
+
+    # Запросы: частое слово, одиночный слог, отсутствующая строка
+    queries = {
+        "common": generator._vocabulary[0],
+        "syllable": "ба",
+        "miss": "zzqxw",
+    }
+    if templates:
+        queries["name"] = rng.choice(templates).name.split()[0].lower()
+
+    for label, query in queries.items():
+        results[f"{prefix}/manager.search_templates[{label}]"] = measure(
+            lambda q=query: manager.search_templates(q), repeat
+        )
+
+    index = TemplateSearchIndex(manager)
+    results[f"{prefix}/index.rebuild"] = measure(index.rebuild, repeat)
+    for label, query in queries.items():
+        results[f"{prefix}/index.search[{label}]"] = measure(
+            lambda q=query: index.search(q), repeat
+        )
+
+    # Поиск узлов по пути и вычисление путей (на выборке SAMPLE_SIZE узлов)
+    results[f"{prefix}/get_node_by_path[x{len(sample_paths)}]"] = measure(
+        lambda: [manager.get_node_by_path(path) for path in sample_paths], repeat
+    )
+    sample_ids = [node.id for node in sample_nodes]
+    results[f"{prefix}/get_node_by_id[x{len(sample_ids)}]"] = measure(
+        lambda: [manager.get_node_by_id(node_id) for node_id in sample_ids], repeat
+    )
+    results[f"{prefix}/get_path[x{len(sample_nodes)}]"] = measure(
+        lambda: [node.get_path() for node in sample_nodes], repeat
+    )
+
+    # Перемещения в самой большой папке
+    folder = _largest_folder(root)
+    names = list(folder.children.keys())
+
+    # Отсортированный вид папки для меню: первый раз сортировка, дальше кэш
+    results[f"{prefix}/sorted_children[first,x{len(names)}]"] = measure(folder.sorted_children, 1)
+    results[f"{prefix}/sorted_children[cached,x{len(names)}]"] = measure(folder.sorted_children, repeat)
+    if names:
+        middle = names[len(names) // 2]
+        results[f"{prefix}/move_child_up"] = measure(lambda: folder.move_child_up(middle), repeat)
+        results[f"{prefix}/move_child_down"] = measure(lambda: folder.move_child_down(middle), repeat)
+
+    # Перенос узла между папками (как в «Переместить в папку»)
+    folders = [node for node in nodes if node.is_folder]
+    if len(folders) >= 2 and names:
+        source, target = folder, next(f for f in folders if f is not folder)
+        moving = source.children[names[0]]
+
+        def move_between():
+            current = moving.parent
+            other = target if current is source else source
+            current.remove_child(moving.name)
+            other.add_child(moving)
+
+        results[f"{prefix}/move_to_folder"] = measure(move_between, repeat)
+
+    # Снимки для фоновых потоков: первый — копия всего дерева,
+    # после правки одного шаблона — только путь от него до корня
+    manager.save_templates()
+    results[f"{prefix}/snapshot[full]"] = measure(manager.snapshot, 1)
+    if templates:
+        edited = templates[len(templates) // 2]
+        results[f"{prefix}/snapshot[after_edit]"] = measure(
+            lambda _: manager.snapshot(), repeat,
+            setup=lambda: manager.set_content(edited, edited.content + "."),
+        )
+
+    # История версий: запись правок (тексты повторяются и хранятся один раз)
+    # и список версий из журнала без чтения текстов
+    if templates:
+        history = TemplateHistory(os.path.join(workdir, f"history_{spec.templates}"))
+        edits = [rng.choice(templates) for _ in range(SAMPLE_SIZE)]
+        results[f"{prefix}/history.record[x{len(edits)}]"] = measure(
+            lambda: [history.record(node.id, node.content) for node in edits], 1
+        )
+        results[f"{prefix}/history.load+versions[x{len(edits)}]"] = measure(
+            lambda: (history.load(), [history.versions(node.id) for node in edits]), repeat
+        )
+        history.close()
+
+    # Массовый экспорт в NDJSON из снимка и импорт обратно в пустую
+    # библиотеку: чтение потоковое, добавление — одной транзакцией
+    export_path = os.path.join(workdir, f"export_{spec.templates}.ndjson")
+    results[f"{prefix}/export_file[ndjson]"] = measure(
+        lambda: manager.export_file(manager.snapshot().root, export_path), 1
+    )
+    results[f"{prefix}/read_import[ndjson]"] = measure(lambda: manager.read_import(export_path), 1)
+
+    def empty_library():
+        importer = TemplateManager(os.path.join(workdir, f"import_{spec.templates}.json"))
+        with importer.batch():
+            importer.remove_many(list(importer.root.children.values()))
+        return importer, manager.read_import(export_path)
+
+    results[f"{prefix}/import_nodes[ndjson]"] = measure(
+        lambda state: state[0].import_nodes(state[1], merge_folders=True), 1, setup=empty_library,
+    )
+
+    # Групповой перенос до 1000 элементов: одна транзакция и одно сохранение
+    if names:
+        holder = TemplateNode("__bench_move_many__", "", True)
+        manager.root.add_child(holder)
+        batch = list(folder.children.values())[:1000]
+        state = {"target": holder, "source": folder}
+
+        def move_many():
+            manager.move_many(batch, state["target"])
+            state["target"], state["source"] = state["source"], state["target"]
+
+        results[f"{prefix}/move_many[x{len(batch)}]"] = measure(move_many, repeat)
+
+    # Раскладка по папкам: правка шаблона переписывает только его папку
+    # верхнего уровня и оглавление, загрузка читает папки по мере обращения
+    if templates:
+        edited = templates[len(templates) // 3]
+        results[f"{prefix}/set_content[file]"] = measure(
+            lambda: manager.set_content(edited, edited.content + "."), repeat
+        )
+        manager.set_sharded(True)
+        results[f"{prefix}/save_templates[sharded]"] = measure(manager.save_templates, 1)
+        results[f"{prefix}/set_content[sharded]"] = measure(
+            lambda: manager.set_content(edited, edited.content + "."), repeat
+        )
+        edited_path = edited.get_path()
+        results[f"{prefix}/load+get_node_by_path[sharded]"] = measure(
+            lambda: TemplateManager(data_file).get_node_by_path(edited_path), repeat
+        )
+
+    results[f"{prefix}/library"] = {"nodes": len(nodes), "templates": len(templates)}
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TextPaster core benchmarks")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma-separated template counts (1000..1000000)")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--cyrillic-ratio", type=float, default=0.5)
+    parser.add_argument("--content-profile", choices=sorted(CONTENT_PROFILES), default="typical")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write JSON report to this path")
+    parser.add_argument("--compare", help="baseline JSON report to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="textpaster-bench-") as workdir:
+        for size in sizes:
+            spec = LibrarySpec(
+                templates=size,
+                depth=args.depth,
+                fanout=args.fanout,
+                cyrillic_ratio=args.cyrillic_ratio,
+                content_profile=args.content_profile,
+                seed=args.seed,
+            )
+            results.update(run_size(spec, args.repeat, workdir))
+
+    params = LibrarySpec(
+        templates=None,
+        depth=args.depth,
+        fanout=args.fanout,
+        cyrillic_ratio=args.cyrillic_ratio,
+        content_profile=args.content_profile,
+        seed=args.seed,
+    ).as_dict()
+    params.update({"sizes": sizes, "repeat": args.repeat})
+    report = make_report("core", results, params)
+    return finish(report, args.output, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Замеры задержек GUI TextPasterApp на синтетических библиотеках.
+
+На Linux без DISPLAY запускается виртуальный X-сервер (Xvfb), поэтому
+бенчмарк работает в CI без физического рабочего стола. Хоткеи вызываются
+напрямую (без pynput-слушателя), для каждой поверхности измеряются:
+    first_paint — от действия до отрисовки (обработаны idle-задачи Tk);
+    idle        — от действия до момента, когда очередь событий Tk пуста.
+
+Примеры:
+    python benchmarks/bench_gui.py --sizes 1000,10000 --output bench_gui.json
+    python benchmarks/bench_gui.py --compare old.json
+"""
+
+import argparse
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import _tkinter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.report import finish, make_report  # noqa: E402
+from benchmarks.synthetic import CONTENT_PROFILES, LibrarySpec, generate_library  # noqa: E402
+
+
+def start_virtual_display(width=1920, height=1080, force=False):
+    """Запустить Xvfb, если нет дисплея; вернуть процесс или None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    if os.environ.get("DISPLAY") and not force:
+        return None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        raise RuntimeError("DISPLAY не задан, а Xvfb не найден (apt-get install xvfb)")
+
+    for number in range(99, 200):
+        if os.path.exists(f"/tmp/.X11-unix/X{number}") or os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        process = subprocess.Popen(
+            [xvfb, f":{number}", "-screen", "0", f"{width}x{height}x24", "-nolisten", "tcp"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if process.poll() is not None:
+                break
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                os.environ["DISPLAY"] = f":{number}"
+                atexit.register(process.terminate)
+                return process
+            time.sleep(0.05)
+        process.terminate()
+    raise RuntimeError("Не удалось запустить Xvfb")
+
+
+class SurfaceTimer:
+    """Замер first_paint/idle для действий в главном цикле Tk"""
+    def __init__(self, root, repeat):
+        self.root = root
+        self.repeat = repeat
+        self.results = {}
+
+    def drain(self):
+        """Обработать все ожидающие события Tk"""
+        while self.root.tk.dooneevent(_tkinter.ALL_EVENTS | _tkinter.DONT_WAIT):
+            pass
+
+    def run_timers(self):
+        """Выполнить уже наступившие after()-вызовы (так хоткеи попадают в поток Tk)"""
+        while self.root.tk.dooneevent(_tkinter.TIMER_EVENTS | _tkinter.DONT_WAIT):
+            pass
+
+    def measure(self, name, action, reset=None):
+        first_paint = []
+        idle = []
+        for _ in range(self.repeat):
+            if reset is not None:
+                reset()
+            self.drain()
+            started = time.perf_counter()
+            action()
+            self.run_timers()
+            self.root.update_idletasks()
+            first_paint.append((time.perf_counter() - started) * 1000)
+            self.drain()
+            idle.append((time.perf_counter() - started) * 1000)
+        for suffix, values in (("first_paint", first_paint), ("idle", idle)):
+            values.sort()
+            self.results[f"{name}.{suffix}"] = {
+                "repeat": self.repeat,
+                "min_ms": round(values[0], 4),
+                "median_ms": round(values[len(values) // 2], 4),
+                "max_ms": round(values[-1], 4),
+            }
+
+
+def run_size(spec, repeat, workdir, query):
+    import textpaster
+    from textpaster_core import ConfigManager, TemplateManager
+
+    data_file = os.path.join(workdir, f"templates_{spec.templates}.json")
+    manager = TemplateManager(data_file)
+    manager.root = generate_library(spec)
+    manager.save_templates()
+    manager = TemplateManager(data_file)
+    config = ConfigManager(os.path.join(workdir, "config.json"))
+
+    app = textpaster.TextPasterApp(
+        config_manager=config,
+        template_manager=manager,
+        enable_hotkeys=False,
+        enable_ipc=False,
+        watch_file=False,
+    )
+    root = app.main_window
+    prefix = f"{spec.templates}"
+    timer = SurfaceTimer(root, repeat)
+    timer.drain()
+
+    try:
+        # Главное окно: полная перестройка дерева
+        timer.measure(f"{prefix}/refresh_tree", app.refresh_tree)
+
+        # Фильтр дерева главного окна (поле «Поиск:» после паузы ввода) и его сброс
+        timer.measure(f"{prefix}/tree_filter[{query}]",
+                      lambda: app._apply_tree_filter(query), reset=app._clear_tree_filter)
+        timer.measure(f"{prefix}/tree_filter_clear",
+                      app._clear_tree_filter, reset=lambda: app._apply_tree_filter(query))
+        app._clear_tree_filter()
+
+        # Окно поиска: создание с нуля (как было до переиспользования окна)
+        created = []
+
+        def create_dialog():
+            created.append(textpaster.TemplateSearchDialog(
+                manager, app.on_template_selected, search_index=app.search_index,
+                parent=root, latency_stats=app.latency_stats,
+            ))
+
+        def destroy_dialogs():
+            while created:
+                created.pop().destroy()
+
+        timer.measure(f"{prefix}/TemplateSearchDialog.__init__", create_dialog, reset=destroy_dialogs)
+        destroy_dialogs()
+
+        # Окно поиска по хоткею (прогретое окно)
+        timer.measure(
+            f"{prefix}/search_hotkey",
+            app.on_search_hotkey,
+            reset=app.popup_window.close,
+        )
+        app.popup_window.close()
+
+        # Результаты поиска в окне
+        dialog = app.popup_window
+        dialog.show()
+        timer.drain()
+
+        def search():
+            dialog.search_var.set(query)
+
+        timer.measure(f"{prefix}/search_results[{query}]", search,
+                      reset=lambda: dialog.search_var.set(""))
+        dialog.search_results = app.search_index.search(query)
+        timer.measure(f"{prefix}/update_results_display[x{len(dialog.search_results)}]",
+                      dialog.update_results_display)
+        dialog.close()
+
+        # Каскадное меню по хоткею
+        timer.measure(
+            f"{prefix}/menu_hotkey",
+            app.on_menu_hotkey,
+            reset=app.cascading_menu._on_escape_key,
+        )
+        app.cascading_menu._on_escape_key()
+        timer.drain()
+
+        # Окно последних шаблонов по хоткею (заполнено полным списком)
+        for template in app.search_index.all_templates()[:app.recent.capacity]:
+            app.recent.push(template)
+        timer.measure(
+            f"{prefix}/recent_hotkey",
+            app.on_recent_hotkey,
+            reset=app.recent_popup.close,
+        )
+        app.recent_popup.close()
+        timer.drain()
+
+        results = dict(timer.results)
+        for name, summary in app.latency_stats.summary().items():
+            results[f"{prefix}/latency/{name}"] = {
+                "repeat": summary["count"],
+                "median_ms": summary["p50_ms"],
+                "p99_ms": summary["p99_ms"],
+                "max_ms": summary["max_ms"],
+            }
+        return results
+    finally:
+        app._is_quitting = True
+        app.on_closing()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="TextPaster GUI latency benchmarks")
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--cyrillic-ratio", type=float, default=0.5)
+    parser.add_argument("--content-profile", choices=sorted(CONTENT_PROFILES), default="typical")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--query", default="ба", help="query typed into the search window")
+    parser.add_argument("--xvfb", action="store_true", help="always start Xvfb, even if DISPLAY is set")
+    parser.add_argument("--output", help="write JSON report to this path")
+    parser.add_argument("--compare", help="baseline JSON report to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    start_virtual_display(force=args.xvfb)
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="textpaster-gui-bench-") as workdir:
+        for size in sizes:
+            spec = LibrarySpec(
+                templates=size,
+                depth=args.depth,
+                fanout=args.fanout,
+                cyrillic_ratio=args.cyrillic_ratio,
+                content_profile=args.content_profile,
+                seed=args.seed,
+            )
+            results.update(run_size(spec, args.repeat, workdir, args.query))
+
+    params = {
+        "sizes": sizes,
+        "depth": args.depth,
+        "fanout": args.fanout,
+        "cyrillic_ratio": args.cyrillic_ratio,
+        "content_profile": args.content_profile,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "query": args.query,
+    }
+    return finish(make_report("gui", results, params), args.output, args.compare, args.threshold)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
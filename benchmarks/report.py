@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Замеры и машиночитаемые отчеты бенчмарков.
+
+Отчет — JSON вида {"meta": {...}, "results": {"<размер>/<операция>": {...}}}.
+Два отчета сравниваются по median_ms (см. compare_reports).
+"""
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(fn, repeat=5, setup=None):
+    """Выполнить fn repeat раз и вернуть статистику в миллисекундах.
+
+    Если задан setup, он вызывается перед каждым замером (вне таймера),
+    а его результат передается в fn.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            argument = setup()
+            started = time.perf_counter()
+            fn(argument)
+        else:
+            started = time.perf_counter()
+            fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(times), 4),
+        "median_ms": round(statistics.median(times), 4),
+        "mean_ms": round(statistics.mean(times), 4),
+        "max_ms": round(max(times), 4),
+    }
+
+
+def git_revision():
+    """Текущий коммит (для сопоставления отчетов с версиями)"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT,
+            stderr=subprocess.DEVNULL,
+        ).decode("ascii").strip()
+    except Exception:
+        return None
+
+
+def make_report(suite, results, params=None):
+    return {
+        "meta": {
+            "suite": suite,
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "params": params or {},
+        },
+        "results": results,
+    }
+
+
+def write_report(report, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def load_report(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Операции быстрее этого порога (мс) не считаются регрессией: там один шум
+NOISE_FLOOR_MS = 0.05
+
+
+def compare_reports(baseline, current, threshold=1.2, metric="median_ms"):
+    """Сравнить отчеты; вернуть (строки таблицы, список регрессий)"""
+    rows = []
+    regressions = []
+    base_results = baseline.get("results", {})
+    for name, result in sorted(current.get("results", {}).items()):
+        before = base_results.get(name, {}).get(metric)
+        after = result.get(metric)
+        if before is None or after is None:
+            continue
+        ratio = after / before if before > 0 else float("inf")
+        flag = ""
+        if ratio > threshold and after >= NOISE_FLOOR_MS:
+            flag = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / threshold:
+            flag = "faster"
+        rows.append(f"{name:60s} {before:12.3f} {after:12.3f} {ratio:7.2f}x {flag}")
+    return rows, regressions
+
+
+def print_results(results):
+    for name, result in sorted(results.items()):
+        if "median_ms" in result:
+            line = f"{name:60s} median {result['median_ms']:10.3f} ms"
+            if "min_ms" in result:
+                line += f"  min {result['min_ms']:10.3f} ms"
+            print(line)
+
+
+def finish(report, output=None, compare=None, threshold=1.2):
+    """Вывести результаты, записать отчет и сравнить с базовым; вернуть код выхода"""
+    print_results(report["results"])
+    if output:
+        write_report(report, output)
+        print(f"Отчет записан: {output}")
+    if compare:
+        rows, regressions = compare_reports(load_report(compare), report, threshold)
+        print(f"\n{'операция':60s} {'было, мс':>12s} {'стало, мс':>12s} {'отнош.':>8s}")
+        for row in rows:
+            print(row)
+        if regressions:
+            print(f"\nРегрессии (> {threshold}x): {len(regressions)}")
+            return 1
+    return 0
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Детерминированный генератор синтетических библиотек шаблонов.
+
+Одинаковые параметры и seed всегда дают одинаковое дерево, поэтому отчеты
+бенчмарков разных версий можно сравнивать между собой.
+"""
+
+import random
+
+from textpaster_core import TemplateNode
+
+LATIN_SYLLABLES = [
+    "ba", "ce", "di", "fo", "gu", "ha", "je", "ki", "lo", "mu",
+    "na", "pe", "qui", "ro", "su", "ta", "ve", "wi", "xo", "zy",
+]
+CYRILLIC_SYLLABLES = [
+    "ба", "ве", "ги", "до", "жу", "за", "ки", "ло", "му", "не",
+    "по", "ру", "се", "то", "фу", "ха", "це", "чо", "ше", "ёл",
+]
+
+# Профили размера содержимого: (вероятность, минимум, максимум) в символах
+CONTENT_PROFILES = {
+    "tiny": [(1.0, 10, 80)],
+    "typical": [(0.70, 20, 200), (0.25, 200, 1000), (0.05, 1000, 5000)],
+    "large": [(0.50, 200, 2000), (0.40, 2000, 20000), (0.10, 20000, 100000)],
+}
+
+
+class LibrarySpec:
+    """Параметры синтетической библиотеки"""
+    def __init__(self, templates=1000, depth=3, fanout=8, cyrillic_ratio=0.5,
+                 content_profile="typical", seed=42):
+        if content_profile not in CONTENT_PROFILES:
+            raise ValueError(f"Неизвестный профиль содержимого: {content_profile}")
+        self.templates = templates
+        self.depth = depth
+        self.fanout = fanout
+        self.cyrillic_ratio = cyrillic_ratio
+        self.content_profile = content_profile
+        self.seed = seed
+
+    def as_dict(self):
+        return {
+            "templates": self.templates,
+            "depth": self.depth,
+            "fanout": self.fanout,
+            "cyrillic_ratio": self.cyrillic_ratio,
+            "content_profile": self.content_profile,
+            "seed": self.seed,
+        }
+
+
+class LibraryGenerator:
+    """Генератор дерева TemplateNode по LibrarySpec"""
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self._vocabulary = [self._word() for _ in range(2000)]
+
+    def _word(self):
+        syllables = CYRILLIC_SYLLABLES if self.rng.random() < self.spec.cyrillic_ratio else LATIN_SYLLABLES
+        return "".join(self.rng.choice(syllables) for _ in range(self.rng.randint(2, 4)))
+
+    def _name(self, words=2):
+        return " ".join(self.rng.choice(self._vocabulary) for _ in range(words)).capitalize()
+
+    def _content(self):
+        roll = self.rng.random()
+        buckets = CONTENT_PROFILES[self.spec.content_profile]
+        for probability, low, high in buckets:
+            if roll < probability:
+                break
+            roll -= probability
+        size = self.rng.randint(low, high)
+        # Слова из общего словаря: быстро и дает реалистичные совпадения при поиске
+        parts = []
+        length = 0
+        while length < size:
+            word = self.rng.choice(self._vocabulary)
+            parts.append(word)
+            length += len(word) + 1
+            if self.rng.random() < 0.05:
+                parts.append("\n")
+        return " ".join(parts)[:size]
+
+    @staticmethod
+    def _unique_name(parent, name):
+        if name not in parent.children:
+            return name
+        counter = 2
+        while f"{name} {counter}" in parent.children:
+            counter += 1
+        return f"{name} {counter}"
+
+    def build(self):
+        """Построить дерево; вернуть корневой узел"""
+        root = TemplateNode("Root", "", True)
+        level = [root]
+        folders = []
+        for _ in range(self.spec.depth):
+            next_level = []
+            for parent in level:
+                for _ in range(self.spec.fanout):
+                    folder = TemplateNode(self._unique_name(parent, self._name(1)), "", True)
+                    parent.add_child(folder)
+                    next_level.append(folder)
+            folders.extend(next_level)
+            level = next_level
+
+        # Шаблоны в основном в листовых папках, немного — во всех остальных
+        leaves = level or [root]
+        containers = folders or [root]
+        for i in range(self.spec.templates):
+            parent = leaves[i % len(leaves)] if self.rng.random() < 0.9 else self.rng.choice(containers)
+            name = self._unique_name(parent, self._name(self.rng.randint(1, 3)))
+            parent.add_child(TemplateNode(name, self._content()))
+        return root
+
+
+def generate_library(spec):
+    """Сгенерировать библиотеку по LibrarySpec"""
+    return LibraryGenerator(spec).build()
+
+
+def iter_nodes(node):
+    """Все узлы дерева (кроме корня) в порядке обхода"""
+    stack = [iter(node.children.values())]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        yield child
+        if child.is_folder:
+            stack.append(iter(child.children.values()))
@@ -5,19 +5,40 @@ TextPaster - Программа для быстрого доступа к шаб
 """
 
 import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
+from tkinter import ttk, messagebox, simpledialog, filedialog
 import argparse
-import json
+import io
 import os
+import queue
 import sys
 import threading
 import ctypes
 from ctypes import wintypes
-import pyperclip
 from pynput import keyboard
 from pynput.keyboard import Key, KeyCode, Listener
 import time
-from collections import OrderedDict
+
+from textpaster_core import (
+    AutoPastePipeline,
+    ClipboardBackend,
+    ClipboardService,
+    ConfigManager,
+    FileWatcher,
+    FrecencyStore,
+    HelperProcessClipboardBackend,
+    InstanceClient,
+    InstanceServer,
+    LatencyStats,
+    PyperclipClipboardBackend,
+    RecentTemplates,
+    TemplateChange,
+    TemplateHistory,
+    TemplateManager,
+    TemplateNode,
+    TemplateSearchIndex,
+    library_signature,
+    shard_directory,
+)
 
 try:
     import pystray
@@ -37,6 +58,8 @@ if os.name == "nt":
     _user32.AttachThreadInput.argtypes = [wintypes.DWORD, wintypes.DWORD, wintypes.BOOL]
     _user32.AttachThreadInput.restype = wintypes.BOOL
     _user32.GetFocus.restype = wintypes.HWND
+    _user32.IsWindow.argtypes = [wintypes.HWND]
+    _user32.IsWindow.restype = wintypes.BOOL
     _user32.SendMessageW.argtypes = [
         wintypes.HWND,
         wintypes.UINT,
@@ -53,271 +76,238 @@ else:
     _kernel32 = None
     _WM_PASTE = None
 
-class ConfigManager:
-    """Менеджер конфигурации приложения (горячие клавиши и т.д.)"""
-    def __init__(self, config_file="config.json"):
-        self.config_file = config_file
-        self.config = {
-            "hotkeys": {
-                "search_templates": "<ctrl>+1",
-                "cascading_menu": "<ctrl>+2"
-            },
-            "features": {
-                "auto_paste": False
-            },
-            "settings": {
-                "paste_method": "wm_paste"
-            }
-        }
-        self.load_config()
-    
-    def load_config(self):
-        """Загрузить конфигурацию из файла"""
-        if os.path.exists(self.config_file):
+class TkClipboardBackend(ClipboardBackend):
+    """Буфер обмена через уже существующее окно Tk (без внешних процессов)"""
+    name = "tk"
+
+    def __init__(self, root_window):
+        self.root_window = root_window
+
+    def copy(self, text):
+        self.root_window.clipboard_clear()
+        self.root_window.clipboard_append(text)
+
+    def paste(self):
+        return self.root_window.clipboard_get()
+
+def run_clipboard_helper():
+    """Точка входа вспомогательного процесса буфера обмена (см. HelperProcessClipboardBackend)"""
+    root = tk.Tk()
+    root.withdraw()
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    requests = queue.Queue()
+
+    def reader():
+        while True:
+            line = stdin.readline()
+            if not line:
+                requests.put(None)
+                return
+            command, _, size = line.decode("ascii").strip().partition(" ")
+            payload = stdin.read(int(size)) if size and int(size) else b""
+            requests.put((command, payload))
+
+    def respond(status, data=b""):
+        stdout.write(f"{status} {len(data)}\n".encode("ascii") + data)
+        stdout.flush()
+
+    def process_requests():
+        while True:
             try:
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    loaded_config = json.load(f)
-                    # Объединить с дефолтной конфигурацией
-                    self.config.update(loaded_config)
+                item = requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                root.destroy()
+                return
+            command, payload = item
+            try:
+                if command == "COPY":
+                    root.clipboard_clear()
+                    root.clipboard_append(payload.decode("utf-8"))
+                    root.update_idletasks()
+                    respond("OK")
+                elif command == "PASTE":
+                    respond("OK", root.clipboard_get().encode("utf-8"))
+                else:
+                    respond("ERR", f"неизвестная команда: {command}".encode("utf-8"))
             except Exception as e:
-                print(f"Ошибка загрузки конфигурации: {e}")
-                self.save_config()
-        else:
-            self.save_config()
-    
-    def save_config(self):
-        """Сохранить конфигурацию в файл"""
+                respond("ERR", str(e).encode("utf-8"))
+        root.after(5, process_requests)
+
+    threading.Thread(target=reader, daemon=True).start()
+    root.after(0, process_requests)
+    root.mainloop()
+
+class TypeOutPaster:
+    """Вставка «набором»: текст печатается через keyboard.Controller порциями.
+
+    Нужна для целей, которые не принимают вставку из буфера обмена
+    (некоторые терминалы и удалённые консоли). Работает в фоновом потоке,
+    отменяется клавишей Escape. cps — символов в секунду; 0 означает
+    автоподбор: скорость растёт, пока ввод успевает, и снижается, когда
+    не успевает. Подобранная скорость используется при следующем наборе.
+    """
+    TICK = 0.05  # Длительность одной порции (с) при текущей скорости
+    MIN_CPS = 20
+    MAX_CPS = 5000
+    DEFAULT_AUTO_CPS = 200
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, cps=0, latency_stats=None, on_progress=None, on_finish=None):
+        self.cps = cps
+        self.auto_cps = self.DEFAULT_AUTO_CPS
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats()
+        self.on_progress = on_progress  # on_progress(sent, total) — из фонового потока
+        self.on_finish = on_finish  # on_finish(result) — из фонового потока
+        self.last_result = None
+        self._cancel_event = threading.Event()
+        self._thread = None
+
+    def is_busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text, hotkey_time=None):
+        """Начать набор текста; возвращает False, если набор уже идёт"""
+        if self.is_busy():
+            print("Набор текста уже выполняется")
+            return False
+        self._cancel_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(text, hotkey_time), daemon=True)
+        self._thread.start()
+        return True
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def _on_key_press(self, key):
+        if key == Key.esc:
+            self.cancel()
+
+    def _run(self, text, hotkey_time):
+        controller = keyboard.Controller()
+        listener = None
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, ensure_ascii=False, indent=2)
+            listener = keyboard.Listener(on_press=self._on_key_press)
+            listener.start()
         except Exception as e:
-            print(f"Ошибка сохранения конфигурации: {e}")
-    
-    def get_hotkey(self, hotkey_name):
-        """Получить горячую клавишу по названию"""
-        return self.config.get("hotkeys", {}).get(hotkey_name, "")
-    
-    def set_hotkey(self, hotkey_name, hotkey_value):
-        """Установить горячую клавишу"""
-        if "hotkeys" not in self.config:
-            self.config["hotkeys"] = {}
-        self.config["hotkeys"][hotkey_name] = hotkey_value
-        self.save_config()
-
-    def get_feature(self, feature_name, default=False):
-        """Получить значение фичи из конфигурации"""
-        return self.config.get("features", {}).get(feature_name, default)
-
-    def set_feature(self, feature_name, feature_value):
-        """Установить значение фичи в конфигурации"""
-        if "features" not in self.config:
-            self.config["features"] = {}
-        self.config["features"][feature_name] = bool(feature_value)
-        self.save_config()
-
-    def get_setting(self, setting_name, default=None):
-        return self.config.get("settings", {}).get(setting_name, default)
-
-    def set_setting(self, setting_name, setting_value):
-        if "settings" not in self.config:
-            self.config["settings"] = {}
-        self.config["settings"][setting_name] = setting_value
-        self.save_config()
-
-class TemplateNode:
-    """Узел для хранения шаблона или папки"""
-    def __init__(self, name, content="", is_folder=False):
-        self.name = name
-        self.content = content
-        self.is_folder = is_folder
-        self.children = OrderedDict()  # Использовать OrderedDict для сохранения порядка
-        self.parent = None
-    
-    def add_child(self, child):
-        """Добавить дочерний элемент"""
-        child.parent = self
-        self.children[child.name] = child
-    
-    def remove_child(self, name):
-        """Удалить дочерний элемент"""
-        if name in self.children:
-            del self.children[name]
-    
-    def move_child_up(self, name):
-        """Переместить дочерний элемент вверх в списке"""
-        if name not in self.children:
-            return False
-        
-        keys = list(self.children.keys())
-        index = keys.index(name)
-        
-        if index > 0:
-            # Переместить элемент вверх
-            old_index = index
-            new_index = index - 1
-            
-            # Создать новый упорядоченный словарь с измененным порядком
-            new_children = OrderedDict()
-            for i, key in enumerate(keys):
-                if i == new_index:
-                    new_children[keys[old_index]] = self.children[keys[old_index]]
-                if i != old_index:
-                    new_children[key] = self.children[key]
-            
-            self.children = new_children
-            return True
-        return False
-    
-    def move_child_down(self, name):
-        """Переместить дочерний элемент вниз в списке"""
-        if name not in self.children:
-            return False
-        
-        keys = list(self.children.keys())
-        index = keys.index(name)
-        
-        if index < len(keys) - 1:
-            # Переместить элемент вниз
-            old_index = index
-            new_index = index + 1
-            
-            # Создать новый упорядоченный словарь с измененным порядком
-            new_children = OrderedDict()
-            for i, key in enumerate(keys):
-                if i == old_index:
-                    new_children[keys[new_index]] = self.children[keys[new_index]]
-                elif i == new_index:
-                    new_children[keys[old_index]] = self.children[keys[old_index]]
-                else:
-                    new_children[key] = self.children[key]
-            
-            self.children = new_children
-            return True
-        return False
-    
-    def get_path(self):
-        """Получить полный путь до узла"""
-        path = []
-        current = self
-        while current.parent is not None:
-            path.append(current.name)
-            current = current.parent
-        return "/".join(reversed(path))
-
-class TemplateManager:
-    """Менеджер шаблонов"""
-    def __init__(self, data_file="templates.json"):
-        self.data_file = data_file
-        self.root = TemplateNode("Root", "", True)
-        self.load_templates()
-    
-    def save_templates(self):
-        """Сохранить шаблоны в файл"""
-        data = self._node_to_dict(self.root)
-        with open(self.data_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    
-    def load_templates(self):
-        """Загрузить шаблоны из файла"""
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                self.root = self._dict_to_node(data)
-            except Exception as e:
-                print(f"Ошибка загрузки шаблонов: {e}")
-                self._create_sample_templates()
-        else:
-            self._create_sample_templates()
-    
-    def _create_sample_templates(self):
-        """Создать примеры шаблонов"""
-        # Папка приветствий
-        greetings = TemplateNode("Приветствия", "", True)
-        greetings.add_child(TemplateNode("Доброе утро", "Доброе утро! Как дела?"))
-        greetings.add_child(TemplateNode("Добрый день", "Добрый день! Надеюсь, у вас все хорошо."))
-        greetings.add_child(TemplateNode("Добрый вечер", "Добрый вечер! Хорошего отдыха."))
-        self.root.add_child(greetings)
-        
-        # Папка подписей
-        signatures = TemplateNode("Подписи", "", True)
-        signatures.add_child(TemplateNode("Официальная", "С уважением,\nИван Иванов\nТел: +7-123-456-7890"))
-        signatures.add_child(TemplateNode("Дружественная", "Всего наилучшего!\nИван"))
-        self.root.add_child(signatures)
-        
-        # Папка программирования
-        programming = TemplateNode("Программирование", "", True)
-        python_folder = TemplateNode("Python", "", True)
-        python_folder.add_child(TemplateNode("Импорты", "import os\nimport sys\nimport json"))
-        python_folder.add_child(TemplateNode("Main функция", "if __name__ == '__main__':\n    main()"))
-        programming.add_child(python_folder)
-        self.root.add_child(programming)
-        
-        self.save_templates()
-    
-    def _node_to_dict(self, node):
-        """Преобразовать узел в словарь с сохранением порядка"""
-        data = {
-            'name': node.name,
-            'content': node.content,
-            'is_folder': node.is_folder,
-            'children': {}
+            print(f"Отмена набора по Escape недоступна: {e}")
+            listener = None
+
+        auto = not self.cps
+        cps = self.auto_cps if auto else max(self.MIN_CPS, min(self.MAX_CPS, self.cps))
+        total = len(text)
+        sent = 0
+        error = None
+        started = time.perf_counter()
+        last_progress = started
+        try:
+            while sent < total and not self._cancel_event.is_set():
+                chunk = text[sent:sent + max(1, int(cps * self.TICK))]
+                chunk_started = time.perf_counter()
+                controller.type(chunk)
+                sent += len(chunk)
+                spent = time.perf_counter() - chunk_started
+                budget = len(chunk) / cps
+
+                if auto:
+                    if spent > budget:
+                        cps = max(self.MIN_CPS, cps * 0.8)
+                    elif spent < budget * 0.5:
+                        cps = min(self.MAX_CPS, cps * 1.1)
+
+                # Ограничение скорости; ожидание прерывается отменой
+                if spent < budget:
+                    self._cancel_event.wait(budget - spent)
+
+                now = time.perf_counter()
+                if self.on_progress and now - last_progress >= self.PROGRESS_INTERVAL:
+                    last_progress = now
+                    self.on_progress(sent, total)
+        except Exception as e:
+            error = e
+            print(f"Ошибка набора текста: {e}")
+        finally:
+            if listener is not None:
+                try:
+                    listener.stop()
+                except Exception:
+                    pass
+
+        finished = time.perf_counter()
+        elapsed = finished - started
+        if auto and error is None:
+            self.auto_cps = int(cps)
+        self.latency_stats.record("type_out.duration", elapsed)
+        if hotkey_time is not None and sent == total:
+            self.latency_stats.record("type_out.hotkey_to_done", finished - hotkey_time)
+        self.last_result = {
+            "sent": sent,
+            "total": total,
+            "seconds": elapsed,
+            "cps": sent / elapsed if elapsed > 0 else 0.0,
+            "cancelled": self._cancel_event.is_set(),
+            "error": str(error) if error else None,
         }
-        # Сохранить порядок детей используя OrderedDict
-        for child_name, child_node in node.children.items():
-            data['children'][child_name] = self._node_to_dict(child_node)
-        return data
-    
-    def _dict_to_node(self, data):
-        """Преобразовать словарь в узел"""
-        node = TemplateNode(data['name'], data.get('content', ''), data.get('is_folder', False))
-        # Использовать OrderedDict для сохранения порядка при загрузке
-        children_data = data.get('children', {})
-        # Если это обычный dict, преобразуем в OrderedDict
-        if children_data:
-            for child_name in children_data:
-                child_data = children_data[child_name]
-                child = self._dict_to_node(child_data)
-                node.add_child(child)
-        return node
-
-    def get_node_by_path(self, path):
-        """Найти узел по пути вида 'Папка/Подпапка/Шаблон'"""
-        if not path:
-            return self.root
-
-        parts = [p for p in path.split('/') if p]
-        current = self.root
-        for part in parts:
-            if part in current.children:
-                current = current.children[part]
-            else:
-                return None
-        return current
-    
-    def search_templates(self, query, node=None):
-        """Поиск шаблонов по названию"""
-        if node is None:
-            node = self.root
-        
-        results = []
-        for child in node.children.values():
-            if query.lower() in child.name.lower():
-                results.append(child)
-            if child.is_folder:
-                results.extend(self.search_templates(query, child))
-        
-        return results
+        if self.on_finish:
+            self.on_finish(self.last_result)
+
+class TypeAheadBuffer:
+    """Префикс, набираемый с клавиатуры для перехода к элементу списка.
+
+    Пауза дольше RESET_SECONDS или переход в другой список начинают
+    префикс заново; BackSpace стирает последний символ.
+    """
+    RESET_SECONDS = 1.0
+
+    def __init__(self):
+        self.text = ""
+        self._owner = None
+        self._last = 0.0
+
+    @staticmethod
+    def char_of(event):
+        """Символ для набора из события клавиатуры или None"""
+        if event.keysym == "BackSpace":
+            return "\b"
+        if event.state & 0x4 or not event.char or not event.char.isprintable():
+            return None  # Ctrl+..., стрелки, Enter и т.п.
+        return event.char
+
+    def feed(self, char, owner=None):
+        now = time.monotonic()
+        if owner is not self._owner or now - self._last > self.RESET_SECONDS:
+            self.text = ""
+        self._owner = owner
+        self._last = now
+        self.text = self.text[:-1] if char == "\b" else self.text + char
+        return self.text
+
+    def current(self):
+        """Набранный префикс или "", если пауза уже истекла"""
+        return self.text if time.monotonic() - self._last <= self.RESET_SECONDS else ""
+
+    def reset(self):
+        self.text = ""
+        self._owner = None
 
 class CascadingMenuSelector:
     """Каскадное меню для выбора шаблонов (похоже на контекстное меню Windows)"""
-    def __init__(self, template_manager, callback, root_window):
+    def __init__(self, template_manager, callback, root_window, frecency=None):
         self.template_manager = template_manager
         self.callback = callback
         self.root_window = root_window
+        self.frecency = frecency
+        self.frequent_first = False  # Часто используемые шаблоны и папки — сверху
         self.menus = {}  # Кэш меню для предотвращения дублей
         self.current_menu = None  # Текущее активное меню
         self._grab_win = None  # Прозрачное окно для перехвата кликов
+        # Набор с клавиатуры: меню -> (папка, {id(узел): номер пункта}, {номер пункта: подменю})
+        self._menu_entries = {}
+        self._active_menu = None
+        self._typeahead = TypeAheadBuffer()
+        self._label_offset = None  # Длина "📁 " в символах Tcl (для underline)
     
     def show(self, event=None):
         """Показать главное меню с папками и шаблонами"""
@@ -326,8 +316,11 @@ class CascadingMenuSelector:
             self._on_escape_key()
 
         main_menu = tk.Menu(self.root_window, tearoff=0)
+        self._menu_entries = {}
+        self._typeahead.reset()
         self._build_menu(main_menu, self.template_manager.root)
         self.current_menu = main_menu
+        self._active_menu = main_menu
 
         # Получаем координаты для показа меню
         try:
@@ -356,6 +349,8 @@ class CascadingMenuSelector:
         # Привязываем клики и клавишу Escape к закрытию меню
         self._grab_win.bind("<ButtonPress>", self._on_mouse_click, add=True)
         self._grab_win.bind("<Escape>", self._on_escape_key, add=True)
+        # Набор названия переходит к пункту открытого меню (см. _on_menu_key)
+        self._grab_win.bind("<KeyPress>", self._on_menu_key, add=True)
         self._grab_win.focus_set()
 
         # Устанавливаем global grab для перехвата событий везде
@@ -368,33 +363,105 @@ class CascadingMenuSelector:
         # Показываем меню
         main_menu.post(x, y)
     
-    def _build_menu(self, parent_menu, node):
-        """Рекурсивно построить меню с подменю для папок"""
-        # Сортируем дочерние элементы: папки первыми
-        folders = []
-        templates = []
-        
-        for child in node.children.values():
-            if child.is_folder:
-                folders.append(child)
-            else:
-                templates.append(child)
+    def _build_menu(self, parent_menu, node, now=None):
+        """Рекурсивно построить меню с подменю для папок.
+
+        Возвращает суммарный frecency-счёт шаблонов поддерева (0, если
+        порядок «частые сверху» выключен).
+        """
+        frequent = self.frequent_first and self.frecency is not None
+        if frequent and now is None:
+            now = time.time()
+
+        # Папки первыми; отсортированные списки папка хранит до смены состава
+        folders, templates = node.sorted_children()
+        positions = {}
+        cascades = {}
+        self._menu_entries[str(parent_menu)] = (node, positions, cascades)
+        parent_menu.bind("<<MenuSelect>>", self._on_menu_select)
+        # В Windows меню системное и клавиши до Tk не доходят: там работает
+        # подчёркнутая первая буква названия (стандартная мнемоника меню)
+        underline = {"underline": self._icon_length()} if sys.platform == "win32" else {}
         
         # Добавляем папки с подменю
-        for folder in sorted(folders, key=lambda x: x.name.lower()):
+        submenus = []
+        for folder in folders:
             submenu = tk.Menu(parent_menu, tearoff=0)
-            self._build_menu(submenu, folder)
-            parent_menu.add_cascade(label=f"📁 {folder.name}", menu=submenu)
+            submenus.append((self._build_menu(submenu, folder, now), folder, submenu))
+        if frequent:
+            submenus.sort(key=lambda item: -item[0])  # Сортировка устойчива: при равенстве — по алфавиту
+        for _, folder, submenu in submenus:
+            index = len(positions)
+            positions[id(folder)] = index
+            cascades[index] = submenu
+            parent_menu.add_cascade(label=f"📁 {folder.name}", menu=submenu, **underline)
         
         # Добавляем шаблоны как команды
         if folders:  # Разделитель между папками и шаблонами
             parent_menu.add_separator()
-        
-        for template in sorted(templates, key=lambda x: x.name.lower()):
+        first_template = len(folders) + (1 if folders else 0)
+        
+        total = sum(item[0] for item in submenus)
+        if frequent:
+            templates = self.frecency.rank(templates, now)
+            total += sum(self.frecency.score(template.id, now) for template in templates)
+        for offset, template in enumerate(templates):
+            positions[id(template)] = first_template + offset
             parent_menu.add_command(
                 label=f"📄 {template.name}",
-                command=lambda t=template: self._select_template(t)
+                command=lambda t=template: self._select_template(t),
+                **underline
             )
+        return total
+
+    def _icon_length(self):
+        """Длина префикса "📁 " в символах Tcl: в Tcl 8.6 эмодзи занимает два"""
+        if self._label_offset is None:
+            self._label_offset = int(self.root_window.tk.call("string", "length", "📁 "))
+        return self._label_offset
+
+    def _on_menu_select(self, event):
+        """Запомнить меню, по которому сейчас ходит пользователь"""
+        if str(event.widget) in self._menu_entries:
+            self._active_menu = event.widget
+
+    def _on_menu_key(self, event):
+        """Набор с клавиатуры: перейти к первому пункту с таким началом названия.
+
+        Enter выбирает шаблон, Enter или стрелка вправо на папке открывает её.
+        """
+        menu = self._active_menu
+        entry = self._menu_entries.get(str(menu)) if menu is not None else None
+        if entry is None:
+            return None
+        node, positions, cascades = entry
+
+        if event.keysym in ("Return", "KP_Enter", "Right"):
+            index = menu.index("active")
+            if index is None:
+                return "break"
+            submenu = cascades.get(index)
+            if submenu is not None:
+                menu.postcascade(index)
+                self._active_menu = submenu
+                submenu.activate(0)
+            elif event.keysym != "Right":
+                menu.invoke(index)
+            return "break"
+
+        char = TypeAheadBuffer.char_of(event)
+        if char is None:
+            return None
+        prefix = self._typeahead.feed(char, menu)
+        if not prefix:
+            return "break"
+        folders, templates = node.children_with_prefix(prefix)
+        indexes = [positions[id(child)] for child in (*folders, *templates) if id(child) in positions]
+        if indexes:
+            menu.activate(min(indexes))
+        else:
+            self.root_window.bell()
+        return "break"
     
     def _on_escape_key(self, event=None):
         """Закрыть меню при нажатии Escape"""
@@ -417,6 +484,8 @@ class CascadingMenuSelector:
     def _cleanup_menu_handlers(self):
         """Очистить обработчики событий меню"""
         self.current_menu = None
+        self._active_menu = None
+        self._menu_entries = {}
 
         if self._grab_win is not None:
             try:
@@ -437,11 +506,42 @@ class CascadingMenuSelector:
         # Вызываем callback
         self.callback(template, source="cascading_menu")
 
+class InstanceAlreadyRunning(Exception):
+    """Канал команд библиотеки занят другим экземпляром приложения"""
+
 class TextPasterApp:
     """Основное приложение TextPaster"""
-    def __init__(self, start_in_tray=False):
-        self.config_manager = ConfigManager()
-        self.template_manager = TemplateManager()
+    def __init__(self, start_in_tray=False, perf_report=None, config_manager=None,
+                 template_manager=None, enable_hotkeys=True, enable_ipc=True, watch_file=True):
+        # Канал команд от повторных запусков и textpaster_cli.py занимается
+        # раньше всего остального: проигравший запуск не должен ни читать,
+        # ни тем более записывать библиотеку. Команды, пришедшие до конца
+        # запуска, ждут _ipc_ready
+        data_file = template_manager.data_file if template_manager is not None else "templates.json"
+        self._ipc_ready = threading.Event()
+        self.instance_server = None
+        if enable_ipc:
+            server = InstanceServer(data_file, self._on_ipc_request)
+            if not server.start():
+                raise InstanceAlreadyRunning(data_file)
+            self.instance_server = server
+        self.config_manager = config_manager or ConfigManager()
+        # Файл пишется из снимка в фоновом потоке, поток Tk не ждёт диска
+        self.template_manager = template_manager or TemplateManager(data_file, background_save=True)
+        self.template_manager.undo_memory_limit = self.get_undo_memory_limit()
+        # Раскладка файла по папкам: при смене настройки файл переписывается
+        self.template_manager.set_sharded(self.config_manager.get_feature("sharded_storage", False))
+        self.template_manager.flush()
+        self.search_index = TemplateSearchIndex(self.template_manager)
+        # Индекс подписывается первым: остальные слушатели уже ищут по свежему
+        self.template_manager.add_listener(self.search_index.apply_changes)
+        # Каждый новый текст шаблона попадает в историю версий
+        self.history = TemplateHistory.for_library(self.template_manager.data_file)
+        self.template_manager.add_listener(self.history.on_templates_changed)
+        self.frecency = FrecencyStore.for_library(self.template_manager.data_file)
+        self.recent = RecentTemplates.for_library(self.template_manager)
+        self.latency_stats = LatencyStats()
+        self.perf_report = perf_report
         self.popup_window = None
         self.hotkey_listener = None
         self.main_window = tk.Tk()
@@ -455,10 +555,64 @@ class TextPasterApp:
         self.tray_thread = None
         self._is_quitting = False
         self._tray_supported = pystray is not None and Image is not None and ImageDraw is not None
+        self.clipboard = ClipboardService(
+            [
+                TkClipboardBackend(self.main_window),
+                HelperProcessClipboardBackend(),
+                PyperclipClipboardBackend(),
+            ],
+            latency_stats=self.latency_stats,
+            preferred=self.config_manager.get_setting("clipboard_backend", "auto"),
+        )
+        self._paste_hotkey_time = None  # Момент нажатия хоткея меню или окна последних шаблонов
+        self._transfer_thread = None  # Фоновый импорт или экспорт (см. _run_transfer)
+        self._calibration_thread = None  # Фоновый замер буфера обмена (см. calibrate_clipboard)
+        self.auto_paste = AutoPastePipeline(
+            self.main_window,
+            self.clipboard,
+            self._simulate_paste,
+            latency_stats=self.latency_stats,
+            focus_ready=self._paste_target_focused,
+        )
+        self.type_out = TypeOutPaster(
+            cps=self.get_type_out_cps(),
+            latency_stats=self.latency_stats,
+            on_progress=lambda sent, total: self.main_window.after(0, self._on_type_out_progress, sent, total),
+            on_finish=lambda result: self.main_window.after(0, self._on_type_out_finished, result),
+        )
         self.init_main_window()
-        self.cascading_menu = CascadingMenuSelector(self.template_manager, self.on_template_selected, self.main_window)
-        self.init_hotkeys()
+        self.template_manager.add_listener(self._on_templates_changed)
+        self.cascading_menu = CascadingMenuSelector(
+            self.template_manager, self.on_template_selected, self.main_window, frecency=self.frecency
+        )
+        self.cascading_menu.frequent_first = self.config_manager.get_feature("frequent_first", False)
+        self._prewarm_search_window()
+        self.recent_popup = RecentTemplatesPopup(
+            self.recent, self.on_template_selected, parent=self.main_window, latency_stats=self.latency_stats
+        )
         self.hotkeys_handle = None  # Для хранения объекта GlobalHotKeys
+        self.hotkeys_enabled = enable_hotkeys
+        if enable_hotkeys:
+            self.init_hotkeys()
+        # Настройки применяются сразу: из меню, из диалога и при правке config.json
+        self.config_manager.add_listener(self._on_config_changed)
+        # Правки templates.json другими программами (например, синхронизация
+        # общего диска) сливаются с деревом без перезагрузки
+        self.file_watcher = None
+        self.config_watcher = None
+        if watch_file:
+            self.template_manager.track_disk_state()
+            # В раскладке по папкам правка папки меняет только её файл
+            self.file_watcher = FileWatcher(
+                self.template_manager.data_file, self._on_templates_file_changed,
+                signature_of=library_signature,
+                directories=[shard_directory(self.template_manager.data_file)],
+            ).start()
+            self.config_watcher = FileWatcher(
+                self.config_manager.config_file,
+                lambda signature: self.main_window.after(0, self.config_manager.reload),
+            ).start()
+        self._ipc_ready.set()
     
     def init_main_window(self):
         """Инициализация основного окна"""
@@ -474,13 +628,22 @@ class TextPasterApp:
         file_menu.add_command(label="Создать папку", command=self.create_folder)
         file_menu.add_command(label="Создать шаблон", command=self.create_template)
         file_menu.add_separator()
+        file_menu.add_command(label="Импорт из файла...", command=self.import_templates)
+        file_menu.add_command(label="Импорт из папки...", command=lambda: self.import_templates(directory=True))
+        file_menu.add_command(label="Экспорт в файл...", command=self.export_templates)
+        file_menu.add_command(label="Экспорт в папку...", command=lambda: self.export_templates(directory=True))
+        file_menu.add_separator()
         file_menu.add_command(label="Свернуть в трей", command=self.minimize_to_tray)
         file_menu.add_separator()
         file_menu.add_command(label="Выход", command=self.exit_application)
         
         edit_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Правка", menu=edit_menu)
+        edit_menu.add_command(label="Отменить", accelerator="Ctrl+Z", command=self.undo)
+        edit_menu.add_command(label="Повторить", accelerator="Ctrl+Y", command=self.redo)
+        edit_menu.add_separator()
         edit_menu.add_command(label="Редактировать", command=self.edit_selected)
+        edit_menu.add_command(label="История версий...", command=self.show_history)
         edit_menu.add_command(label="Удалить", command=self.delete_selected)
         
         help_menu = tk.Menu(menubar, tearoff=0)
@@ -496,6 +659,18 @@ class TextPasterApp:
             variable=self.auto_paste_var,
             command=self.toggle_auto_paste
         )
+        self.frequent_first_var = tk.BooleanVar(value=self.config_manager.get_feature("frequent_first", False))
+        settings_menu.add_checkbutton(
+            label="Меню: часто используемые сверху",
+            variable=self.frequent_first_var,
+            command=self.toggle_frequent_first
+        )
+        self.sharded_storage_var = tk.BooleanVar(value=self.config_manager.get_feature("sharded_storage", False))
+        settings_menu.add_checkbutton(
+            label="Хранить папки в отдельных файлах",
+            variable=self.sharded_storage_var,
+            command=self.toggle_sharded_storage
+        )
         
         # Панель инструментов
         self.paste_method_var = tk.StringVar(
@@ -514,6 +689,33 @@ class TextPasterApp:
             value="ctrl_v",
             command=self.on_paste_method_change
         )
+        settings_menu.add_radiobutton(
+            label="Paste: набор текста (Esc — отмена)",
+            variable=self.paste_method_var,
+            value="type_out",
+            command=self.on_paste_method_change
+        )
+        settings_menu.add_command(label="Скорость набора...", command=self.change_type_out_cps)
+        settings_menu.add_separator()
+        settings_menu.add_command(label="Задержка предпросмотра...", command=self.change_preview_delay)
+
+        clipboard_menu = tk.Menu(settings_menu, tearoff=0)
+        settings_menu.add_cascade(label="Буфер обмена", menu=clipboard_menu)
+        self.clipboard_backend_var = tk.StringVar(value=self.clipboard.preferred)
+        for value, label in (
+            ("auto", "Авто (самый быстрый)"),
+            ("tk", "Tk (окно приложения)"),
+            ("helper", "Вспомогательный процесс"),
+            ("pyperclip", "pyperclip"),
+        ):
+            clipboard_menu.add_radiobutton(
+                label=label,
+                variable=self.clipboard_backend_var,
+                value=value,
+                command=self.on_clipboard_backend_change
+            )
+        clipboard_menu.add_separator()
+        clipboard_menu.add_command(label="Замерить скорость...", command=self.calibrate_clipboard)
 
         toolbar = ttk.Frame(self.main_window)
         toolbar.pack(fill=tk.X, padx=5, pady=5)
@@ -535,12 +737,15 @@ class TextPasterApp:
         
         ttk.Button(toolbar, text="🔍 Поиск шаблонов", command=self.show_popup_selector).pack(side=tk.LEFT, padx=2)
         ttk.Button(toolbar, text="Меню выбора", command=lambda: self.cascading_menu.show() if self.cascading_menu else None).pack(side=tk.LEFT, padx=2)
+        ttk.Button(toolbar, text="Последние", command=lambda: self.show_recent_popup()).pack(side=tk.LEFT, padx=2)
         
         # Поиск
         search_frame = ttk.Frame(self.main_window)
         search_frame.pack(fill=tk.X, padx=5, pady=5)
         
         ttk.Label(search_frame, text="Поиск:").pack(side=tk.LEFT)
+        self._search_after = None  # Отложенный фильтр дерева (см. on_search)
+        self._tree_filter = None   # (папки со скрытыми детьми, прежнее состояние раскрытия)
         self.search_var = tk.StringVar()
         self.search_var.trace_add('write', self.on_search)
         search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
@@ -573,14 +778,19 @@ class TextPasterApp:
         
         # Привязка событий
         self.tree.bind('<<TreeviewSelect>>', self.on_tree_select)
+        self.tree.bind('<<TreeviewOpen>>', self.on_tree_open)
         self.tree.bind('<Double-1>', self.on_tree_double_click)
         self.tree.bind('<Button-3>', self.on_tree_right_click)
         
         # Горячие клавиши в главном окне
         self.main_window.bind('<Control-1>', lambda e: self.show_popup_selector())
         self.main_window.bind('<Control-2>', lambda e: self.cascading_menu.show())
+        self.main_window.bind('<Control-3>', lambda e: self.show_recent_popup())
         self.main_window.bind('<F2>', lambda e: self.edit_selected())
         self.main_window.bind('<Delete>', lambda e: self.delete_selected())
+        self.main_window.bind('<Control-z>', lambda e: self._on_history_key(e, self.undo))
+        self.main_window.bind('<Control-y>', lambda e: self._on_history_key(e, self.redo))
+        self.main_window.bind('<Control-Z>', lambda e: self._on_history_key(e, self.redo))  # Ctrl+Shift+Z
         self.main_window.bind('<Return>', lambda e: self.copy_to_clipboard())
         self.main_window.bind('<Control-f>', lambda e: search_entry.focus_set())
         self.main_window.bind('<Unmap>', self.on_main_window_unmap)
@@ -591,6 +801,7 @@ class TextPasterApp:
         self.context_menu.add_command(label="Создать шаблон", command=self.create_template)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Редактировать", command=self.edit_selected)
+        self.context_menu.add_command(label="История версий...", command=self.show_history)
         self.context_menu.add_command(label="Удалить", command=self.delete_selected)
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Копировать в буфер", command=self.copy_to_clipboard)
@@ -608,85 +819,351 @@ class TextPasterApp:
         self.status_label.pack(side=tk.LEFT)
     
     def refresh_tree(self, search_query=""):
-        """Обновить дерево шаблонов"""
+        """Полностью перестроить дерево шаблонов (и отфильтровать по search_query)"""
+        # Скрытые фильтром строки не входят в get_children(): сначала вернуть их
+        self._clear_tree_filter()
         self.tree.delete(*self.tree.get_children())
-        
+        self._add_node_to_tree("", self.template_manager.root)
         if search_query:
-            # Показать результаты поиска
-            results = self.template_manager.search_templates(search_query)
-            for template in results:
-                path = template.get_path()
-                icon = "📁" if template.is_folder else "📄"
-                self.tree.insert("", tk.END, text=f"{icon} {template.name}", 
-                               values=(path,), tags=("search_result",))
+            self._apply_tree_filter(search_query)
+
+    def _apply_tree_filter(self, query):
+        """Оставить в дереве найденные шаблоны и папки, в которых они лежат.
+
+        Папка, найденная по названию, остаётся со всем содержимым. Строки не
+        пересоздаются: лишние отцепляются (detach) одним вызовом на папку, а
+        папки с найденным раскрываются. Ищет общий индекс окна поиска.
+        """
+        self._clear_tree_filter()
+        if not query.strip():
+            return
+        root = self.template_manager.root
+        shown = {id(root): (root, set())}  # папка -> id видимых детей
+        matched_folders = self.search_index.search_folders(query)
+        for folder in matched_folders:
+            shown.setdefault(id(folder), (folder, set()))
+        matched_ids = {folder.id for folder in matched_folders}
+
+        def inside_matched(folder):
+            while folder is not None:
+                if folder.id in matched_ids:
+                    return True
+                folder = folder.parent
+            return False
+
+        for node in [*self.search_index.search(query), *matched_folders]:
+            child = node
+            while child.parent is not None:
+                folder, visible = shown.setdefault(id(child.parent), (child.parent, set()))
+                if child.id in visible:
+                    break  # Выше по этой ветке уже всё отмечено
+                visible.add(child.id)
+                child = folder
+
+        # Найденное могло оказаться в папке, чьи строки ещё не заполнены
+        for folder, _ in list(shown.values()):
+            while folder.parent is not None and folder.parent is not root:
+                folder = folder.parent
+            self._fill_tree_item(folder)
+
+        open_before = {}
+        for folder, visible in shown.values():
+            if inside_matched(folder):
+                hidden = []
+            else:
+                hidden = [child.id for child in folder.children.values() if child.id not in visible]
+            if hidden:
+                self.tree.detach(*hidden)
+            if folder is not root:
+                open_before[folder.id] = self.tree.item(folder.id, "open")
+                self.tree.item(folder.id, open=True)
+        self._tree_filter = ([folder for folder, _ in shown.values()], open_before)
+
+    def _clear_tree_filter(self):
+        """Вернуть отцепленные фильтром строки на их места и прежнее раскрытие папок"""
+        if self._tree_filter is None:
+            return
+        folders, open_before = self._tree_filter
+        self._tree_filter = None
+        for folder in folders:
+            item = self._tree_item(folder)
+            if item is not None:
+                self.tree.set_children(
+                    item, *[child.id for child in folder.children.values() if self.tree.exists(child.id)]
+                )
+        for item, was_open in open_before.items():
+            if self.tree.exists(item):
+                self.tree.item(item, open=was_open)
+    
+    # Транзакции крупнее этого числа изменений проще показать перестройкой дерева
+    TREE_REBUILD_THRESHOLD = 500
+
+    def _on_templates_changed(self, changes):
+        """Дерево изменилось (одна транзакция TemplateManager): обновить только затронутые строки.
+
+        Выделение и раскрытые папки при этом сохраняются.
+        """
+        query = self.search_var.get()
+        if (len(changes) > self.TREE_REBUILD_THRESHOLD
+                or any(change.kind == TemplateChange.RELOADED for change in changes)):
+            self.refresh_tree(query)
         else:
-            # Показать полную структуру
-            self._add_node_to_tree("", self.template_manager.root)
-    
+            # Изменения применяются к полному дереву, затем фильтр — заново
+            self._clear_tree_filter()
+            for change in changes:
+                self._apply_tree_change(change)
+            if query:
+                self._apply_tree_filter(query)
+        selected = self.get_selected_node()
+        if selected is not None and any(change.node is selected for change in changes):
+            self.on_tree_select(None)
+
+    def _apply_tree_change(self, change):
+        """Применить одно изменение к Treeview (строка узла — iid = node.id)"""
+        tree = self.tree
+        node = change.node
+        if change.kind == TemplateChange.REMOVED:
+            if tree.exists(node.id):
+                tree.delete(node.id)
+        elif change.kind in (TemplateChange.ADDED, TemplateChange.MOVED):
+            # Узел мог быть удалён позже в той же транзакции
+            parent_item = self._tree_item(node.parent) if self.template_manager.contains(node) else None
+            if parent_item is None or tree.exists(self._pending_item(node.parent.id)):
+                # Строки папки ещё не заполнены: узел появится при её раскрытии
+                if tree.exists(node.id):
+                    tree.delete(node.id)
+                return
+            index = list(node.parent.children).index(node.name)
+            if tree.exists(node.id):
+                tree.move(node.id, parent_item, index)
+            else:
+                self._insert_tree_item(parent_item, node, index)
+        elif change.kind == TemplateChange.RENAMED:
+            if tree.exists(node.id):
+                tree.item(node.id, text=self._tree_label(node))
+        elif change.kind == TemplateChange.REORDERED:
+            self._sync_tree_order(node)
+
+    def _tree_item(self, node):
+        """iid строки узла ("" для корня) или None, если строки нет"""
+        if node is self.template_manager.root:
+            return ""
+        return node.id if self.tree.exists(node.id) else None
+
+    @staticmethod
+    def _tree_label(node):
+        return f"{'📁' if node.is_folder else '📄'} {node.name}"
+
+    def _sync_tree_order(self, folder):
+        """Привести порядок строк папки к порядку детей, двигая только несовпадающие"""
+        parent_item = self._tree_item(folder)
+        if parent_item is None or self.tree.exists(self._pending_item(folder.id)):
+            return
+        current = list(self.tree.get_children(parent_item))
+        desired = [child.id for child in folder.children.values() if self.tree.exists(child.id)]
+        for index, item in enumerate(desired):
+            if current[index] != item:
+                self.tree.move(item, parent_item, index)
+                current.remove(item)
+                current.insert(index, item)
+
+    def _insert_tree_item(self, parent_item, node, index=tk.END):
+        if self.tree.exists(node.id):
+            # Узел перенесли в папку, добавленную в той же транзакции
+            self.tree.move(node.id, parent_item, index)
+            return node.id
+        item_id = self.tree.insert(parent_item, index, iid=node.id, text=self._tree_label(node),
+                                   tags=("folder" if node.is_folder else "template",))
+        if node.is_folder and not node.children_loaded:
+            # Папка раскладки по папкам ещё не прочитана: её файл читается при
+            # раскрытии, а пока строка-заглушка даёт папке значок раскрытия
+            self.tree.insert(item_id, tk.END, iid=self._pending_item(node.id), text="…")
+        elif node.is_folder:
+            self._add_node_to_tree(item_id, node)
+        return item_id
+
+    @staticmethod
+    def _pending_item(folder_id):
+        """iid строки-заглушки папки, чьи строки ещё не заполнены"""
+        return f"pending:{folder_id}"
+
+    def _fill_tree_item(self, folder):
+        """Заменить заглушку папки строками её детей (читает папку)"""
+        pending = self._pending_item(folder.id)
+        if self.tree.exists(pending):
+            self.tree.delete(pending)
+            self._add_node_to_tree(folder.id, folder)
+
+    def on_tree_open(self, event):
+        """Папку раскрывают: заполнить её строки, если они отложены"""
+        # Раскрываемая строка (щелчком по значку или клавишей) — в фокусе
+        item = self.tree.focus()
+        if item and self.tree.exists(self._pending_item(item)):
+            self._fill_tree_item(self.template_manager.get_node_by_id(item))
+
     def _add_node_to_tree(self, parent, node):
         """Добавить узел в дерево"""
         for child in node.children.values():
-            icon = "📁" if child.is_folder else "📄"
-            # В Treeview сохраняем путь до узла как значение (строка). Сохранение объекта в values
-            # приводит к строковой сериализации и мешает корректному доступу.
-            path = child.get_path()
-            item_id = self.tree.insert(parent, tk.END, text=f"{icon} {child.name}", 
-                                     values=(path,), tags=("folder" if child.is_folder else "template",))
-            if child.is_folder:
-                self._add_node_to_tree(item_id, child)
+            # iid строки — постоянный id узла: строки не зависят от пути
+            # и обновляются по событиям TemplateManager точечно
+            self._insert_tree_item(parent, child)
     
     def on_tree_select(self, event):
         """Обработка выбора элемента в дереве"""
-        selection = self.tree.selection()
-        if selection:
-            item = selection[0]
-            values = self.tree.item(item, 'values')
-            if values:
-                path = values[0]
-                node = self.template_manager.get_node_by_path(path)
-                if node:
-                    if not node.is_folder:
-                        self.preview_text.delete(1.0, tk.END)
-                        self.preview_text.insert(1.0, node.content)
-                    else:
-                        self.preview_text.delete(1.0, tk.END)
-                        self.preview_text.insert(1.0, f"Папка: {node.name}\nСодержит {len(node.children)} элементов")
+        node = self.get_selected_node()
+        if node:
+            if not node.is_folder:
+                self.preview_text.delete(1.0, tk.END)
+                self.preview_text.insert(1.0, node.content)
+            else:
+                self.preview_text.delete(1.0, tk.END)
+                self.preview_text.insert(1.0, f"Папка: {node.name}\nСодержит {len(node.children)} элементов")
     
     def on_tree_double_click(self, event):
         """Обработка двойного клика по элементу дерева"""
-        selection = self.tree.selection()
-        if selection:
-            item = selection[0]
-            values = self.tree.item(item, 'values')
-            if values:
-                path = values[0]
-                node = self.template_manager.get_node_by_path(path)
-                if node and not node.is_folder:
-                    self.copy_to_clipboard()
+        node = self.get_selected_node()
+        if node and not node.is_folder:
+            self.copy_to_clipboard()
     
     def on_tree_right_click(self, event):
         """Обработка правого клика по дереву"""
         item = self.tree.identify_row(event.y)
-        if item:
+        # Клик по уже выделенному элементу сохраняет множественное выделение
+        if item and item not in self.tree.selection():
             self.tree.selection_set(item)
         self.context_menu.post(event.x_root, event.y_root)
     
+    # Пауза после последнего нажатия клавиши до фильтрации дерева
+    SEARCH_DEBOUNCE_MS = 150
+
     def on_search(self, *args):
-        """Обработка поиска"""
-        query = self.search_var.get()
-        self.refresh_tree(query)
+        """Обработка поиска: отфильтровать дерево, когда ввод приостановится.
+
+        Очистка поля возвращает дерево сразу — это дешево, пересоздания нет.
+        """
+        if self._search_after is not None:
+            self.main_window.after_cancel(self._search_after)
+            self._search_after = None
+        if not self.search_var.get():
+            self._clear_tree_filter()
+            return
+        self._search_after = self.main_window.after(self.SEARCH_DEBOUNCE_MS, self._run_tree_search)
+
+    def _run_tree_search(self):
+        self._search_after = None
+        self._apply_tree_filter(self.search_var.get())
     
     def get_selected_node(self):
         """Получить выбранный узел"""
         selection = self.tree.selection()
         if selection:
-            item = selection[0]
-            values = self.tree.item(item, 'values')
-            if values:
-                path = values[0]
-                return self.template_manager.get_node_by_path(path)
+            return self.template_manager.get_node_by_id(selection[0])
         return None
-    
+
+    def get_selected_nodes(self):
+        """Получить все выбранные узлы (без вложенных в выбранные папки)"""
+        nodes = []
+        for item in self.tree.selection():
+            node = self.template_manager.get_node_by_id(item)
+            if node is not None and node.parent is not None:
+                nodes.append(node)
+        return self.template_manager.outermost_nodes(nodes)
+    
+    TRANSFER_FILETYPES = [
+        ("NDJSON", "*.ndjson *.jsonl"),
+        ("CSV", "*.csv"),
+        ("JSON (templates.json)", "*.json"),
+        ("Все файлы", "*.*"),
+    ]
+
+    def import_templates(self, directory=False):
+        """Импорт из NDJSON, CSV, JSON или папки с файлами в выбранную папку.
+
+        Файл разбирается в фоновом потоке, дерево дополняется одной
+        транзакцией; совпадающие папки дополняются, совпадающие шаблоны
+        пропускаются.
+        """
+        if self._transfer_running():
+            return
+        if directory:
+            path = filedialog.askdirectory(parent=self.main_window, title="Импорт из папки", mustexist=True)
+        else:
+            path = filedialog.askopenfilename(
+                parent=self.main_window, title="Импорт из файла", filetypes=self.TRANSFER_FILETYPES
+            )
+        if not path:
+            return
+        manager = self.template_manager
+        selected = self.get_selected_node()
+        target = selected if selected and selected.is_folder else manager.root
+
+        def finish(tree):
+            if not manager.contains(target):
+                messagebox.showerror("Ошибка", "Папка назначения была удалена во время импорта")
+                return
+            added, skipped = manager.import_nodes(tree, target, "skip", merge_folders=True)
+            self.status_label.config(text=f"Импорт: добавлено {added}, пропущено совпадающих {skipped}")
+
+        self._run_transfer(
+            "Импорт",
+            lambda progress: manager.read_import(path, "dir" if directory else None, progress),
+            finish,
+        )
+
+    def export_templates(self, directory=False):
+        """Экспорт выбранной папки или шаблона (или всей библиотеки) в файл или папку"""
+        if self._transfer_running():
+            return
+        if directory:
+            path = filedialog.askdirectory(parent=self.main_window, title="Экспорт в папку")
+        else:
+            path = filedialog.asksaveasfilename(
+                parent=self.main_window, title="Экспорт в файл",
+                defaultextension=".ndjson", filetypes=self.TRANSFER_FILETYPES,
+            )
+        if not path:
+            return
+        manager = self.template_manager
+        selected = self.get_selected_node()
+        # Выгрузка идёт из снимка: дерево можно править, пока файл пишется
+        snapshot = manager.snapshot()
+        node = snapshot.get_node_by_path(selected.get_path()) if selected else snapshot.root
+        self._run_transfer(
+            "Экспорт",
+            lambda progress: manager.export_file(node, path, "dir" if directory else None, progress),
+            lambda count: self.status_label.config(text=f"Экспорт: записано элементов {count} в {path}"),
+        )
+
+    def _transfer_running(self):
+        if self._transfer_thread is not None:
+            messagebox.showinfo("Подождите", "Импорт или экспорт уже выполняется")
+            return True
+        return False
+
+    def _run_transfer(self, label, work, on_done):
+        """Выполнить work(progress) в фоновом потоке, затем on_done(результат) в потоке Tk"""
+        def progress(count):
+            self.main_window.after(0, lambda: self.status_label.config(text=f"{label}: обработано {count}..."))
+
+        def run():
+            try:
+                result, error = work(progress), None
+            except Exception as e:
+                result, error = None, e
+            self.main_window.after(0, finish, result, error)
+
+        def finish(result, error):
+            self._transfer_thread = None
+            if error is not None:
+                print(f"Ошибка: {label.lower()}: {error}")
+                messagebox.showerror("Ошибка", f"{label}: {error}")
+                return
+            on_done(result)
+
+        self.status_label.config(text=f"{label}...")
+        self._transfer_thread = threading.Thread(target=run, daemon=True)
+        self._transfer_thread.start()
+
     def create_folder(self):
         """Создать новую папку"""
         name = simpledialog.askstring("Создать папку", "Введите название папки:")
@@ -694,14 +1171,12 @@ class TextPasterApp:
             selected_node = self.get_selected_node()
             parent = selected_node if selected_node and selected_node.is_folder else self.template_manager.root
             
-            if name not in parent.children:
-                new_folder = TemplateNode(name, "", True)
-                parent.add_child(new_folder)
-                self.template_manager.save_templates()
-                self.refresh_tree()
-                self.status_label.config(text=f"Папка '{name}' создана")
-            else:
-                messagebox.showerror("Ошибка", "Папка с таким названием уже существует")
+            try:
+                self.template_manager.add(parent, TemplateNode(name, "", True))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
+                return
+            self.status_label.config(text=f"Папка '{name}' создана")
     
     def create_template(self):
         """Создать новый шаблон"""
@@ -711,14 +1186,12 @@ class TextPasterApp:
             selected_node = self.get_selected_node()
             parent = selected_node if selected_node and selected_node.is_folder else self.template_manager.root
             
-            if name not in parent.children:
-                new_template = TemplateNode(name, content)
-                parent.add_child(new_template)
-                self.template_manager.save_templates()
-                self.refresh_tree()
-                self.status_label.config(text=f"Шаблон '{name}' создан")
-            else:
-                messagebox.showerror("Ошибка", "Шаблон с таким названием уже существует")
+            try:
+                self.template_manager.add(parent, TemplateNode(name, content))
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
+                return
+            self.status_label.config(text=f"Шаблон '{name}' создан")
     
     def edit_selected(self):
         """Редактировать выбранный элемент"""
@@ -727,51 +1200,71 @@ class TextPasterApp:
             if node.is_folder:
                 new_name = simpledialog.askstring("Редактировать папку", "Новое название:", initialvalue=node.name)
                 if new_name and new_name != node.name:
-                    if node.parent and new_name not in node.parent.children:
-                        del node.parent.children[node.name]
-                        node.name = new_name
-                        node.parent.children[new_name] = node
-                        self.template_manager.save_templates()
-                        self.refresh_tree()
-                        self.status_label.config(text=f"Папка переименована в '{new_name}'")
-                    else:
-                        messagebox.showerror("Ошибка", "Папка с таким названием уже существует")
+                    try:
+                        self.template_manager.rename(node, new_name)
+                    except ValueError as e:
+                        messagebox.showerror("Ошибка", str(e))
+                        return
+                    self.status_label.config(text=f"Папка переименована в '{new_name}'")
             else:
                 dialog = TemplateDialog(self.main_window, node.name, node.content)
                 if dialog.result:
                     new_name, new_content = dialog.result
-                    if new_name != node.name:
-                        if node.parent and new_name not in node.parent.children:
-                            del node.parent.children[node.name]
-                            node.name = new_name
-                            node.parent.children[new_name] = node
-                        else:
-                            messagebox.showerror("Ошибка", "Шаблон с таким названием уже существует")
-                            return
-                    
-                    node.content = new_content
-                    self.template_manager.save_templates()
-                    self.refresh_tree()
+                    try:
+                        # Название и текст сохраняются одной транзакцией
+                        with self.template_manager.batch():
+                            self.template_manager.rename(node, new_name)
+                            self.template_manager.set_content(node, new_content)
+                    except ValueError as e:
+                        messagebox.showerror("Ошибка", str(e))
+                        return
                     # Обновить предпросмотр: выбрать элемент снова по пути (имя могло измениться)
                     self.on_tree_select(None)
                     self.status_label.config(text=f"Шаблон '{node.name}' обновлен")
     
-    def delete_selected(self):
-        """Удалить выбранный элемент"""
+    def show_history(self):
+        """Показать версии выбранного шаблона и восстановить одну из них"""
         node = self.get_selected_node()
-        if node and node.parent:
+        if node is None or node.is_folder:
+            self.status_label.config(text="Выберите шаблон, чтобы посмотреть его историю")
+            return
+        if not self.history.versions(node.id):
+            messagebox.showinfo("История версий", f"У шаблона '{node.name}' пока нет сохранённых версий: "
+                                "они появляются после изменения текста")
+            return
+        dialog = TemplateHistoryDialog(self.main_window, self.history, node)
+        if dialog.result is None:
+            return
+        when, content = dialog.result
+        if not self.template_manager.contains(node):
+            messagebox.showerror("Ошибка", f"Шаблон '{node.name}' уже удален")
+            return
+        self.template_manager.set_content(node, content)
+        self.on_tree_select(None)
+        self.status_label.config(
+            text=f"Шаблон '{node.name}' восстановлен из версии от {time.strftime('%d.%m.%Y %H:%M', time.localtime(when))}"
+        )
+    
+    def delete_selected(self):
+        """Удалить выбранные элементы"""
+        nodes = self.get_selected_nodes()
+        if len(nodes) == 1:
+            node = nodes[0]
             if messagebox.askyesno("Подтверждение", f"Удалить {'папку' if node.is_folder else 'шаблон'} '{node.name}'?"):
-                node.parent.remove_child(node.name)
-                self.template_manager.save_templates()
-                self.refresh_tree()
+                self.template_manager.remove(node)
                 self.preview_text.delete(1.0, tk.END)
                 self.status_label.config(text=f"{'Папка' if node.is_folder else 'Шаблон'} '{node.name}' удален")
+        elif nodes:
+            if messagebox.askyesno("Подтверждение", f"Удалить выбранные элементы ({len(nodes)})?"):
+                count = self.template_manager.remove_many(nodes)
+                self.preview_text.delete(1.0, tk.END)
+                self.status_label.config(text=f"Удалено элементов: {count}")
     
     def copy_to_clipboard(self):
         """Копировать выбранный шаблон в буфер обмена"""
         node = self.get_selected_node()
         if node and not node.is_folder:
-            pyperclip.copy(node.content)
+            self.clipboard.copy(node.content)
             self.status_label.config(text=f"Шаблон '{node.name}' скопирован в буфер обмена")
             messagebox.showinfo("Готово", f"Текст шаблона '{node.name}' скопирован в буфер обмена")
     
@@ -779,11 +1272,13 @@ class TextPasterApp:
         """Показать информацию о горячих клавишах"""
         hotkey_1 = self.config_manager.get_hotkey("search_templates")
         hotkey_2 = self.config_manager.get_hotkey("cascading_menu")
+        hotkey_3 = self.config_manager.get_hotkey("recent_templates")
         
         info = f"""Горячие клавиши TextPaster:
 
 {hotkey_1} - Открыть окно поиска шаблонов по названию и содержимому
 {hotkey_2} - Открыть каскадное меню выбора шаблона (как контекстное меню)
+{hotkey_3} - Последние вставленные шаблоны (1–9 — вставить)
 
 В основном окне:
 F2 - Редактировать выбранный элемент
@@ -807,17 +1302,232 @@ Esc - Закрыть окно поиска
         """Показать диалог для переназначения горячих клавиш"""
         dialog = HotKeySettingsDialog(self.main_window, self.config_manager)
         if dialog.changed:
-            messagebox.showinfo("Информация", "Горячие клавиши обновлены. Пожалуйста, перезагрузите приложение для применения изменений.")
+            self.status_label.config(text="Горячие клавиши обновлены")
+
+    def _on_config_changed(self, changed):
+        """Применить изменённые настройки (слушатель ConfigManager)"""
+        config = self.config_manager
+        if self.hotkeys_enabled and any(section == "hotkeys" for section, _ in changed):
+            self.restart_hotkeys()
+        if ("features", "auto_paste") in changed:
+            self.auto_paste_var.set(config.get_feature("auto_paste", False))
+        if ("features", "frequent_first") in changed:
+            value = config.get_feature("frequent_first", False)
+            self.frequent_first_var.set(value)
+            if self.cascading_menu:
+                self.cascading_menu.frequent_first = value
+        if ("features", "sharded_storage") in changed:
+            value = config.get_feature("sharded_storage", False)
+            self.sharded_storage_var.set(value)
+            self.template_manager.set_sharded(value)
+            self.status_label.config(
+                text="Папки хранятся в отдельных файлах" if value else "Библиотека хранится в одном файле"
+            )
+        if ("settings", "paste_method") in changed:
+            self.paste_method_var.set(config.get_setting("paste_method", "wm_paste"))
+        if ("settings", "preview_delay_ms") in changed and self.popup_window is not None:
+            self.popup_window.preview_delay_ms = self.get_preview_delay_ms()
+        if ("settings", "clipboard_backend") in changed:
+            self.clipboard.preferred = config.get_setting("clipboard_backend", "auto")
+            self.clipboard_backend_var.set(self.clipboard.preferred)
+        if ("settings", "type_out_cps") in changed:
+            self.type_out.cps = self.get_type_out_cps()
+        if ("settings", "undo_memory_mb") in changed:
+            self.template_manager.undo_memory_limit = self.get_undo_memory_limit()
 
     def toggle_auto_paste(self):
         """Сохранить настройку быстрой вставки"""
         if hasattr(self, "auto_paste_var"):
             self.config_manager.set_feature("auto_paste", self.auto_paste_var.get())
 
+    def toggle_frequent_first(self):
+        """Сохранить порядок каскадного меню (часто используемые сверху)"""
+        self.config_manager.set_feature("frequent_first", self.frequent_first_var.get())
+
+    def toggle_sharded_storage(self):
+        """Сохранить раскладку файла шаблонов (папки верхнего уровня — отдельными файлами)"""
+        self.config_manager.set_feature("sharded_storage", self.sharded_storage_var.get())
+
     def on_paste_method_change(self):
         if hasattr(self, "paste_method_var"):
             self.config_manager.set_setting("paste_method", self.paste_method_var.get())
 
+    def get_preview_delay_ms(self):
+        """Задержка показа предпросмотра в окне поиска (мс)"""
+        try:
+            return max(0, int(self.config_manager.get_setting(
+                "preview_delay_ms", TemplateSearchDialog.DEFAULT_PREVIEW_DELAY_MS
+            )))
+        except (TypeError, ValueError):
+            return TemplateSearchDialog.DEFAULT_PREVIEW_DELAY_MS
+
+    def change_preview_delay(self):
+        """Изменить задержку предпросмотра"""
+        value = simpledialog.askinteger(
+            "Задержка предпросмотра",
+            "Задержка показа предпросмотра при наведении (мс):",
+            initialvalue=self.get_preview_delay_ms(),
+            minvalue=0,
+            maxvalue=10000,
+            parent=self.main_window,
+        )
+        if value is None:
+            return
+        self.config_manager.set_setting("preview_delay_ms", value)
+        self.status_label.config(text=f"Задержка предпросмотра: {value} мс")
+
+    def on_clipboard_backend_change(self):
+        self.config_manager.set_setting("clipboard_backend", self.clipboard_backend_var.get())
+
+    CALIBRATION_ROUNDS = 5
+
+    def calibrate_clipboard(self):
+        """Замерить задержку копирования каждым способом и показать p50/p99.
+
+        Tk замеряется здесь (он работает только в своём потоке), остальные
+        способы — в фоновом потоке: зависший xclip или вспомогательный
+        процесс не подвешивает окно. Потом прежний текст буфера возвращается.
+        """
+        if self._calibration_thread is not None and self._calibration_thread.is_alive():
+            self.status_label.config(text="Замер буфера обмена уже идёт")
+            return
+        clipboard = self.clipboard
+        rounds = self.CALIBRATION_ROUNDS
+        original = clipboard.current_text()
+        timings = {}
+        for name in clipboard.backends:
+            if name == "tk":
+                try:
+                    timings[name] = clipboard.time_copies(name, rounds)
+                except Exception as e:
+                    timings[name] = e
+
+        def run():
+            for name in clipboard.backends:
+                if name not in timings:
+                    try:
+                        timings[name] = clipboard.time_copies(name, rounds)
+                    except Exception as e:
+                        timings[name] = e
+            self.main_window.after(0, finish)
+
+        def finish():
+            self._calibration_thread = None
+            report = {}
+            for name in clipboard.backends:
+                result = timings.get(name)
+                if isinstance(result, Exception):
+                    report[name] = {"error": str(result)}
+                else:
+                    report[name] = clipboard.add_calibration(name, result)
+            # Если за время замера в буфер скопировали что-то другое, его не трогаем
+            if original is not None and clipboard.verify(f"{clipboard.CALIBRATION_TEXT} {rounds - 1}"):
+                clipboard.copy(original)
+            self._show_calibration_report(report)
+
+        self.status_label.config(text="Замер скорости буфера обмена...")
+        self._calibration_thread = threading.Thread(target=run, daemon=True)
+        self._calibration_thread.start()
+
+    def _show_calibration_report(self, report):
+        self.status_label.config(text="Замер буфера обмена завершен")
+        lines = []
+        for name, result in report.items():
+            if "error" in result:
+                lines.append(f"{name}: ошибка — {result['error']}")
+            else:
+                lines.append(f"{name}: p50 {result['p50_ms']} мс, p99 {result['p99_ms']} мс")
+        fastest = self.clipboard.ordered_backends()[0].name
+        lines.append("")
+        lines.append(f"В режиме «Авто» используется: {fastest}")
+        messagebox.showinfo("Буфер обмена", "\n".join(lines))
+
+    def get_undo_memory_limit(self):
+        """Лимит памяти истории отмены в байтах (settings.undo_memory_mb)"""
+        megabytes = self.config_manager.get_setting("undo_memory_mb", 16)
+        return megabytes * 1024 * 1024
+
+    UNDO_LABELS = {
+        TemplateChange.ADDED: "добавление",
+        TemplateChange.REMOVED: "удаление",
+        TemplateChange.RENAMED: "переименование",
+        TemplateChange.CONTENT: "изменение текста",
+        TemplateChange.MOVED: "перемещение",
+        TemplateChange.REORDERED: "изменение порядка",
+    }
+
+    def _on_history_key(self, event, action):
+        """Ctrl+Z/Ctrl+Y вне полей ввода: в строке поиска и тексте это их собственная правка"""
+        if isinstance(event.widget, (tk.Entry, tk.Text)):
+            return None
+        action()
+        return "break"
+
+    def undo(self):
+        """Отменить последнюю правку библиотеки (Ctrl+Z)"""
+        self._replay_history(self.template_manager.undo, "Отменено", "Нечего отменять")
+
+    def redo(self):
+        """Повторить отменённую правку (Ctrl+Y, Ctrl+Shift+Z)"""
+        self._replay_history(self.template_manager.redo, "Повторено", "Нечего повторять")
+
+    def _replay_history(self, action, done_label, empty_label):
+        try:
+            changes = action()
+        except Exception as e:
+            print(f"Ошибка отмены/повтора: {e}")
+            messagebox.showerror("Ошибка", f"Не удалось выполнить: {e}")
+            return
+        if not changes:
+            self.status_label.config(text=empty_label)
+            return
+        kinds = []
+        for change in changes:
+            label = self.UNDO_LABELS.get(change.kind)
+            if label and label not in kinds:
+                kinds.append(label)
+        nodes = {id(change.node) for change in changes}
+        details = ", ".join(kinds)
+        if len(nodes) == 1:
+            details += f" «{changes[0].node.name}»"
+        else:
+            details += f" ({len(nodes)} элементов)"
+        self.status_label.config(text=f"{done_label}: {details}")
+
+    def get_type_out_cps(self):
+        """Скорость набора текста (символов/с); 0 — автоподбор"""
+        try:
+            return max(0, int(self.config_manager.get_setting("type_out_cps", 0)))
+        except (TypeError, ValueError):
+            return 0
+
+    def change_type_out_cps(self):
+        """Изменить скорость набора текста"""
+        value = simpledialog.askinteger(
+            "Скорость набора",
+            "Символов в секунду (0 — подбирать автоматически):",
+            initialvalue=self.get_type_out_cps(),
+            minvalue=0,
+            maxvalue=TypeOutPaster.MAX_CPS,
+            parent=self.main_window,
+        )
+        if value is None:
+            return
+        self.config_manager.set_setting("type_out_cps", value)
+
+    def _on_type_out_progress(self, sent, total):
+        self.status_label.config(text=f"Набор текста: {sent}/{total} символов (Esc — отмена)")
+
+    def _on_type_out_finished(self, result):
+        if result["error"]:
+            text = f"Ошибка набора текста: {result['error']}"
+        elif result["cancelled"]:
+            text = f"Набор текста отменен: {result['sent']}/{result['total']} символов"
+        else:
+            text = f"Набрано {result['sent']} символов за {result['seconds']:.1f} с ({result['cps']:.0f} симв/с)"
+        print(text)
+        self.status_label.config(text=text)
+
     def is_auto_paste_enabled(self):
         """Проверить, включена ли быстрая вставка"""
         if hasattr(self, "auto_paste_var"):
@@ -842,6 +1552,22 @@ Esc - Закрыть окно поиска
             return
         self._last_foreground_hwnd = hwnd
 
+    def _paste_target_focused(self, method):
+        """Готово ли к вставке окно, запомненное до показа меню (None — не проверить).
+
+        WM_PASTE отправляется самому окну, ему достаточно, чтобы окно ещё
+        существовало; нажатия клавиш попадут в окно, только когда в него
+        вернулся фокус.
+        """
+        if _user32 is None or not self._last_foreground_hwnd:
+            return None
+        try:
+            if method == "wm_paste":
+                return bool(_user32.IsWindow(self._last_foreground_hwnd))
+            return _user32.GetForegroundWindow() == self._last_foreground_hwnd
+        except Exception:
+            return None
+
     def _get_paste_target_hwnd(self):
         if _user32 is None:
             return None
@@ -863,89 +1589,127 @@ Esc - Закрыть окно поиска
 
         return focused or hwnd
 
-    def _send_ctrl_v(self):
+    def _send_ctrl_v(self, key_delay=0.02):
         controller = keyboard.Controller()
         try:
             controller.press(Key.ctrl_l)
-            time.sleep(0.02)
+            time.sleep(key_delay)
             controller.press(KeyCode.from_char('v'))
             controller.release(KeyCode.from_char('v'))
-            time.sleep(0.02)
+            time.sleep(key_delay)
             controller.release(Key.ctrl_l)
+            return True
         except Exception as e:
-            print(f"Р?С?РёР+РєР° Р+С<С?С'С?Р?Р№ Р?С?С'Р°Р?РєРё: {e}")
+            print(f"Ошибка быстрой вставки: {e}")
             try:
                 controller.release(Key.ctrl_l)
             except Exception:
                 pass
+            return False
 
-    def _simulate_paste(self):
-        """Simulate paste in the active window."""
+    def get_paste_method(self):
+        """Текущий способ вставки (вызывать в потоке Tk)"""
         method = self.config_manager.get_setting("paste_method", "wm_paste")
         if hasattr(self, "paste_method_var"):
             method = self.paste_method_var.get() or method
+        return method
+
+    def _simulate_paste(self, method=None, key_delay=0.02):
+        """Simulate paste in the active window.
+
+        Called from the auto-paste worker thread, so it must not touch Tk.
+        Returns True if the paste was injected.
+        """
+        if method is None:
+            method = self.get_paste_method()
         if method == "ctrl_v" or _user32 is None:
-            self._send_ctrl_v()
-            return
+            return self._send_ctrl_v(key_delay)
         if method != "wm_paste":
-            self._send_ctrl_v()
-            return
+            return self._send_ctrl_v(key_delay)
         if _user32 is not None:
             hwnd = self._get_paste_target_hwnd()
             if not hwnd:
-                return
+                return False
             try:
                 _user32.SendMessageW(hwnd, _WM_PASTE, 0, 0)
             except Exception as e:
                 print(f"Paste error: {e}")
-            return
+                return False
+            return True
 
-    def move_selected_up(self):
-        """Переместить выбранный элемент вверх"""
-        node = self.get_selected_node()
-        if node and node.parent:
-            if node.parent.move_child_up(node.name):
-                self.template_manager.save_templates()
-                self.refresh_tree()
-                self.status_label.config(text=f"'{node.name}' перемещен выше")
-            else:
-                messagebox.showinfo("Информация", "Элемент уже находится в начале списка")
-        else:
+    def _move_selected(self, step):
+        """Сдвинуть выбранные элементы на одну позицию (step -1 — выше, 1 — ниже).
+
+        Выделенные соседи двигаются блоком; все папки меняются одной транзакцией.
+        """
+        nodes = self.get_selected_nodes()
+        if not nodes:
             messagebox.showwarning("Ошибка", "Выберите элемент для перемещения")
+            return False
+        if len(nodes) == 1:
+            node = nodes[0]
+            return self.template_manager.move_up(node) if step < 0 else self.template_manager.move_down(node)
+
+        by_parent = {}
+        for node in nodes:
+            by_parent.setdefault(id(node.parent), (node.parent, set()))[1].add(node.name)
+        moved = False
+        with self.template_manager.batch():
+            for parent, selected in by_parent.values():
+                names = list(parent.children)
+                indexes = range(1, len(names)) if step < 0 else range(len(names) - 2, -1, -1)
+                for i in indexes:
+                    j = i - 1 if step < 0 else i + 1
+                    if names[i] in selected and names[j] not in selected:
+                        names[i], names[j] = names[j], names[i]
+                if names != list(parent.children):
+                    self.template_manager.reorder(parent, names)
+                    moved = True
+        return moved
+
+    def move_selected_up(self):
+        """Переместить выбранные элементы вверх"""
+        nodes = self.get_selected_nodes()
+        if self._move_selected(-1):
+            label = f"'{nodes[0].name}'" if len(nodes) == 1 else f"Элементы ({len(nodes)})"
+            self.status_label.config(text=f"{label} перемещен{'ы' if len(nodes) > 1 else ''} выше")
+        elif nodes:
+            messagebox.showinfo("Информация", "Элемент уже находится в начале списка")
     
     def move_selected_down(self):
-        """Переместить выбранный элемент вниз"""
-        node = self.get_selected_node()
-        if node and node.parent:
-            if node.parent.move_child_down(node.name):
-                self.template_manager.save_templates()
-                self.refresh_tree()
-                self.status_label.config(text=f"'{node.name}' перемещен ниже")
-            else:
-                messagebox.showinfo("Информация", "Элемент уже находится в конце списка")
-        else:
-            messagebox.showwarning("Ошибка", "Выберите элемент для перемещения")
+        """Переместить выбранные элементы вниз"""
+        nodes = self.get_selected_nodes()
+        if self._move_selected(1):
+            label = f"'{nodes[0].name}'" if len(nodes) == 1 else f"Элементы ({len(nodes)})"
+            self.status_label.config(text=f"{label} перемещен{'ы' if len(nodes) > 1 else ''} ниже")
+        elif nodes:
+            messagebox.showinfo("Информация", "Элемент уже находится в конце списка")
     
     def move_selected_to_folder(self):
-        """Переместить выбранный элемент в другую папку"""
-        node = self.get_selected_node()
-        if not node or not node.parent:
+        """Переместить выбранные элементы в другую папку"""
+        nodes = self.get_selected_nodes()
+        if not nodes:
             messagebox.showwarning("Ошибка", "Выберите элемент для перемещения")
             return
         
         # Создать диалог выбора папки назначения
-        dialog = MoveToFolderDialog(self.main_window, self.template_manager, node)
+        dialog = MoveToFolderDialog(self.main_window, self.template_manager, nodes)
         if dialog.result:
             target_parent = dialog.result
-            if target_parent == node.parent:
+            if all(node.parent is target_parent for node in nodes):
                 messagebox.showinfo("Информация", "Элемент уже находится в этой папке")
                 return
             
-            # Переместить элемент
-            node.parent.remove_child(node.name)
-            target_parent.add_child(node)
-            self.template_manager.save_templates()
-            self.refresh_tree()
+            # Переместить элементы (все или ни одного)
+            try:
+                count = self.template_manager.move_many(nodes, target_parent)
+            except ValueError as e:
+                messagebox.showerror("Ошибка", str(e))
+                return
+            if len(nodes) > 1:
+                self.status_label.config(text=f"Перемещено элементов: {count} в '{target_parent.name}'")
+                return
+            node = nodes[0]
             self.status_label.config(text=f"'{node.name}' перемещен в '{target_parent.name}'")
     
     def init_hotkeys(self):
@@ -953,65 +1717,22 @@ Esc - Закрыть окно поиска
         # Получить горячие клавиши из конфигурации
         hotkey_1 = self.config_manager.get_hotkey("search_templates")
         hotkey_2 = self.config_manager.get_hotkey("cascading_menu")
-        
-        # Tkinter требует, чтобы все операции с GUI выполнялись в главном потоке.
-        # Глобальные хоткеи от pynput работают в отдельном потоке, поэтому любые вызовы
-        # GUI нужно делегировать в основной цикл через .after().
-        def _on_hotkey_1_mainthread():
-            """Горячая клавиша 1: показать всплывающее окно быстрого выбора"""
-            try:
-                self._capture_foreground_window()
-                if self.popup_window is None:
-                    self.show_popup_selector()
-                else:
-                    try:
-                        exists = self.popup_window.window.winfo_exists()
-                        if not exists:
-                            self.show_popup_selector()
-                    except Exception:
-                        self.show_popup_selector()
-            except Exception as e:
-                print(f"Ошибка в обработчике горячей клавиши 1: {e}")
-
-        def _on_hotkey_2_mainthread():
-            """Горячая клавиша 2: показать каскадное меню"""
-            try:
-                self._capture_foreground_window()
-                self.cascading_menu.show()
-            except Exception as e:
-                print(f"Ошибка в обработчике горячей клавиши 2: {e}")
-
-        def on_hotkey_1():
-            try:
-                if self.main_window:
-                    self.main_window.after(0, _on_hotkey_1_mainthread)
-                else:
-                    _on_hotkey_1_mainthread()
-            except Exception as e:
-                print(f"Ошибка в on_hotkey_1: {e}")
-
-        def on_hotkey_2():
-            try:
-                if self.main_window:
-                    self.main_window.after(0, _on_hotkey_2_mainthread)
-                else:
-                    _on_hotkey_2_mainthread()
-            except Exception as e:
-                print(f"Ошибка в on_hotkey_2: {e}")
+        hotkey_3 = self.config_manager.get_hotkey("recent_templates")
         
         def hotkey_thread():
             try:
-                # Создаем слушатель горячих клавиш для обоих хоткеев
+                # Создаем слушатель горячих клавиш для всех хоткеев
                 hotkeys_dict = {
-                    hotkey_1: on_hotkey_1,
-                    hotkey_2: on_hotkey_2
+                    hotkey_1: self.on_search_hotkey,
+                    hotkey_2: self.on_menu_hotkey
                 }
-                self.hotkeys_handle = keyboard.GlobalHotKeys(hotkeys_dict)
-                self.hotkeys_handle.start()
+                if hotkey_3 not in hotkeys_dict:
+                    hotkeys_dict[hotkey_3] = self.on_recent_hotkey
+                handle = self.hotkeys_handle = keyboard.GlobalHotKeys(hotkeys_dict)
+                handle.start()
                 
-                # Бесконечный цикл для поддержания работы
-                while True:
-                    time.sleep(0.1)
+                # Поток живёт, пока слушатель не остановят (restart_hotkeys, выход)
+                handle.join()
                     
             except Exception as e:
                 print(f"Ошибка горячих клавиш: {e}")
@@ -1020,28 +1741,254 @@ Esc - Закрыть окно поиска
         
         self.hotkey_thread = threading.Thread(target=hotkey_thread, daemon=True)
         self.hotkey_thread.start()
+
+    def restart_hotkeys(self):
+        """Перерегистрировать глобальные горячие клавиши после изменения настроек"""
+        handle, self.hotkeys_handle = self.hotkeys_handle, None
+        if handle is not None:
+            try:
+                handle.stop()
+            except Exception as e:
+                print(f"Ошибка остановки горячих клавиш: {e}")
+        self.init_hotkeys()
+
+    # Tkinter требует, чтобы все операции с GUI выполнялись в главном потоке.
+    # Глобальные хоткеи от pynput работают в отдельном потоке, поэтому любые вызовы
+    # GUI нужно делегировать в основной цикл через .after().
+    def on_search_hotkey(self):
+        """Горячая клавиша 1 (вызывается из потока pynput)"""
+        hotkey_time = time.perf_counter()
+        try:
+            if self.main_window:
+                self.main_window.after(0, self._on_search_hotkey_mainthread, hotkey_time)
+            else:
+                self._on_search_hotkey_mainthread(hotkey_time)
+        except Exception as e:
+            print(f"Ошибка в on_hotkey_1: {e}")
+
+    def on_menu_hotkey(self):
+        """Горячая клавиша 2 (вызывается из потока pynput)"""
+        hotkey_time = time.perf_counter()
+        try:
+            if self.main_window:
+                self.main_window.after(0, self._on_menu_hotkey_mainthread, hotkey_time)
+            else:
+                self._on_menu_hotkey_mainthread(hotkey_time)
+        except Exception as e:
+            print(f"Ошибка в on_hotkey_2: {e}")
+
+    def on_recent_hotkey(self):
+        """Горячая клавиша 3 (вызывается из потока pynput)"""
+        hotkey_time = time.perf_counter()
+        try:
+            if self.main_window:
+                self.main_window.after(0, self._on_recent_hotkey_mainthread, hotkey_time)
+            else:
+                self._on_recent_hotkey_mainthread(hotkey_time)
+        except Exception as e:
+            print(f"Ошибка в on_hotkey_3: {e}")
+
+    def _on_search_hotkey_mainthread(self, hotkey_time=None):
+        """Горячая клавиша 1: показать всплывающее окно быстрого выбора"""
+        try:
+            self._capture_foreground_window()
+            self.show_popup_selector(hotkey_time=hotkey_time)
+        except Exception as e:
+            print(f"Ошибка в обработчике горячей клавиши 1: {e}")
+
+    def _on_menu_hotkey_mainthread(self, hotkey_time=None):
+        """Горячая клавиша 2: показать каскадное меню"""
+        try:
+            self._capture_foreground_window()
+            self._paste_hotkey_time = hotkey_time
+            self.cascading_menu.show()
+        except Exception as e:
+            print(f"Ошибка в обработчике горячей клавиши 2: {e}")
+
+    def _on_recent_hotkey_mainthread(self, hotkey_time=None):
+        """Горячая клавиша 3: показать последние вставленные шаблоны"""
+        try:
+            self._capture_foreground_window()
+            self._paste_hotkey_time = hotkey_time
+            self.show_recent_popup(hotkey_time=hotkey_time)
+        except Exception as e:
+            print(f"Ошибка в обработчике горячей клавиши 3: {e}")
+
+    def show_recent_popup(self, hotkey_time=None):
+        """Показать окно последних шаблонов"""
+        if not self.recent_popup.exists():
+            self.recent_popup = RecentTemplatesPopup(
+                self.recent, self.on_template_selected, parent=self.main_window, latency_stats=self.latency_stats
+            )
+        self.recent_popup.show(hotkey_time=hotkey_time)
     
-    def show_popup_selector(self):
-        """Показать окно поиска шаблонов"""
-        # Закрываем существующее окно, если оно есть
-        if self.popup_window:
+    def _on_templates_file_changed(self, signature):
+        """Файл шаблонов изменился (поток FileWatcher): разобрать его здесь, слить в потоке Tk"""
+        if self.template_manager.is_own_write(signature):
+            return  # Это наша собственная запись
+        try:
+            external = self.template_manager.read_external()
+        except (OSError, ValueError) as e:
+            # Файл мог быть дописан не до конца: следующее событие прочитает его снова.
+            # Если он так и останется испорченным, следующая запись сохранит его
+            # копию и заменит файл (см. TemplateManager._write_snapshot)
+            print(f"Ошибка чтения изменённого файла шаблонов: {e}")
+            message = f"Файл шаблонов изменён снаружи и не читается: {e}"
+            self.main_window.after(0, lambda: self.status_label.config(text=message))
+            return
+        self.main_window.after(0, self._apply_external_templates, external, signature)
+
+    def _apply_external_templates(self, external, signature, interactive=True):
+        """Слить внешние изменения файла шаблонов с деревом"""
+        try:
+            applied, conflicts, conflict_copy = self.template_manager.apply_external(external, signature)
+        except Exception as e:
+            print(f"Ошибка слияния изменений файла шаблонов: {e}")
+            return
+        if not interactive:
+            return
+        if applied:
+            self.status_label.config(text=f"Шаблоны обновлены из файла: изменений {applied}")
+        if conflicts:
+            details = "\n".join(conflicts[:10])
+            if len(conflicts) > 10:
+                details += f"\n... и ещё {len(conflicts) - 10}"
+            copy_note = f"\n\nВерсия из файла сохранена в {conflict_copy}" if conflict_copy else ""
+            messagebox.showwarning(
+                "Конфликт изменений",
+                f"Файл шаблонов изменён другой программой, а здесь правились те же элементы. "
+                f"Оставлены здешние изменения:\n\n{details}{copy_note}",
+            )
+
+    # Команды от повторного запуска или консольной утилиты приходят в поток
+    # канала InstanceServer и, как хоткеи, выполняются в главном потоке.
+    IPC_TIMEOUT = 5.0
+    IPC_IMPORT_TIMEOUT = 300.0
+
+    def _on_ipc_request(self, request):
+        """Обработать запрос канала команд (вызывается из потока канала)"""
+        if request.get("command") == "ping":
+            return {"ok": True, "pid": os.getpid()}
+        if not self._ipc_ready.wait(self.IPC_TIMEOUT):
+            return {"ok": False, "error": "приложение ещё запускается"}
+        timeout = self.IPC_TIMEOUT
+        if request.get("command") == "import":
+            timeout = self.IPC_IMPORT_TIMEOUT
+            if "data" not in request:
+                # Файл или текст импорта разбирается здесь, главный поток только вливает дерево
+                source = request.get("path") or io.StringIO(request.get("text") or "")
+                try:
+                    request["tree"] = self.template_manager.read_import(source, request.get("format"))
+                except (OSError, ValueError) as e:
+                    return {"ok": False, "error": f"Не удалось прочитать {request.get('path') or 'stdin'}: {e}"}
+        done = threading.Event()
+        response = {}
+
+        def run():
             try:
-                self.popup_window.close()
-            except:
-                pass
+                response.update(self._handle_ipc_request(request))
+            except Exception as e:
+                response.update(ok=False, error=str(e))
+            finally:
+                done.set()
+
+        try:
+            self.main_window.after(0, run)
+        except Exception as e:
+            return {"ok": False, "error": f"приложение недоступно: {e}"}
+        if not done.wait(timeout):
+            return {"ok": False, "error": "приложение не ответило вовремя"}
+        return response
+
+    def _handle_ipc_request(self, request):
+        """Выполнить команду канала в главном потоке"""
+        command = request.get("command")
+        if command == "show":
+            self.restore_from_tray()
+            return {"ok": True}
+        if command == "search":
+            self._capture_foreground_window()
+            self.show_popup_selector()
+            query = request.get("query")
+            if query and self.popup_window is not None:
+                self.popup_window.search_var.set(query)
+            return {"ok": True}
+        if command == "copy":
+            node = self.template_manager.resolve(request.get("ref") or "")
+            if node is None or node.is_folder:
+                return {"ok": False, "error": f"Шаблон не найден: {request.get('ref')}"}
+            backend = self.clipboard.copy(node.content)
+            if backend is None:
+                return {"ok": False, "error": "Не удалось скопировать в буфер обмена"}
+            self.frecency.record(node.id)
+            self.recent.push(node)
+            return {"ok": True, "id": node.id, "path": node.get_path(), "backend": backend.name}
+        if command == "import":
+            target = self.template_manager.resolve(request.get("into") or "")
+            if target is None or not target.is_folder:
+                return {"ok": False, "error": f"Папка не найдена: {request.get('into')}"}
+            on_conflict, merge = request.get("on_conflict", "skip"), bool(request.get("merge"))
+            if "tree" in request:
+                added, skipped = self.template_manager.import_nodes(request["tree"], target, on_conflict, merge)
+            else:
+                added, skipped = self.template_manager.import_tree(request.get("data") or {}, target, on_conflict, merge)
+            return {"ok": True, "added": added, "skipped": skipped}
+        return {"ok": False, "error": f"Неизвестная команда: {command}"}
+
+    def _prewarm_search_window(self):
+        """Заранее создать скрытое окно поиска и построить индекс"""
+        try:
+            self.popup_window = TemplateSearchDialog(
+                self.template_manager,
+                self.on_template_selected,
+                search_index=self.search_index,
+                parent=self.main_window,
+                latency_stats=self.latency_stats,
+                frecency=self.frecency,
+                preview_delay_ms=self.get_preview_delay_ms(),
+            )
+        except Exception as e:
+            print(f"Ошибка создания окна поиска: {e}")
             self.popup_window = None
-        
-        # Используем новое окно поиска вместо старого навигационного
-        self.popup_window = TemplateSearchDialog(self.template_manager, self.on_template_selected)
+        # Индекс строим после старта главного цикла, чтобы не задерживать запуск.
+        # В раскладке по папкам — при первом поиске: индексу нужны все папки,
+        # а их файлы читаются только по мере надобности
+        if not self.template_manager.sharded:
+            self.main_window.after_idle(self.search_index.refresh)
+
+    def show_popup_selector(self, hotkey_time=None):
+        """Показать окно поиска шаблонов"""
+        # Окно создаётся один раз; пересоздаём только если его уничтожили
+        if self.popup_window is None or not self.popup_window.exists():
+            self._prewarm_search_window()
+        if self.popup_window is not None:
+            self.popup_window.show(hotkey_time=hotkey_time)
     
     def on_template_selected(self, template, source=None):
         """Обработка выбора шаблона во всплывающем окне"""
         if template and not template.is_folder:
-            pyperclip.copy(template.content)
-            # Показать уведомление в трее (опционально)
-            print(f"Шаблон '{template.name}' скопирован в буфер обмена")
-            if source == "cascading_menu" and self.is_auto_paste_enabled():
-                self.main_window.after(50, self._simulate_paste)
+            self.frecency.record(template.id)
+            self.recent.push(template)
+            auto_paste = source in ("cascading_menu", "recent") and self.is_auto_paste_enabled()
+            method = self.get_paste_method()
+            hotkey_time, self._paste_hotkey_time = self._paste_hotkey_time, None
+            if self.clipboard.copy(template.content) is None:
+                print(f"Не удалось скопировать шаблон '{template.name}' в буфер обмена")
+                # Набор текста не зависит от буфера обмена
+                if not (auto_paste and method == "type_out"):
+                    return
+            else:
+                # Показать уведомление в трее (опционально)
+                print(f"Шаблон '{template.name}' скопирован в буфер обмена")
+            if auto_paste:
+                if method == "type_out":
+                    # Дать меню закрыться и фокусу вернуться в целевое окно
+                    self.main_window.after(
+                        int(self.auto_paste.settle_delay * 1000),
+                        self.type_out.start, template.content, hotkey_time,
+                    )
+                else:
+                    self.auto_paste.schedule(template.content, method, hotkey_time=hotkey_time)
 
     def _create_tray_image(self):
         """Create a simple in-memory tray icon."""
@@ -1135,12 +2082,40 @@ Esc - Закрыть окно поиска
             except:
                 pass
         
-        self.template_manager.save_templates()
+        if self.config_watcher is not None:
+            self.config_watcher.close()
+        if self.file_watcher is not None:
+            self.file_watcher.close()
+            # Изменения файла, которые наблюдатель не успел передать, сливаются
+            # до последней записи: иначе она затёрла бы их
+            self.template_manager.flush()
+            signature = library_signature(self.template_manager.data_file)
+            if signature is not None and not self.template_manager.is_own_write(signature):
+                try:
+                    external = self.template_manager.read_external()
+                except (OSError, ValueError) as e:
+                    print(f"Ошибка чтения изменённого файла шаблонов: {e}")
+                else:
+                    self._apply_external_templates(external, signature, interactive=False)
+
+        # Все правки уже записаны транзакциями; осталось дождаться фоновой записи
+        self.template_manager.close()
         if self.popup_window:
             try:
-                self.popup_window.close()
+                self.popup_window.destroy()
             except:
                 pass
+        self.auto_paste.close()
+        self.type_out.cancel()
+        self.clipboard.close()
+        self.frecency.close()
+        self.history.close()
+        self.recent.save()
+        self.recent_popup.destroy()
+        if self.instance_server is not None:
+            self.instance_server.close()
+        if self.perf_report:
+            self.latency_stats.save_report(self.perf_report)
 
         if self.tray_icon:
             try:
@@ -1247,6 +2222,91 @@ class TemplateDialog:
         """Отменить"""
         self.dialog.destroy()
 
+class TemplateHistoryDialog:
+    """Диалог истории версий шаблона: список версий, просмотр и восстановление"""
+    def __init__(self, parent, history, node):
+        self.result = None  # (время версии, текст) для восстановления
+        self.history = history
+        self.versions = history.versions(node.id)
+        current = history.digest(node.content)
+
+        self.dialog = tk.Toplevel(parent)
+        self.dialog.title(f"История версий: {node.name}")
+        self.dialog.geometry("700x450")
+        self.dialog.transient(parent)
+        self.dialog.grab_set()
+
+        paned = ttk.PanedWindow(self.dialog, orient=tk.HORIZONTAL)
+        paned.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+
+        list_frame = ttk.LabelFrame(paned, text="Версии")
+        paned.add(list_frame, weight=1)
+        self.listbox = tk.Listbox(list_frame, exportselection=False, width=30)
+        self.listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        # В списке только время и длина: тексты читаются с диска при выборе версии
+        for when, digest, length in self.versions:
+            label = f"{time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(when))} — {length} симв."
+            if digest == current:
+                label += " (текущая)"
+            self.listbox.insert(tk.END, label)
+
+        preview_frame = ttk.LabelFrame(paned, text="Текст версии")
+        paned.add(preview_frame, weight=2)
+        self.preview_text = tk.Text(preview_frame, wrap=tk.WORD, state=tk.DISABLED)
+        self.preview_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        button_frame = ttk.Frame(self.dialog)
+        button_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=10, pady=10)
+        ttk.Button(button_frame, text="Восстановить", command=self.restore).pack(side=tk.RIGHT, padx=5)
+        ttk.Button(button_frame, text="Закрыть", command=self.cancel).pack(side=tk.RIGHT, padx=5)
+
+        self.listbox.bind('<<ListboxSelect>>', self.on_select)
+        self.listbox.bind('<Double-1>', lambda e: self.restore())
+        self.dialog.bind('<Return>', lambda e: self.restore())
+        self.dialog.bind('<Escape>', lambda e: self.cancel())
+
+        self.listbox.selection_set(0)
+        self.listbox.focus_set()
+        self.on_select()
+
+        self.dialog.wait_window()
+
+    def _selected(self):
+        selection = self.listbox.curselection()
+        return self.versions[selection[0]] if selection else None
+
+    def _read(self, version):
+        try:
+            return self.history.read(version[1])
+        except Exception as e:
+            print(f"Ошибка чтения версии шаблона: {e}")
+            return None
+
+    def on_select(self, event=None):
+        """Показать текст выбранной версии"""
+        version = self._selected()
+        content = self._read(version) if version else None
+        self.preview_text.config(state=tk.NORMAL)
+        self.preview_text.delete(1.0, tk.END)
+        self.preview_text.insert(1.0, content if content is not None else "(текст версии недоступен)")
+        self.preview_text.config(state=tk.DISABLED)
+
+    def restore(self):
+        """Восстановить выбранную версию"""
+        version = self._selected()
+        if version is None:
+            return
+        content = self._read(version)
+        if content is None:
+            messagebox.showerror("Ошибка", "Не удалось прочитать текст версии", parent=self.dialog)
+            return
+        self.result = (version[0], content)
+        self.dialog.destroy()
+
+    def cancel(self):
+        """Закрыть без восстановления"""
+        self.dialog.destroy()
+
 class PopupSelector:
     """Всплывающее окно для быстрого выбора шаблона"""
     def __init__(self, template_manager, callback):
@@ -1254,6 +2314,10 @@ class PopupSelector:
         self.callback = callback
         self.current_node = template_manager.root
         self.hover_timer = None
+        self.rows = []  # Узел каждой строки списка (None — строка «Назад»)
+        self._row_of = {}  # id(узел) -> номер строки
+        self._typeahead = TypeAheadBuffer()
+        self._typeahead_timer = None
         
         # Создание окна
         self.window = tk.Toplevel()
@@ -1320,34 +2384,60 @@ class PopupSelector:
     def refresh_list(self):
         """Обновить список элементов"""
         self.listbox.delete(0, tk.END)
+        self._typeahead.reset()
         
         # Показать кнопку "Назад" если не в корне
-        if self.current_node.parent is not None:
-            self.listbox.insert(tk.END, "📁 .. (Назад)")
-        
-        # Показать содержимое текущей папки
-        folders = []
-        templates = []
-        
-        for child in self.current_node.children.values():
-            if child.is_folder:
-                folders.append(child)
-            else:
-                templates.append(child)
-        
-        # Сначала папки, потом шаблоны
-        for folder in sorted(folders, key=lambda x: x.name.lower()):
-            self.listbox.insert(tk.END, f"📁 {folder.name}")
-        
-        for template in sorted(templates, key=lambda x: x.name.lower()):
-            self.listbox.insert(tk.END, f"📄 {template.name}")
-        
-        # Обновить путь
-        if self.current_node.parent is None:
+        self.rows = [None] if self.current_node.parent is not None else []
+        labels = ["📁 .. (Назад)"] if self.rows else []
+        
+        # Показать содержимое текущей папки: сначала папки, потом шаблоны
+        folders, templates = self.current_node.sorted_children()
+        self.rows.extend(folders)
+        self.rows.extend(templates)
+        labels.extend(f"📁 {folder.name}" for folder in folders)
+        labels.extend(f"📄 {template.name}" for template in templates)
+        self._row_of = {id(node): index for index, node in enumerate(self.rows) if node is not None}
+        if labels:
+            self.listbox.insert(tk.END, *labels)
+        self._show_path()
+
+    def _show_path(self):
+        """Путь текущей папки (или набираемый префикс) в строке под заголовком"""
+        prefix = self._typeahead.current()
+        if prefix:
+            self.path_label.config(text=f"Переход: {prefix}")
+        elif self.current_node.parent is None:
             self.path_label.config(text="Корень")
         else:
             path = self.current_node.get_path()
             self.path_label.config(text=path if path else "Корень")
+
+    def node_at(self, index):
+        """Узел строки index; None для строки «Назад» и вне списка"""
+        return self.rows[index] if 0 <= index < len(self.rows) else None
+
+    def type_ahead(self, char):
+        """Перейти к первой строке, название которой начинается с набранного"""
+        prefix = self._typeahead.feed(char, self.current_node)
+        self._show_path()
+        # Когда пауза истечёт, вернуть в строку путь папки
+        if self._typeahead_timer:
+            self.window.after_cancel(self._typeahead_timer)
+        self._typeahead_timer = self.window.after(
+            int(TypeAheadBuffer.RESET_SECONDS * 1000) + 50, self._show_path
+        )
+        if not prefix:
+            return
+        folders, templates = self.current_node.children_with_prefix(prefix)
+        match = next(iter(folders or templates), None)
+        if match is None:
+            self.window.bell()
+            return
+        index = self._row_of[id(match)]
+        self.listbox.selection_clear(0, tk.END)
+        self.listbox.selection_set(index)
+        self.listbox.activate(index)
+        self.listbox.see(index)
     
     def on_mouse_motion(self, event):
         """Обработка движения мыши"""
@@ -1371,15 +2461,10 @@ class PopupSelector:
     
     def on_hover_timeout(self, index):
         """Обработка таймаута наведения"""
-        if 0 <= index < self.listbox.size():
-            item_text = self.listbox.get(index)
-            if item_text.startswith("📁 ") and not item_text.endswith("(Назад)"):
-                folder_name = item_text[2:].strip()
-                if folder_name in self.current_node.children:
-                    folder = self.current_node.children[folder_name]
-                    if folder.is_folder:
-                        self.current_node = folder
-                        self.refresh_list()
+        node = self.node_at(index)
+        if node is not None and node.is_folder:
+            self.current_node = node
+            self.refresh_list()
     
     def on_click(self, event):
         """Обработка одиночного клика — выбрать шаблон или открыть папку через двойной клик"""
@@ -1395,13 +2480,12 @@ class PopupSelector:
         if not index:
             return
         
-        item_text = self.listbox.get(index[0])
+        node = self.node_at(index[0])
         
-        # Если это шаблон — выбрать (скопировать)
-        if item_text.startswith("📄 "):
+        # Если это шаблон — выбрать (скопировать), папку или «Назад» — открыть
+        if node is not None and not node.is_folder:
             self.select_item(index[0])
-        # Если это папка — открыть
-        elif item_text.startswith("📁 "):
+        else:
             self.handle_selection(index[0])
     
     def on_key_press(self, event):
@@ -1438,46 +2522,40 @@ class PopupSelector:
             self.listbox.selection_clear(0, tk.END)
             self.listbox.selection_set(new_index)
             self.listbox.see(new_index)
+        else:
+            # Набор начала названия — переход к подходящей строке
+            char = TypeAheadBuffer.char_of(event)
+            if char is not None:
+                self.type_ahead(char)
     
     def handle_selection(self, index):
         """Обработка выбора элемента"""
-        if index >= self.listbox.size():
+        if not 0 <= index < len(self.rows):
             return
         
-        item_text = self.listbox.get(index)
-        
-        if item_text == "📁 .. (Назад)":
+        node = self.rows[index]
+        if node is None:
             if self.current_node.parent:
                 self.current_node = self.current_node.parent
                 self.refresh_list()
-        elif item_text.startswith("📁 "):
-            folder_name = item_text[2:].strip()
-            if folder_name in self.current_node.children:
-                folder = self.current_node.children[folder_name]
-                if folder.is_folder:
-                    self.current_node = folder
-                    self.refresh_list()
+        elif node.is_folder:
+            self.current_node = node
+            self.refresh_list()
     
     def select_item(self, index):
         """Выбрать и скопировать шаблон"""
-        if index >= self.listbox.size():
-            return
-        
-        item_text = self.listbox.get(index)
-        
-        if item_text.startswith("📄 "):
-            template_name = item_text[2:].strip()
-            if template_name in self.current_node.children:
-                template = self.current_node.children[template_name]
-                if not template.is_folder:
-                    self.callback(template)
-                    self.close()
+        template = self.node_at(index)
+        if template is not None and not template.is_folder:
+            self.callback(template)
+            self.close()
     
     def close(self):
         """Закрыть окно"""
         try:
             if hasattr(self, 'hover_timer') and self.hover_timer:
                 self.window.after_cancel(self.hover_timer)
+            if self._typeahead_timer:
+                self.window.after_cancel(self._typeahead_timer)
             if hasattr(self, 'window'):
                 self.window.destroy()
         except:
@@ -1485,23 +2563,42 @@ class PopupSelector:
 
 
 class TemplateSearchDialog:
-    """Окно поиска шаблонов по названию и содержимому"""
-    def __init__(self, template_manager, callback):
+    """Окно поиска шаблонов по названию и содержимому.
+
+    Окно создаётся один раз и дальше только скрывается (withdraw) и
+    показывается (deiconify) через show()/close(), чтобы хоткей не
+    пересоздавал виджеты.
+    """
+    WIDTH = 500
+    HEIGHT = 400
+    PREVIEW_LIMIT = 500  # Сколько символов показывать в предпросмотре
+    DEFAULT_PREVIEW_DELAY_MS = 1000
+
+    def __init__(self, template_manager, callback, search_index=None, parent=None, latency_stats=None,
+                 preview_delay_ms=DEFAULT_PREVIEW_DELAY_MS, frecency=None):
         self.template_manager = template_manager
         self.callback = callback
+        self.search_index = search_index or TemplateSearchIndex(template_manager)
+        self.latency_stats = latency_stats
+        self.frecency = frecency  # Часто используемые шаблоны — в начале результатов
         self.search_results = []  # Найденные шаблоны
         self.selected_template = None
         
         # Переменные для предпросмотра
         self.preview_window = None
         self.preview_timer = None
+        self.preview_delay_ms = preview_delay_ms
         self.last_hovered_index = -1
+        self._preview_cache = {}  # шаблон -> (текст предпросмотра, нужен ли скроллбар)
+        self._preview_cache_version = None
         
-        # Создание окна
-        self.window = tk.Toplevel()
+        # Создание окна (сразу скрытого — показывается через show())
+        self.window = tk.Toplevel(parent)
+        self.window.withdraw()
         self.window.title("Поиск шаблонов")
-        self.window.geometry("500x400")
+        self.window.geometry(f"{self.WIDTH}x{self.HEIGHT}")
         self.window.attributes('-topmost', True)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
         
         # Стили
         self.window.configure(bg='#f0f0f0')
@@ -1525,7 +2622,6 @@ class TemplateSearchDialog:
         self.search_var.trace_add('write', self.on_search_change)
         self.search_entry = tk.Entry(search_frame, textvariable=self.search_var, font=('Arial', 12), width=50)
         self.search_entry.pack(fill=tk.X, pady=5)
-        self.search_entry.focus()
         
         # Информация о результатах
         self.info_label = tk.Label(self.window, text="Найдено: 0 результатов", 
@@ -1557,51 +2653,76 @@ class TemplateSearchDialog:
         
         # Центрировать окно
         self.center_window()
+
+        # Окно предпросмотра тоже создаётся заранее и переиспользуется
+        self._build_preview_window()
+
+        # Открытое окно не должно показывать удалённые или устаревшие шаблоны
+        self.template_manager.add_listener(self.on_templates_changed)
     
     def center_window(self):
         """Центрировать окно"""
-        self.window.update_idletasks()
-        width = self.window.winfo_width()
-        height = self.window.winfo_height()
+        # Размер задан явно: у скрытого окна winfo_width() ещё не известен
+        width, height = self.WIDTH, self.HEIGHT
         x = (self.window.winfo_screenwidth() // 2) - (width // 2)
         y = (self.window.winfo_screenheight() // 2) - (height // 2)
         self.window.geometry(f'{width}x{height}+{x}+{y}')
+
+    def show(self, hotkey_time=None):
+        """Показать окно: сбросить запрос и вернуть фокус в поле поиска.
+
+        hotkey_time — отметка time.perf_counter() нажатия хоткея; если
+        передана, задержка до появления окна записывается в latency_stats.
+        """
+        self.cancel_preview()
+        if self.search_var.get():
+            self.search_var.set("")
+        self.window.deiconify()
+        self.window.lift()
+        self.window.attributes('-topmost', True)
+        try:
+            self.window.focus_force()
+        except Exception:
+            pass
+        self.search_entry.focus_set()
+        if hotkey_time is not None and self.latency_stats is not None:
+            self.window.after_idle(
+                lambda: self.latency_stats.record(
+                    "search_window.hotkey_to_visible", time.perf_counter() - hotkey_time
+                )
+            )
+
+    def is_visible(self):
+        """Проверить, показано ли окно"""
+        try:
+            return self.window.winfo_exists() and self.window.state() != "withdrawn"
+        except Exception:
+            return False
+
+    def exists(self):
+        """Проверить, что окно не уничтожено"""
+        try:
+            return bool(self.window.winfo_exists())
+        except Exception:
+            return False
     
     def get_all_templates(self, node=None):
         """Получить все шаблоны (не папки) из дерева"""
-        if node is None:
-            node = self.template_manager.root
-        
-        templates = []
-        
-        for child in node.children.values():
-            if child.is_folder:
-                # Рекурсивно получить шаблоны из подпапок
-                templates.extend(self.get_all_templates(child))
-            else:
-                templates.append(child)
-        
-        return templates
+        if node is not None:
+            templates = []
+            for child in node.children.values():
+                if child.is_folder:
+                    templates.extend(self.get_all_templates(child))
+                else:
+                    templates.append(child)
+            return templates
+        return self.search_index.all_templates()
     
     def search_templates(self, query):
         """Поиск шаблонов по названию и содержимому"""
-        if not query.strip():
-            return []
-        
-        query_lower = query.lower()
-        all_templates = self.get_all_templates()
-        results = []
-        
-        for template in all_templates:
-            # Поиск по названию (точный и частичный)
-            if query_lower in template.name.lower():
-                results.append(template)
-                continue
-            
-            # Поиск по содержимому
-            if template.content and query_lower in template.content.lower():
-                results.append(template)
-        
+        results = self.search_index.search(query)
+        if self.frecency is not None:
+            results = self.frecency.rank(results)
         return results
     
     def on_search_change(self, *args):
@@ -1609,6 +2730,23 @@ class TemplateSearchDialog:
         query = self.search_var.get()
         self.search_results = self.search_templates(query)
         self.update_results_display()
+
+    def on_templates_changed(self, changes):
+        """Слушатель TemplateManager: пересчитать результаты, если окно открыто.
+
+        Выделение остаётся на том же шаблоне, если он всё ещё найден.
+        """
+        if not self.is_visible() or not self.search_var.get():
+            return
+        current = self.results_listbox.curselection()
+        selected = self.search_results[current[0]] if current and current[0] < len(self.search_results) else None
+        self.cancel_preview()
+        self.on_search_change()
+        if selected is not None and selected in self.search_results:
+            index = self.search_results.index(selected)
+            self.results_listbox.selection_clear(0, tk.END)
+            self.results_listbox.selection_set(index)
+            self.results_listbox.see(index)
     
     def update_results_display(self):
         """Обновить список результатов"""
@@ -1683,53 +2821,24 @@ class TemplateSearchDialog:
                 self.window.after_cancel(self.preview_timer)
                 self.preview_timer = None
             
-            # Закрыть старый предпросмотр если существует
-            if self.preview_window:
-                self.close_preview()
+            # Скрыть старый предпросмотр если он показан
+            self.close_preview()
             
-            # Установить таймер на 1 секунды для показа предпросмотра
-            self.preview_timer = self.window.after(1000, self.show_preview, index)
+            # Установить таймер для показа предпросмотра
+            self.preview_timer = self.window.after(self.preview_delay_ms, self.show_preview, index)
     
     def on_listbox_leave(self, event):
         """Обработка ухода мышки из списка"""
-        self.last_hovered_index = -1
-        
-        # Отменить таймер
-        if self.preview_timer:
-            self.window.after_cancel(self.preview_timer)
-            self.preview_timer = None
-        
-        # Закрыть предпросмотр
-        if self.preview_window:
-            self.close_preview()
-    
-    def show_preview(self, index):
-        """Показать предпросмотр содержимого шаблона"""
-        if not (0 <= index < len(self.search_results)):
-            return
-        
-        template = self.search_results[index]
-        
-        # Создать окно предпросмотра
+        self.cancel_preview()
+
+    def _build_preview_window(self):
+        """Создать окно предпросмотра один раз; дальше оно только заполняется"""
         self.preview_window = tk.Toplevel(self.window)
+        self.preview_window.withdraw()
         self.preview_window.wm_overrideredirect(True)  # Убрать заголовок окна
         self.preview_window.configure(bg='#fafafa')
-        
-        # Получить координаты элемента списка
-        listbox_x = self.results_listbox.winfo_rootx()
-        listbox_y = self.results_listbox.winfo_rooty()
-        item_height = self.results_listbox.winfo_height() // max(1, self.results_listbox.size())
-        item_y = listbox_y + item_height * index
-        
-        # Показать окно над элементом
-        preview_x = listbox_x - 320
-        preview_y = item_y - 10
-        
-        # Убедиться что окно не выходит за границы экрана
-        screen_width = self.preview_window.winfo_screenwidth()
-        if preview_x < 0:
-            preview_x = listbox_x + self.results_listbox.winfo_width() + 10
-        
+        self.preview_window.attributes('-topmost', True)
+
         # Рамка с тенью
         border_frame = tk.Frame(self.preview_window, bg='#bdbdbd')
         border_frame.pack(fill=tk.BOTH, expand=True)
@@ -1741,13 +2850,13 @@ class TemplateSearchDialog:
         header = tk.Frame(main_frame, bg='#e3f2fd')
         header.pack(fill=tk.X, padx=10, pady=(10, 5))
         
-        header_label = tk.Label(header, text=f"📄 {template.name}", 
-                               bg='#e3f2fd', font=('Arial', 11, 'bold'), fg='#1976d2')
-        header_label.pack(anchor=tk.W)
+        self.preview_header_label = tk.Label(header, text="", anchor=tk.W,
+                                             bg='#e3f2fd', font=('Arial', 11, 'bold'), fg='#1976d2')
+        self.preview_header_label.pack(anchor=tk.W)
         
-        path_label = tk.Label(header, text=f"Путь: {template.get_path()}", 
-                             bg='#e3f2fd', font=('Arial', 9), fg='#555')
-        path_label.pack(anchor=tk.W, pady=(0, 5))
+        self.preview_path_label = tk.Label(header, text="", anchor=tk.W,
+                                           bg='#e3f2fd', font=('Arial', 9), fg='#555')
+        self.preview_path_label.pack(anchor=tk.W, pady=(0, 5))
         
         # Содержимое
         content_label = tk.Label(main_frame, text="Содержимое:", 
@@ -1758,38 +2867,85 @@ class TemplateSearchDialog:
         text_frame = tk.Frame(main_frame, bg='#fafafa')
         text_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=(5, 10))
         
-        text_widget = tk.Text(text_frame, height=10, width=40, font=('Courier', 9),
-                             bg='#fff', fg='#222', wrap=tk.WORD, relief=tk.SUNKEN, bd=1)
-        text_widget.pack(fill=tk.BOTH, expand=True)
-        text_widget.config(state=tk.NORMAL)
-        text_widget.delete('1.0', tk.END)
+        self.preview_text_widget = tk.Text(text_frame, height=10, width=40, font=('Courier', 9),
+                                           bg='#fff', fg='#222', wrap=tk.WORD, relief=tk.SUNKEN, bd=1,
+                                           state=tk.DISABLED)
+        self.preview_text_widget.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        # Скроллбар показывается только для длинного содержимого
+        self.preview_scrollbar = tk.Scrollbar(text_frame, command=self.preview_text_widget.yview)
+        self.preview_text_widget.config(yscrollcommand=self.preview_scrollbar.set)
+        self._preview_scrollbar_shown = False
+
+    def get_preview_text(self, template):
+        """Получить сокращённый текст предпросмотра (кэшируется по версии дерева)"""
+        version = self.template_manager.version
+        if self._preview_cache_version != version:
+            self._preview_cache.clear()
+            self._preview_cache_version = version
+
+        cached = self._preview_cache.get(template)
+        if cached is None:
+            # Показать содержимое с обрезкой если слишком длинное
+            content = template.content if template.content else "[Пусто]"
+            if len(content) > self.PREVIEW_LIMIT:
+                content = content[:self.PREVIEW_LIMIT] + "\n\n[...сокращено...]"
+            cached = (content, content.count('\n') > 10)
+            self._preview_cache[template] = cached
+        return cached
+    
+    def show_preview(self, index):
+        """Показать предпросмотр содержимого шаблона"""
+        self.preview_timer = None
+        if not (0 <= index < len(self.search_results)):
+            return
+        
+        template = self.search_results[index]
+        if self.preview_window is None:
+            self._build_preview_window()
+        
+        # Получить координаты элемента списка
+        listbox_x = self.results_listbox.winfo_rootx()
+        listbox_y = self.results_listbox.winfo_rooty()
+        item_height = self.results_listbox.winfo_height() // max(1, self.results_listbox.size())
+        item_y = listbox_y + item_height * index
         
-        # Показать содержимое с обрезкой если слишком длинное
-        content = template.content if template.content else "[Пусто]"
-        # Обрезать содержимое если очень длинное
-        if len(content) > 500:
-            content = content[:500] + "\n\n[...сокращено...]"
+        # Показать окно над элементом
+        preview_x = listbox_x - 320
+        preview_y = item_y - 10
         
+        # Убедиться что окно не выходит за границы экрана
+        if preview_x < 0:
+            preview_x = listbox_x + self.results_listbox.winfo_width() + 10
+
+        # Заполнить уже созданные виджеты
+        content, needs_scrollbar = self.get_preview_text(template)
+        self.preview_header_label.config(text=f"📄 {template.name}")
+        self.preview_path_label.config(text=f"Путь: {template.get_path()}")
+
+        text_widget = self.preview_text_widget
+        text_widget.config(state=tk.NORMAL)
+        text_widget.delete('1.0', tk.END)
         text_widget.insert('1.0', content)
         text_widget.config(state=tk.DISABLED)  # Сделать read-only
+
+        if needs_scrollbar and not self._preview_scrollbar_shown:
+            self.preview_scrollbar.pack(side=tk.RIGHT, fill=tk.Y, before=text_widget)
+            self._preview_scrollbar_shown = True
+        elif not needs_scrollbar and self._preview_scrollbar_shown:
+            self.preview_scrollbar.pack_forget()
+            self._preview_scrollbar_shown = False
         
-        # Добавить скроллбар если нужно
-        scrollbar = tk.Scrollbar(text_frame, command=text_widget.yview)
-        if content.count('\n') > 10:
-            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-            text_widget.config(yscrollcommand=scrollbar.set)
-        
-        # Размер окна
+        # Размер и положение окна
         self.preview_window.geometry(f'380x250+{preview_x}+{preview_y}')
-        self.preview_window.attributes('-topmost', True)
+        self.preview_window.deiconify()
         self.preview_window.lift()
     
     def close_preview(self):
-        """Закрыть окно предпросмотра"""
+        """Скрыть окно предпросмотра"""
         try:
-            if self.preview_window:
-                self.preview_window.destroy()
-                self.preview_window = None
+            if self.preview_window is not None:
+                self.preview_window.withdraw()
         except:
             pass
     
@@ -1805,23 +2961,162 @@ class TemplateSearchDialog:
             self.callback(self.selected_template)
             self.close()
     
-    def close(self):
-        """Закрыть окно"""
-        # Отменить таймер предпросмотра
+    def cancel_preview(self):
+        """Отменить таймер и закрыть предпросмотр"""
+        self.last_hovered_index = -1
         if self.preview_timer:
             self.window.after_cancel(self.preview_timer)
             self.preview_timer = None
-        
-        # Закрыть окно предпросмотра
         self.close_preview()
-        
+
+    def close(self):
+        """Скрыть окно (виджеты сохраняются для следующего показа)"""
+        self.cancel_preview()
+        try:
+            self.window.withdraw()
+        except Exception:
+            pass
+
+    def destroy(self):
+        """Окончательно уничтожить окно (при выходе из приложения)"""
+        self.template_manager.remove_listener(self.on_templates_changed)
+        self.cancel_preview()
         try:
+            if self.preview_window is not None:
+                self.preview_window.destroy()
+                self.preview_window = None
             if hasattr(self, 'window'):
                 self.window.destroy()
         except:
             pass
 
 
+class RecentTemplatesPopup:
+    """Окно последних вставленных шаблонов (горячая клавиша 3).
+
+    Создаётся один раз и дальше только показывается/скрывается. Список
+    берётся из RecentTemplates, поэтому окно открывается за постоянное время
+    при любом размере библиотеки. Цифры 1–9 сразу выбирают шаблон.
+    """
+    WIDTH = 460
+    LINE_LIMIT = 50  # Сколько символов содержимого показывать в строке
+
+    def __init__(self, recent, callback, parent=None, latency_stats=None):
+        self.recent = recent
+        self.callback = callback
+        self.latency_stats = latency_stats
+        self.items = []
+        # Номера в открытом окне должны соответствовать живым шаблонам
+        self.recent.template_manager.add_listener(self.on_templates_changed)
+
+        self.window = tk.Toplevel(parent)
+        self.window.withdraw()
+        self.window.title("Последние шаблоны")
+        self.window.attributes('-topmost', True)
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.info_label = tk.Label(self.window, text="1–9 — вставить, Esc — закрыть",
+                                   font=('Arial', 9), fg='#666')
+        self.info_label.pack(fill=tk.X, padx=10, pady=(8, 2))
+
+        self.listbox = tk.Listbox(self.window, font=('Arial', 11), selectmode=tk.SINGLE,
+                                  activestyle='none', height=self.recent.capacity)
+        self.listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=(2, 10))
+
+        self.listbox.bind('<Double-Button-1>', lambda e: self.select(self.listbox.nearest(e.y)))
+        self.window.bind('<Return>', self.on_enter_pressed)
+        self.window.bind('<KP_Enter>', self.on_enter_pressed)
+        self.window.bind('<Escape>', lambda e: self.close())
+        self.window.bind('<Key>', self.on_key_press)
+
+    def _row_text(self, number, template):
+        first_line = template.content.split("\n", 1)[0][:self.LINE_LIMIT]
+        return f"{number}. {template.name}  —  {first_line}" if first_line else f"{number}. {template.name}"
+
+    def _fill(self):
+        self.items = self.recent.items()
+        self.listbox.delete(0, tk.END)
+        if self.items:
+            for number, template in enumerate(self.items, 1):
+                self.listbox.insert(tk.END, self._row_text(number, template))
+            self.listbox.selection_set(0)
+            self.listbox.activate(0)
+        else:
+            self.listbox.insert(tk.END, "Пока ничего не вставлялось")
+
+    def on_templates_changed(self, changes):
+        """Слушатель TemplateManager: перерисовать открытое окно"""
+        if self.is_visible():
+            self._fill()
+
+    def show(self, hotkey_time=None):
+        """Показать окно со списком последних шаблонов"""
+        self._fill()
+        x = (self.window.winfo_screenwidth() - self.WIDTH) // 2
+        y = self.window.winfo_screenheight() // 3
+        self.window.geometry(f"+{x}+{y}")
+        self.window.deiconify()
+        self.window.lift()
+        try:
+            self.window.focus_force()
+        except Exception:
+            pass
+        self.listbox.focus_set()
+        if hotkey_time is not None and self.latency_stats is not None:
+            self.window.after_idle(
+                lambda: self.latency_stats.record(
+                    "recent_window.hotkey_to_visible", time.perf_counter() - hotkey_time
+                )
+            )
+
+    def on_key_press(self, event):
+        """Цифра 1–9 (в том числе на цифровом блоке) выбирает шаблон"""
+        char = event.char
+        if char and char in "123456789":
+            self.select(int(char) - 1)
+            return "break"
+
+    def on_enter_pressed(self, event=None):
+        current = self.listbox.curselection()
+        if current:
+            self.select(current[0])
+
+    def select(self, index):
+        """Вставить шаблон с номером index + 1"""
+        if not 0 <= index < len(self.items):
+            return
+        template = self.items[index]
+        # Сначала спрятать окно, чтобы фокус вернулся в целевое приложение
+        self.close()
+        self.callback(template, source="recent")
+
+    def is_visible(self):
+        try:
+            return self.window.winfo_exists() and self.window.state() != "withdrawn"
+        except Exception:
+            return False
+
+    def exists(self):
+        try:
+            return bool(self.window.winfo_exists())
+        except Exception:
+            return False
+
+    def close(self):
+        """Скрыть окно"""
+        try:
+            self.window.withdraw()
+        except Exception:
+            pass
+
+    def destroy(self):
+        self.recent.template_manager.remove_listener(self.on_templates_changed)
+        try:
+            self.window.destroy()
+        except Exception:
+            pass
+
+
 class HotKeySettingsDialog:
     """Диалог для переназначения горячих клавиш"""
     def __init__(self, parent, config_manager):
@@ -1831,7 +3126,7 @@ class HotKeySettingsDialog:
         
         self.dialog = tk.Toplevel(parent)
         self.dialog.title("Переназначение горячих клавиш")
-        self.dialog.geometry("550x440")
+        self.dialog.geometry("550x510")
         self.dialog.transient(parent)
         self.dialog.grab_set()
         
@@ -1858,6 +3153,15 @@ class HotKeySettingsDialog:
         self.entry2 = ttk.Entry(frame2, textvariable=self.hotkey2_var, font=('Arial', 11), width=30)
         self.entry2.pack(fill=tk.X, pady=5)
         
+        # Горячая клавиша 3
+        frame3 = ttk.Frame(self.dialog)
+        frame3.pack(fill=tk.X, padx=20, pady=10)
+        
+        ttk.Label(frame3, text="Последние шаблоны:", font=('Arial', 10)).pack(anchor=tk.W)
+        self.hotkey3_var = tk.StringVar(value=self.config_manager.get_hotkey("recent_templates"))
+        self.entry3 = ttk.Entry(frame3, textvariable=self.hotkey3_var, font=('Arial', 11), width=30)
+        self.entry3.pack(fill=tk.X, pady=5)
+        
         # Примеры
         examples = ttk.LabelFrame(self.dialog, text="Доступные комбинации", padding=10)
         examples.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
@@ -1892,6 +3196,7 @@ class HotKeySettingsDialog:
         """Сохранить новые горячие клавиши"""
         hotkey1 = self.hotkey1_var.get().strip()
         hotkey2 = self.hotkey2_var.get().strip()
+        hotkey3 = self.hotkey3_var.get().strip()
         
         if not hotkey1:
             messagebox.showerror("Ошибка", "Горячая клавиша для поиска не может быть пустой")
@@ -1901,13 +3206,19 @@ class HotKeySettingsDialog:
             messagebox.showerror("Ошибка", "Горячая клавиша для меню не может быть пустой")
             return
         
-        if hotkey1 == hotkey2:
+        if not hotkey3:
+            messagebox.showerror("Ошибка", "Горячая клавиша для последних шаблонов не может быть пустой")
+            return
+        
+        if len({hotkey1, hotkey2, hotkey3}) < 3:
             messagebox.showerror("Ошибка", "Горячие клавиши должны быть разными")
             return
         
-        # Сохранить в конфиг
-        self.config_manager.set_hotkey("search_templates", hotkey1)
-        self.config_manager.set_hotkey("cascading_menu", hotkey2)
+        # Сохранить в конфиг одной записью; приложение перерегистрирует хоткеи
+        with self.config_manager.batch():
+            self.config_manager.set_hotkey("search_templates", hotkey1)
+            self.config_manager.set_hotkey("cascading_menu", hotkey2)
+            self.config_manager.set_hotkey("recent_templates", hotkey3)
         
         self.changed = True
         self.dialog.destroy()
@@ -1918,11 +3229,14 @@ class HotKeySettingsDialog:
 
 
 class MoveToFolderDialog:
-    """Диалог для выбора папки-назначения при перемещении элемента"""
-    def __init__(self, parent, template_manager, node_to_move):
+    """Диалог для выбора папки-назначения при перемещении элементов"""
+    def __init__(self, parent, template_manager, nodes_to_move):
         self.result = None
         self.template_manager = template_manager
-        self.node_to_move = node_to_move
+        if isinstance(nodes_to_move, TemplateNode):
+            nodes_to_move = [nodes_to_move]
+        self.nodes_to_move = nodes_to_move
+        self._excluded = {id(node) for node in nodes_to_move}  # Нельзя переместить папку в себя
         self.selected_folder = None
         
         self.dialog = tk.Toplevel(parent)
@@ -1932,8 +3246,11 @@ class MoveToFolderDialog:
         self.dialog.grab_set()
         
         # Информация
-        info_label = ttk.Label(self.dialog, text=f"Куда переместить '{node_to_move.name}'?", 
-                              font=('Arial', 10))
+        if len(nodes_to_move) == 1:
+            question = f"Куда переместить '{nodes_to_move[0].name}'?"
+        else:
+            question = f"Куда переместить выбранные элементы ({len(nodes_to_move)})?"
+        info_label = ttk.Label(self.dialog, text=question, font=('Arial', 10))
         info_label.pack(pady=10, padx=10)
         
         # Дерево папок
@@ -1945,8 +3262,9 @@ class MoveToFolderDialog:
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.tree.configure(yscrollcommand=scrollbar.set)
         
-        # Добавить папки в дерево
-        self._add_folders_to_tree("", self.template_manager.root)
+        # Добавить папки в дерево (корень — чтобы можно было вынести элементы наверх)
+        root_item = self.tree.insert("", tk.END, text="📁 (корень)", values=(id(self.template_manager.root),), open=True)
+        self._add_folders_to_tree(root_item, self.template_manager.root)
         
         # Кнопки
         button_frame = ttk.Frame(self.dialog)
@@ -1960,7 +3278,7 @@ class MoveToFolderDialog:
     def _add_folders_to_tree(self, parent_item, node):
         """Рекурсивно добавить папки в дерево"""
         for child in node.children.values():
-            if child.is_folder and child != self.node_to_move:
+            if child.is_folder and id(child) not in self._excluded:
                 # Сохраняем ссылку на объект узла как значение в дереве
                 item_id = self.tree.insert(parent_item, tk.END, text=f"📁 {child.name}", 
                                           values=(id(child),))
@@ -2014,15 +3332,75 @@ def parse_cli_args(argv=None):
         action="store_true",
         help="force visible window on startup",
     )
+    parser.add_argument(
+        "--clipboard-helper",
+        action="store_true",
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        nargs="?",
+        const="",
+        help="open the search window (with QUERY); forwarded to a running instance",
+    )
+    parser.add_argument(
+        "--perf-report",
+        metavar="PATH",
+        help="write latency metrics (p50/p99) as JSON to PATH on exit",
+    )
     return parser.parse_args(argv)
 
 
+FORWARD_RETRY_SECONDS = 5.0
+
+def forward_to_running_instance(request):
+    """Передать команду запущенному экземпляру; False, если он не запущен"""
+    try:
+        response = InstanceClient("templates.json").request(**request)
+    except Exception as e:
+        print(f"Ошибка связи с запущенным TextPaster: {e}")
+        return True
+    if response is None:
+        return False
+    if not response.get("ok"):
+        print(f"TextPaster: {response.get('error')}")
+    return True
+
 def main(argv=None):
     """Главная функция"""
     try:
         args = parse_cli_args(argv)
+        if args.clipboard_helper:
+            run_clipboard_helper()
+            return
         start_in_tray = args.start_in_tray and not args.start_visible
-        app = TextPasterApp(start_in_tray=start_in_tray)
+
+        # Если приложение уже запущено, передать ему команду и выйти
+        if args.search is not None:
+            request = {"command": "search", "query": args.search}
+        elif start_in_tray:
+            request = {"command": "ping"}
+        else:
+            request = {"command": "show"}
+        if forward_to_running_instance(request):
+            return
+
+        try:
+            app = TextPasterApp(start_in_tray=start_in_tray, perf_report=args.perf_report)
+        except InstanceAlreadyRunning:
+            # Другой экземпляр занял канал между проверкой и запуском (и,
+            # возможно, ещё не начал слушать) или канал не открылся вовсе.
+            # Второй экземпляр не запускается ни в каком случае
+            deadline = time.monotonic() + FORWARD_RETRY_SECONDS
+            while time.monotonic() < deadline:
+                if forward_to_running_instance(request):
+                    return
+                time.sleep(0.2)
+            print("TextPaster: не удалось занять канал команд или связаться с запущенным экземпляром")
+            return 1
+        if args.search is not None:
+            app.main_window.after(0, app._handle_ipc_request, request)
         app.run()
     except Exception as e:
         print(f"Ошибка запуска приложения: {e}")
@@ -2030,4 +3408,4 @@ def main(argv=None):
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TextPaster - консольный доступ к библиотеке шаблонов.
+
+Работает с тем же templates.json, что и приложение, но не импортирует
+tkinter, pynput и pystray: запуск быстрый, поэтому утилиту удобно
+вызывать из скриптов и циклов в shell.
+
+Примеры:
+    python textpaster_cli.py search "добрый"
+    python textpaster_cli.py --json search "добрый" | jq -r .path
+    python textpaster_cli.py get "Приветствия/Доброе утро"
+    python textpaster_cli.py copy 3f2a...           (по идентификатору)
+    python textpaster_cli.py list -r Программирование
+    python textpaster_cli.py export Подписи -o signatures.json
+    python textpaster_cli.py import signatures.json --into Архив
+    python textpaster_cli.py export -o snippets/           (папка с .txt)
+    python textpaster_cli.py import snippets.csv --into Архив
+    python textpaster_cli.py show --search "добрый"
+
+Если TextPaster уже запущен с той же библиотекой, copy и import
+выполняет он (без повторной загрузки и без гонки за templates.json),
+а show открывает его окно.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+
+from textpaster_core import (
+    TRANSFER_FORMATS,
+    InstanceClient,
+    TemplateManager,
+    TemplateSearchIndex,
+    detect_transfer_format,
+    write_records,
+)
+
+CONFLICT_POLICIES = ("skip", "replace", "rename")
+FORMATS = ("json",) + TRANSFER_FORMATS
+IMPORT_TIMEOUT = 600.0  # Большой импорт приложение читает и вливает дольше обычной команды
+
+
+class CliError(Exception):
+    """Ошибка, о которой достаточно сообщить одной строкой"""
+
+
+def node_record(node, with_content=True):
+    """Описание узла для вывода в формате JSON lines"""
+    record = {
+        "id": node.id,
+        "path": node.get_path(),
+        "name": node.name,
+        "type": "folder" if node.is_folder else "template",
+    }
+    if with_content and not node.is_folder:
+        record["content"] = node.content
+    return record
+
+
+class Output:
+    """Вывод результатов: построчно для человека или JSON lines"""
+    def __init__(self, stream, as_json=False):
+        self.stream = stream
+        self.as_json = as_json
+
+    def node(self, node, with_content=False):
+        if self.as_json:
+            self.stream.write(json.dumps(node_record(node, with_content), ensure_ascii=False) + "\n")
+        else:
+            path = node.get_path()
+            self.stream.write(f"{path}/\n" if node.is_folder else f"{path}\n")
+
+    def content(self, node):
+        if self.as_json:
+            self.node(node, with_content=True)
+        else:
+            self.stream.write(node.content)
+            if node.content and not node.content.endswith("\n") and self.stream.isatty():
+                self.stream.write("\n")
+
+    def status(self, **fields):
+        if self.as_json:
+            self.stream.write(json.dumps(fields, ensure_ascii=False) + "\n")
+
+
+def resolve(manager, ref, folder=False):
+    """Найти узел по пути или идентификатору, иначе CliError"""
+    node = manager.resolve(ref or "")
+    if node is None:
+        raise CliError(f"Не найдено: {ref}")
+    if folder and not node.is_folder:
+        raise CliError(f"Не папка: {ref}")
+    return node
+
+
+def load_library(args, writable=False):
+    """Открыть библиотеку; нет файла или он не читается — CliError.
+
+    Файл пишут только команды, меняющие библиотеку (writable=True); им
+    отсутствующий файл не мешает — создаётся новая библиотека.
+    """
+    if writable and not os.path.exists(args.data_file):
+        return TemplateManager(args.data_file)
+    try:
+        manager = TemplateManager(args.data_file, read_only=True)
+    except Exception as e:
+        raise CliError(f"Не удалось прочитать {args.data_file}: {e}")
+    manager.read_only = not writable
+    return manager
+
+
+def cmd_search(args, out):
+    manager = load_library(args)
+    if args.names_only:
+        results = manager.search_templates(args.query)
+    else:
+        results = TemplateSearchIndex(manager).search(args.query)
+    if args.limit:
+        results = results[:args.limit]
+    for node in results:
+        out.node(node, with_content=args.content)
+    return 0 if results else 1
+
+
+def cmd_get(args, out):
+    manager = load_library(args)
+    node = resolve(manager, args.ref)
+    if node.is_folder:
+        raise CliError(f"Это папка: {args.ref}")
+    out.content(node)
+    return 0
+
+
+def forward(args, command, timeout=5.0, **fields):
+    """Передать команду запущенному приложению; None, если оно не запущено"""
+    if args.no_daemon:
+        return None
+    response = InstanceClient(args.data_file, timeout=timeout).request(command, **fields)
+    if response is not None and not response.get("ok"):
+        raise CliError(response.get("error") or "ошибка TextPaster")
+    return response
+
+
+def cmd_show(args, out):
+    fields = {"query": args.search} if args.search is not None else {}
+    response = forward(args, "search" if args.search is not None else "show", **fields)
+    if response is None:
+        raise CliError("TextPaster не запущен")
+    return 0
+
+
+def cmd_copy(args, out):
+    from textpaster_core import ClipboardService, FrecencyStore, PyperclipClipboardBackend
+
+    response = forward(args, "copy", ref=args.ref)
+    if response is not None:
+        out.status(copied=response["id"], path=response["path"])
+        return 0
+
+    manager = load_library(args)
+    node = resolve(manager, args.ref)
+    if node.is_folder:
+        raise CliError(f"Это папка: {args.ref}")
+    clipboard = ClipboardService([PyperclipClipboardBackend()])
+    if clipboard.copy(node.content) is None:
+        raise CliError("Не удалось скопировать в буфер обмена")
+    FrecencyStore.for_library(args.data_file).record(node.id)
+    out.status(copied=node.id, path=node.get_path())
+    return 0
+
+
+def cmd_list(args, out):
+    manager = load_library(args)
+    folder = resolve(manager, args.ref, folder=True)
+    nodes = manager.iter_nodes(folder) if args.recursive else folder.children.values()
+    for node in nodes:
+        if args.templates_only and node.is_folder:
+            continue
+        out.node(node, with_content=args.content)
+    return 0
+
+
+def cmd_export(args, out):
+    manager = load_library(args)
+    node = resolve(manager, args.ref)
+    fmt = args.format or (detect_transfer_format(args.output) if args.output else "json")
+    if fmt == "dir" and not args.output:
+        raise CliError("Для выгрузки в папку укажите -o ПАПКА")
+    if args.output:
+        if fmt == "dir" and os.path.isfile(args.output):
+            raise CliError(f"Не папка: {args.output}")
+        try:
+            count = manager.export_file(node, args.output, fmt)
+        except OSError as e:
+            raise CliError(f"Не удалось записать {args.output}: {e}")
+        out.status(exported=node.get_path(), output=args.output, count=count)
+    elif fmt == "json":
+        out.stream.write(json.dumps(manager.export_tree(node), ensure_ascii=False, indent=2) + "\n")
+    else:
+        write_records(node, out.stream, fmt)
+    return 0
+
+
+def cmd_import(args, out):
+    fmt = args.format or ("json" if args.file == "-" else detect_transfer_format(args.file))
+    if fmt == "dir" and args.file == "-":
+        raise CliError("Папку нельзя передать через stdin")
+    # Папки, CSV и NDJSON описывают пути: совпадающие папки дополняются, а не конфликтуют
+    merge = fmt != "json"
+    # Запущенное приложение само читает файл по пути (stdin передаётся
+    # текстом как есть): дерево импорта не пересобирается для канала
+    if args.file == "-":
+        source = {"text": sys.stdin.read()}
+    else:
+        source = {"path": os.path.abspath(args.file)}
+    response = forward(args, "import", timeout=IMPORT_TIMEOUT, format=fmt, into=args.into,
+                       on_conflict=args.on_conflict, merge=merge, **source)
+    if response is not None:
+        added, skipped = response["added"], response["skipped"]
+    else:
+        manager = load_library(args, writable=True)
+        target = resolve(manager, args.into, folder=True)
+        try:
+            tree = manager.read_import(source.get("path") or io.StringIO(source["text"]), fmt)
+        except (OSError, ValueError) as e:
+            raise CliError(f"Не удалось прочитать {args.file}: {e}")
+        added, skipped = manager.import_nodes(tree, target, args.on_conflict, merge_folders=merge)
+    out.status(added=added, skipped=skipped, into=args.into)
+    if not out.as_json:
+        print(f"Добавлено: {added}, пропущено: {skipped}", file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="textpaster",
+        description="TextPaster: консольный доступ к шаблонам",
+    )
+    parser.add_argument("--data-file", default="templates.json",
+                        help="файл шаблонов (по умолчанию templates.json)")
+    parser.add_argument("--json", action="store_true",
+                        help="вывод в формате JSON lines (один объект на строку)")
+    parser.add_argument("--no-daemon", action="store_true",
+                        help="не передавать команды запущенному приложению")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    search = commands.add_parser("search", help="поиск по названию и содержимому")
+    search.add_argument("query")
+    search.add_argument("--limit", type=int, default=0, help="не больше N результатов")
+    search.add_argument("--names-only", action="store_true",
+                        help="искать только по названию (включая папки)")
+    search.add_argument("--content", action="store_true", help="добавить содержимое в JSON")
+    search.set_defaults(handler=cmd_search)
+
+    get = commands.add_parser("get", help="вывести содержимое шаблона")
+    get.add_argument("ref", help="путь 'Папка/Шаблон' или идентификатор")
+    get.set_defaults(handler=cmd_get)
+
+    copy = commands.add_parser("copy", help="скопировать шаблон в буфер обмена")
+    copy.add_argument("ref", help="путь 'Папка/Шаблон' или идентификатор")
+    copy.set_defaults(handler=cmd_copy)
+
+    show = commands.add_parser("show", help="показать окно запущенного приложения")
+    show.add_argument("--search", metavar="QUERY", nargs="?", const="",
+                      help="открыть окно поиска (с запросом)")
+    show.set_defaults(handler=cmd_show)
+
+    list_ = commands.add_parser("list", help="содержимое папки")
+    list_.add_argument("ref", nargs="?", default="", help="папка (по умолчанию корень)")
+    list_.add_argument("-r", "--recursive", action="store_true")
+    list_.add_argument("--templates-only", action="store_true")
+    list_.add_argument("--content", action="store_true", help="добавить содержимое в JSON")
+    list_.set_defaults(handler=cmd_list)
+
+    export = commands.add_parser("export", help="выгрузить папку или шаблон")
+    export.add_argument("ref", nargs="?", default="", help="что выгрузить (по умолчанию всё)")
+    export.add_argument("-o", "--output", help="файл или папка (по умолчанию stdout)")
+    export.add_argument("--format", choices=FORMATS,
+                        help="json, ndjson, csv или dir (по умолчанию по -o, иначе json)")
+    export.set_defaults(handler=cmd_export)
+
+    import_ = commands.add_parser("import", help="загрузить шаблоны из файла или папки")
+    import_.add_argument("file", help="файл (templates.json, .ndjson, .csv), папка или '-' для stdin")
+    import_.add_argument("--format", choices=FORMATS,
+                         help="формат (по умолчанию по расширению или папка)")
+    import_.add_argument("--into", default="", help="папка назначения (по умолчанию корень)")
+    import_.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default="skip",
+                         help="что делать с совпадающими именами")
+    import_.set_defaults(handler=cmd_import)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    # Вывод в канал всегда в UTF-8, независимо от кодовой страницы консоли
+    if not sys.stdout.isatty() and hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(encoding="utf-8")
+
+    out = Output(sys.stdout, as_json=args.json)
+    try:
+        return args.handler(args, out)
+    except CliError as e:
+        print(f"textpaster: {e}", file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        # Например, `textpaster list -r | head`
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3430 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TextPaster - модель данных и сервисы без GUI.
+
+Модуль не импортирует tkinter, pynput и pystray, поэтому его можно
+использовать из бенчмарков, скриптов и консольных утилит без дисплея.
+"""
+
+import bisect
+import copy
+import csv
+import ctypes
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+from types import MappingProxyType
+
+class ConfigManager:
+    """Менеджер конфигурации приложения (горячие клавиши и т.д.).
+
+    Изменения — через set_hotkey/set_feature/set_setting; несколько вызовов
+    внутри ``with config.batch():`` записываются в файл одной атомарной
+    записью и приходят слушателям одним уведомлением. Недостающие ключи
+    берутся из DEFAULTS, недопустимые значения (SCHEMA) — заменяются ими.
+    """
+    DEFAULTS = {
+        "hotkeys": {
+            "search_templates": "<ctrl>+1",
+            "cascading_menu": "<ctrl>+2",
+            "recent_templates": "<ctrl>+3"
+        },
+        "features": {
+            "auto_paste": False,
+            "frequent_first": False,
+            "sharded_storage": False
+        },
+        "settings": {
+            "paste_method": "wm_paste",
+            "preview_delay_ms": 1000,
+            "clipboard_backend": "auto",
+            "type_out_cps": 0,
+            "undo_memory_mb": 16
+        }
+    }
+    PASTE_METHODS = ("wm_paste", "ctrl_v", "type_out")
+    CLIPBOARD_BACKENDS = ("auto", "tk", "helper", "pyperclip")
+    # Проверки значений: раздел -> ключ ("*" — любой ключ раздела) -> условие
+    SCHEMA = {
+        "hotkeys": {"*": lambda value: isinstance(value, str) and bool(value.strip())},
+        "features": {"*": lambda value: isinstance(value, bool)},
+        "settings": {
+            "paste_method": lambda value: value in ConfigManager.PASTE_METHODS,
+            "preview_delay_ms": lambda value: ConfigManager._is_count(value),
+            "clipboard_backend": lambda value: value in ConfigManager.CLIPBOARD_BACKENDS,
+            "type_out_cps": lambda value: ConfigManager._is_count(value),
+            "undo_memory_mb": lambda value: ConfigManager._is_count(value),
+        },
+    }
+
+    def __init__(self, config_file="config.json"):
+        self.config_file = config_file
+        self.config = copy.deepcopy(self.DEFAULTS)
+        self.signature = None  # Сигнатура файла после последней записи или чтения
+        self._listeners = []  # callback(множество (раздел, ключ)) после изменений
+        self._batch_depth = 0
+        self._batch_backup = None
+        self._changed = set()
+        self.load_config()
+
+    @staticmethod
+    def _is_count(value):
+        return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+    def load_config(self):
+        """Загрузить конфигурацию из файла"""
+        if os.path.exists(self.config_file):
+            try:
+                self._apply_loaded(self._read())
+            except Exception as e:
+                print(f"Ошибка загрузки конфигурации: {e}")
+                self.save_config()
+        else:
+            self.save_config()
+
+    def reload(self):
+        """Перечитать файл, если его изменили снаружи; вернуть изменённые ключи.
+
+        В отличие от load_config, испорченный файл не перезаписывается:
+        его, скорее всего, ещё правят, и следующее изменение прочитается снова.
+        """
+        if self._batch_depth or file_signature(self.config_file) == self.signature:
+            return set()
+        try:
+            loaded = self._read()
+        except (OSError, ValueError) as e:
+            print(f"Ошибка загрузки конфигурации: {e}")
+            return set()
+        return self._apply_loaded(loaded)
+
+    def _read(self):
+        signature = file_signature(self.config_file)
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            loaded = json.load(f)
+        if not isinstance(loaded, dict):
+            raise ValueError("ожидался объект JSON")
+        self.signature = signature
+        return loaded
+
+    def _apply_loaded(self, loaded):
+        """Объединить прочитанное с умолчаниями, проверить и уведомить слушателей"""
+        config = self._with_defaults(self.DEFAULTS, loaded)
+        fixed = False
+        for section, rules in self.SCHEMA.items():
+            values = config[section]
+            for key, value in list(values.items()):
+                check = rules.get(key, rules.get("*"))
+                if check is not None and not check(value):
+                    print(f"Недопустимое значение {section}.{key} в конфигурации: {value!r}")
+                    fixed = True
+                    if key in self.DEFAULTS[section]:
+                        values[key] = copy.deepcopy(self.DEFAULTS[section][key])
+                    else:
+                        del values[key]
+        changed = self._diff(self.config, config)
+        self.config = config
+        if fixed or loaded != config:
+            # Дописать недостающие ключи, чтобы файл было видно целиком
+            self.save_config()
+        self._notify(changed)
+        return changed
+
+    @classmethod
+    def _with_defaults(cls, defaults, loaded):
+        """Глубокое объединение: значения из loaded, недостающее — из defaults"""
+        merged = copy.deepcopy(loaded)
+        for key, default in defaults.items():
+            value = merged.get(key)
+            if isinstance(default, dict):
+                merged[key] = cls._with_defaults(default, value if isinstance(value, dict) else {})
+            elif key not in merged:
+                merged[key] = copy.deepcopy(default)
+        return merged
+
+    @staticmethod
+    def _diff(old, new):
+        """Множество (раздел, ключ), значения которых различаются"""
+        changed = set()
+        for section in old.keys() | new.keys():
+            before, after = old.get(section), new.get(section)
+            if isinstance(before, dict) and isinstance(after, dict):
+                changed.update((section, key) for key in before.keys() | after.keys()
+                               if before.get(key) != after.get(key))
+            elif before != after:
+                changed.add((section, None))
+        return changed
+
+    def save_config(self):
+        """Сохранить конфигурацию в файл"""
+        try:
+            # Через временный файл: прерванная запись не портит настройки
+            temp_path = f"{self.config_file}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.config, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.config_file)
+            self.signature = file_signature(self.config_file)
+        except Exception as e:
+            print(f"Ошибка сохранения конфигурации: {e}")
+
+    def add_listener(self, callback):
+        """Подписаться на изменения: callback(множество пар (раздел, ключ))"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, changed):
+        if not changed:
+            return
+        for callback in list(self._listeners):
+            try:
+                callback(changed)
+            except Exception as e:
+                print(f"Ошибка обработчика изменений конфигурации: {e}")
+
+    @contextmanager
+    def batch(self):
+        """Транзакция: одна запись файла и одно уведомление на все изменения.
+
+        Исключение внутри откатывает всю транзакцию и пробрасывается дальше.
+        """
+        if self._batch_depth == 0:
+            self._batch_backup = copy.deepcopy(self.config)
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._batch_depth == 1:
+                self.config = self._batch_backup
+                self._changed = set()
+            raise
+        finally:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            changed, self._changed = self._changed, set()
+            self._batch_backup = None
+            if changed:
+                self.save_config()
+                self._notify(changed)
+
+    def _set(self, section, key, value):
+        """Проверить и установить значение (ValueError, если оно недопустимо)"""
+        rules = self.SCHEMA.get(section, {})
+        check = rules.get(key, rules.get("*"))
+        if check is not None and not check(value):
+            raise ValueError(f"Недопустимое значение {section}.{key}: {value!r}")
+        values = self.config.setdefault(section, {})
+        if key in values and values[key] == value and type(values[key]) is type(value):
+            return
+        with self.batch():
+            values[key] = value
+            self._changed.add((section, key))
+
+    def get_hotkey(self, hotkey_name):
+        """Получить горячую клавишу по названию"""
+        return self.config.get("hotkeys", {}).get(hotkey_name, "")
+    
+    def set_hotkey(self, hotkey_name, hotkey_value):
+        """Установить горячую клавишу"""
+        self._set("hotkeys", hotkey_name, hotkey_value)
+
+    def get_feature(self, feature_name, default=False):
+        """Получить значение фичи из конфигурации"""
+        return self.config.get("features", {}).get(feature_name, default)
+
+    def set_feature(self, feature_name, feature_value):
+        """Установить значение фичи в конфигурации"""
+        self._set("features", feature_name, bool(feature_value))
+
+    def get_setting(self, setting_name, default=None):
+        return self.config.get("settings", {}).get(setting_name, default)
+
+    def set_setting(self, setting_name, setting_value):
+        self._set("settings", setting_name, setting_value)
+
+def new_node_id():
+    """Новый постоянный идентификатор узла"""
+    return uuid.uuid4().hex
+
+NODE_ID_PATTERN = re.compile(r"[0-9a-f]{32}")  # Формат new_node_id() и legacy_node_id()
+
+def is_node_id(value):
+    """Проверить, что значение из файла или импорта — допустимый id узла"""
+    return isinstance(value, str) and NODE_ID_PATTERN.fullmatch(value) is not None
+
+def legacy_node_id(path):
+    """Идентификатор для узла из файла без поля 'id'.
+
+    Выводится из пути, поэтому одинаков при каждой загрузке старого файла
+    и сохраняется в файл при первой же записи.
+    """
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:32]
+
+def node_to_dict(node):
+    """Преобразовать узел (дерева или снимка) в словарь формата templates.json"""
+    data = {
+        'id': node.id,
+        'name': node.name,
+        'content': node.content,
+        'is_folder': node.is_folder,
+        'children': {}
+    }
+    # Сохранить порядок детей используя OrderedDict
+    for child_name, child_node in node.children.items():
+        data['children'][child_name] = node_to_dict(child_node)
+    return data
+
+SHARD_LAYOUT = "sharded"  # Значение "layout" в файле шаблонов, разложенном по папкам
+
+def shard_directory(data_file):
+    """Папка с файлами верхних папок библиотеки (раскладка SHARD_LAYOUT)"""
+    return data_file + ".d"
+
+SHARD_FILE_PATTERN = re.compile(r"[0-9a-f]{32}\.json")
+
+def shard_file_name(node_id):
+    """Имя файла папки верхнего уровня.
+
+    Берётся хэш id, а не сам id: имя файла не зависит от содержимого
+    templates.json, и чужой id вроде "../x" не выведет запись из папки.
+    """
+    return hashlib.sha256(node_id.encode("utf-8")).hexdigest()[:32] + ".json"
+
+def library_signature(data_file):
+    """Сигнатура файла шаблонов вместе с файлами его папок или None, если его нет.
+
+    В раскладке SHARD_LAYOUT правка папки меняет только её файл, поэтому
+    одной сигнатуры оглавления недостаточно.
+    """
+    signature = file_signature(data_file)
+    if signature is None:
+        return None
+    shards = shard_directory(data_file)
+    try:
+        names = sorted(name for name in os.listdir(shards) if SHARD_FILE_PATTERN.fullmatch(name))
+    except OSError:
+        names = []
+    return (signature, tuple((name, file_signature(os.path.join(shards, name))) for name in names))
+
+def write_json_atomic(data, path):
+    """Записать JSON через временный файл: прерванная запись не портит path"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+def file_signature(path):
+    """(mtime_ns, размер, inode) файла или None, если его нет"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def collation_key(name):
+    """Ключ сортировки названий для меню и списков.
+
+    Без учёта регистра (casefold), «ё» стоит вместе с «е», как в словарях
+    (по кодам символов она оказалась бы после «я»). При равных ключах
+    порядок задаёт само название, чтобы сортировка была однозначной.
+    """
+    return (name.casefold().replace("ё", "е"), name)
+
+class TemplateNode:
+    """Узел для хранения шаблона или папки"""
+    def __init__(self, name, content="", is_folder=False, node_id=None):
+        self.id = node_id or new_node_id()
+        self.name = name
+        self.content = content
+        self.is_folder = is_folder
+        self._children = OrderedDict()  # Использовать OrderedDict для сохранения порядка
+        self._children_loader = None  # loader(self) для детей, отложенных до первого обращения
+        self.parent = None
+        # Путь и глубина вычисляются один раз и сбрасываются (invalidate_path)
+        # только при смене родителя или имени узла либо его предка
+        self._path = None
+        self._depth = None
+        self._sort_key = None  # (название, collation_key(название))
+        self._sorted = None    # (папки, шаблоны, их ключи) для sorted_children(); сбрасывается при смене состава
+
+    @property
+    def children(self):
+        """Дети по порядку; отложенные (load_children_lazily) читаются здесь"""
+        if self._children_loader is not None:
+            self.load_children()
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+        self._children_loader = None
+
+    @property
+    def children_loaded(self):
+        """Дети уже в памяти: обращение к children ничего не читает"""
+        return self._children_loader is None
+
+    def load_children_lazily(self, loader):
+        """Отложить заполнение children до первого обращения: loader(self)"""
+        self._children = OrderedDict()
+        self._children_loader = loader
+
+    def load_children(self):
+        """Заполнить отложенных детей сейчас (если они ещё не прочитаны)"""
+        loader, self._children_loader = self._children_loader, None
+        if loader is not None:
+            loader(self)
+    
+    def add_child(self, child):
+        """Добавить дочерний элемент"""
+        child.parent = self
+        child.invalidate_path()
+        self.children[child.name] = child
+        self._sorted = None
+    
+    def remove_child(self, name):
+        """Удалить дочерний элемент"""
+        if name in self.children:
+            child = self.children.pop(name)
+            child.parent = None
+            child.invalidate_path()
+            self._sorted = None
+
+    @property
+    def sort_key(self):
+        """collation_key(name), вычисленный один раз для текущего названия"""
+        cached = self._sort_key
+        if cached is None or cached[0] is not self.name:
+            cached = self._sort_key = (self.name, collation_key(self.name))
+        return cached[1]
+
+    def sorted_children(self):
+        """Дети по алфавиту для меню: кортеж (папки, шаблоны).
+
+        Результат кэшируется и сбрасывается только при добавлении, удалении
+        или переименовании детей этой папки (перестановка его не меняет).
+        """
+        return self._sorted_view()[:2]
+
+    def _sorted_view(self):
+        view = self._sorted
+        if view is None:
+            ordered = sorted(self.children.values(), key=lambda child: child.sort_key)
+            folders = tuple(child for child in ordered if child.is_folder)
+            templates = tuple(child for child in ordered if not child.is_folder)
+            view = self._sorted = (
+                folders,
+                templates,
+                [child.sort_key[0] for child in folders],
+                [child.sort_key[0] for child in templates],
+            )
+        return view
+
+    def children_with_prefix(self, prefix):
+        """Дети, чьё название начинается с prefix: (папки, шаблоны) по алфавиту.
+
+        Сравнение как в collation_key (регистр и «ё» не важны); поиск —
+        двоичный по ключам отсортированного вида папки.
+        """
+        key = collation_key(prefix)[0]
+        folders, templates, folder_keys, template_keys = self._sorted_view()
+
+        def matching(nodes, keys):
+            start = bisect.bisect_left(keys, key)
+            return nodes[start:bisect.bisect_left(keys, key + "\U0010ffff", start)]
+
+        return matching(folders, folder_keys), matching(templates, template_keys)
+    
+    def move_child_up(self, name):
+        """Переместить дочерний элемент вверх в списке"""
+        if name not in self.children:
+            return False
+        
+        keys = list(self.children.keys())
+        index = keys.index(name)
+        
+        if index > 0:
+            # Переместить элемент вверх
+            old_index = index
+            new_index = index - 1
+            
+            # Создать новый упорядоченный словарь с измененным порядком
+            new_children = OrderedDict()
+            for i, key in enumerate(keys):
+                if i == new_index:
+                    new_children[keys[old_index]] = self.children[keys[old_index]]
+                if i != old_index:
+                    new_children[key] = self.children[key]
+            
+            self.children = new_children
+            return True
+        return False
+    
+    def move_child_down(self, name):
+        """Переместить дочерний элемент вниз в списке"""
+        if name not in self.children:
+            return False
+        
+        keys = list(self.children.keys())
+        index = keys.index(name)
+        
+        if index < len(keys) - 1:
+            # Переместить элемент вниз
+            old_index = index
+            new_index = index + 1
+            
+            # Создать новый упорядоченный словарь с измененным порядком
+            new_children = OrderedDict()
+            for i, key in enumerate(keys):
+                if i == old_index:
+                    new_children[keys[new_index]] = self.children[keys[new_index]]
+                elif i == new_index:
+                    new_children[keys[old_index]] = self.children[keys[old_index]]
+                else:
+                    new_children[key] = self.children[key]
+            
+            self.children = new_children
+            return True
+        return False
+    
+    def get_path(self):
+        """Получить полный путь до узла"""
+        path = self._path
+        if path is None:
+            parent = self.parent
+            if parent is None:
+                path = ""
+            else:
+                parent_path = parent.get_path()
+                path = f"{parent_path}/{self.name}" if parent_path else self.name
+            self._path = path
+        return path
+
+    def get_depth(self):
+        """Глубина узла: 0 у корня, 1 у его детей"""
+        depth = self._depth
+        if depth is None:
+            depth = self._depth = 0 if self.parent is None else self.parent.get_depth() + 1
+        return depth
+
+    def invalidate_path(self):
+        """Сбросить закэшированные путь и глубину у узла и всего его поддерева.
+
+        Путь кэшируется только вместе с путями предков, поэтому узел без
+        кэша означает поддерево без кэша: обход останавливается на нём.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._path is None and node._depth is None:
+                continue
+            node._path = node._depth = None
+            # Непрочитанные дети ещё не вычисляли пути: обходить их незачем
+            stack.extend(node._children.values())
+
+class FrozenTemplateNode:
+    """Неизменяемая копия узла для чтения из фоновых потоков.
+
+    Повторяет поля TemplateNode (id, name, content, is_folder, children),
+    поэтому код, который только читает дерево (сохранение, индекс поиска),
+    работает с ней без изменений. Родителя нет: одно и то же неизменённое
+    поддерево входит в снимки разных версий. children_loaded=False бывает
+    только в снимках для записи файла: папку ещё не читали, и детей у копии нет.
+    """
+    __slots__ = ("id", "name", "content", "is_folder", "children", "children_loaded")
+
+    def __init__(self, node, children):
+        for field, value in (("id", node.id), ("name", node.name), ("content", node.content),
+                             ("is_folder", node.is_folder), ("children", MappingProxyType(children)),
+                             ("children_loaded", node.children_loaded)):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenTemplateNode нельзя изменить")
+
+    def __repr__(self):
+        return f"FrozenTemplateNode({self.name!r})"
+
+class TemplateSnapshot:
+    """Согласованный снимок дерева версии version (см. TemplateManager.snapshot)"""
+    def __init__(self, root, version):
+        self.root = root
+        self.version = version
+
+    def iter_nodes(self, node=None):
+        """Все узлы поддерева (без самого node) в порядке дерева"""
+        stack = [iter((node or self.root).children.values())]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            yield child
+            if child.is_folder:
+                stack.append(iter(child.children.values()))
+
+    def get_node_by_path(self, path):
+        current = self.root
+        for part in (p for p in path.split('/') if p):
+            current = current.children.get(part)
+            if current is None:
+                return None
+        return current
+
+class TemplateChange:
+    """Одно изменение дерева в транзакции TemplateManager.
+
+    version — версия дерева после транзакции (одна на все её изменения):
+    подписчик, у которого версия на единицу меньше, может применить
+    изменения к своим данным, иначе ему нужно перестроить их целиком.
+    Для REORDERED node — папка, в которой поменялся порядок детей,
+    для RELOADED — новый корень (дерево загружено заново). У CONTENT
+    old_content — текст шаблона до изменения.
+    """
+    ADDED = "added"
+    REMOVED = "removed"
+    RENAMED = "renamed"
+    CONTENT = "content"
+    MOVED = "moved"
+    REORDERED = "reordered"
+    RELOADED = "reloaded"
+
+    # Изменения, после которых меняется состав или порядок узлов
+    STRUCTURAL = frozenset((ADDED, REMOVED, MOVED, REORDERED, RELOADED))
+
+    def __init__(self, kind, node, old_parent=None, old_name=None, old_content=None):
+        self.kind = kind
+        self.node = node
+        self.old_parent = old_parent
+        self.old_name = old_name
+        self.old_content = old_content
+        self.version = None
+
+    def __repr__(self):
+        return f"TemplateChange({self.kind!r}, {self.node.name!r})"
+
+class TemplateManager:
+    """Менеджер шаблонов.
+
+    Изменения дерева — через add/remove/rename/set_content/move/move_up/
+    move_down. Каждый вызов сам по себе транзакция; несколько вызовов
+    внутри ``with manager.batch():`` сохраняются одной записью файла и
+    одним уведомлением слушателей, а при исключении откатываются.
+
+    Фоновым потокам дерево отдаётся только через snapshot(): живые узлы
+    меняются в потоке Tk без блокировок. С background_save=True файл
+    записывается из снимка в отдельном потоке (см. flush/close).
+
+    Завершённые транзакции можно отменять и повторять (undo/redo): каждая
+    хранит свои обратные и прямые шаги, поэтому отмена стоит столько же,
+    сколько сама правка. Память под историю ограничена undo_memory_limit.
+
+    С sharded=True каждая папка верхнего уровня лежит в своём файле
+    {data_file}.d/<хэш id>.json, а data_file становится оглавлением (корень,
+    шаблоны верхнего уровня и ссылки на файлы папок). Запись переписывает
+    оглавление и только изменённые папки; при загрузке папка читается при
+    первом обращении к её детям. sharded=None — как в уже записанном файле.
+
+    С read_only=True файл только читается: если его нет или он не
+    разбирается, конструктор бросает исключение вместо создания примеров,
+    а любая запись — RuntimeError.
+    """
+    UNDO_MEMORY_LIMIT = 16 * 1024 * 1024  # Примерный объём истории отмены, байт
+    UNDO_NODE_OVERHEAD = 256  # Узел, изменение и замыкания одного шага, байт
+
+    def __init__(self, data_file="templates.json", background_save=False,
+                 undo_memory_limit=UNDO_MEMORY_LIMIT, sharded=None, read_only=False):
+        self.data_file = data_file
+        self.read_only = read_only
+        self.background_save = background_save
+        self.sharded = sharded
+        self.root = TemplateNode("Root", "", True)
+        # Версия дерева: увеличивается при каждой транзакции, загрузке и
+        # явном save_templates(); по ней кэши понимают, что данные устарели
+        self.version = 0
+        self._id_index = {}
+        self._id_index_version = None
+        self._listeners = []  # callback(list[TemplateChange]) после каждой транзакции
+        self._batch_depth = 0
+        self._batch_log = []  # ([TemplateChange, ...], функция отката, функция повтора)
+        # История: (шаги транзакции из _batch_log, примерный размер в байтах)
+        self.undo_memory_limit = undo_memory_limit
+        self._undo_stack = deque()
+        self._redo_stack = []
+        self._undo_memory = 0
+        # Кэш неизменяемых копий: node.id -> FrozenTemplateNode. Транзакция
+        # выбрасывает только изменённые узлы и их предков, остальное
+        # переиспользуется следующим снимком
+        self._frozen = {}
+        self._frozen_version = None
+        self._writer = None
+        self._write_pending = None  # Снимок, ожидающий записи фоновым потоком
+        self._write_cond = threading.Condition()
+        self._writing = False
+        # Что лежит в файле (см. track_disk_state): плоское описание дерева
+        # после последней записи или слияния и сигнатура файла; None — не следим.
+        # Меняется и читается под _write_cond: пишет его поток записи
+        self._disk_state = None
+        self._suppress_save = False
+        self._merging_external = False  # Транзакция apply_external: в историю отмены не попадает
+        # Раскладка по папкам: id папок верхнего уровня, изменённых с последней
+        # записи (None — переписать все). _changed_shards копит поток, меняющий
+        # дерево; _unwritten — то, что передано потоку записи (под _write_cond)
+        self._changed_shards = set()
+        self._unwritten = set()
+        self._shard_files = {}  # id папки -> имя её файла, который сейчас есть на диске
+        # Папки, чей файл не прочитался: id -> имя файла из оглавления. Их
+        # файлы не перезаписываются и не удаляются, иначе пустая папка в
+        # памяти затёрла бы содержимое на диске
+        self._broken_shards = {}
+        # Папки, прочитанные уже после того, как запомнено состояние файла:
+        # id -> их содержимое в плоском виде (см. _load_lazily, apply_external)
+        self._loaded_shards = {}
+        self.load_templates()
+    
+    def save_templates(self):
+        """Сохранить шаблоны в файл.
+
+        Нужен только после прямой правки узлов (в обход add/remove/...):
+        версия увеличивается, и кэши перестраиваются при следующем обращении.
+        История отмены сбрасывается: её шаги рассчитаны на прежнее дерево.
+        """
+        self._check_writable()
+        self.version += 1
+        self.clear_history()
+        if self._disk_state is not None:
+            self._write_snapshot(self._snapshot(), check=False)
+        else:
+            self._write()
+
+    def set_sharded(self, sharded):
+        """Сменить раскладку файла (True — по папкам) и сразу переписать его"""
+        sharded = bool(sharded)
+        if sharded == self.sharded:
+            return
+        if not sharded:
+            # Единый файл пишется целиком: нужны все папки
+            for folder in self._unloaded_folders():
+                folder.load_children()
+        self.sharded = sharded
+        self._changed_shards = None
+        self._save_committed()
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"{self.data_file} открыт только для чтения")
+
+    def _save_committed(self):
+        """Записать дерево после транзакции: сразу или в фоновом потоке"""
+        self._check_writable()
+        if self.background_save:
+            self._save_in_background(self._snapshot())
+            return
+        dirty, self._changed_shards = self._changed_shards, set()
+        written = False
+        try:
+            if self._disk_state is not None:
+                written = self._write_snapshot(self._snapshot(), dirty=dirty)
+            else:
+                self._write(dirty=dirty)
+                written = True
+        finally:
+            if not written:
+                self._changed_shards = self._merge_dirty(self._changed_shards, dirty)
+
+    @staticmethod
+    def _merge_dirty(first, second):
+        return None if first is None or second is None else first | second
+
+    def _mark_changed_shards(self, changes):
+        """Запомнить папки верхнего уровня, которые задела транзакция"""
+        if self._changed_shards is None:
+            return
+        root = self.root
+        tops = {}  # id(папка) -> id её папки верхнего уровня или None
+
+        def top_of(folder):
+            key = id(folder)
+            if key not in tops:
+                node = folder
+                while node.parent is not None and node.parent is not root:
+                    node = node.parent
+                tops[key] = node.id if node.parent is root else None
+            return tops[key]
+
+        changed = self._changed_shards
+        for change in changes:
+            node = change.node
+            if node.parent is root:
+                if node.is_folder:
+                    changed.add(node.id)
+            elif node.parent is not None:
+                changed.add(top_of(node.parent))
+            if change.old_parent is not None and change.old_parent is not root:
+                changed.add(top_of(change.old_parent))
+        changed.discard(None)
+
+    def _write_snapshot(self, snapshot, check=True, dirty=None):
+        """Записать снимок и запомнить его как состояние файла; True, если записан.
+
+        Если файл успели изменить снаружи, запись откладывается: её сделает
+        apply_external() после слияния, иначе чужие правки пропали бы.
+        Если же изменённый файл не разбирается, слияния не будет: он
+        копируется в {data_file}.conflict-ДАТА, а дерево записывается поверх.
+        """
+        with self._write_cond:
+            state = self._disk_state
+            changed = check and state is not None and library_signature(self.data_file) != state[1]
+        if changed:
+            try:
+                self.read_external()
+            except (OSError, ValueError) as e:
+                conflict_copy = self._save_conflict_copy()
+                if conflict_copy is None:
+                    return False
+                print(f"Файл шаблонов изменён другой программой и не читается ({e}): "
+                      f"он сохранён в {conflict_copy} и заменён текущими шаблонами")
+                dirty = None  # Файлы папок тоже могли быть испорчены
+            else:
+                print("Файл шаблонов изменён другой программой: запись отложена до слияния")
+                return False
+        # Снимок неизменяем: его описание готово до записи, и состояние файла
+        # запоминается сразу после замены (см. _write)
+        self._write(snapshot.root, dirty, self._flatten(snapshot.root) if state is not None else None)
+        return True
+
+    @property
+    def disk_signature(self):
+        """Сигнатура файла после последней записи или слияния (None — не следим)"""
+        with self._write_cond:
+            return self._disk_state[1] if self._disk_state is not None else None
+
+    def is_own_write(self, signature):
+        """Сигнатура совпадает с последней записью или слиянием этого менеджера"""
+        with self._write_cond:
+            return self._disk_state is not None and signature == self._disk_state[1]
+
+    def track_disk_state(self):
+        """Запоминать, что записано в файл, чтобы сливать внешние правки.
+
+        Нужно приложению, которое следит за файлом (FileWatcher) и вызывает
+        read_external/apply_external; консольной утилите не нужно.
+        """
+        records = self._flatten(self._snapshot().root)
+        with self._write_cond:
+            self._disk_state = (records, library_signature(self.data_file))
+
+    @staticmethod
+    def _flatten(root, root_id=""):
+        """Плоское описание дерева (живого, снимка или прочитанного из файла).
+
+        Возвращает (records, order, unread): records[id] = (id родителя,
+        название, текст, папка ли), order[id папки] = [id детей по порядку],
+        unread — id папок, чьи файлы не читались: их детей в описании нет.
+        Корень обозначается root_id, по умолчанию пустой строкой: его id
+        в разных файлах может не совпадать.
+        """
+        records = {}
+        order = {root_id: [child.id for child in root.children.values()]}
+        unread = set()
+        stack = [(root_id, child) for child in reversed(root.children.values())]
+        while stack:
+            parent_id, node = stack.pop()
+            records[node.id] = (parent_id, node.name, node.content, node.is_folder)
+            if not node.is_folder:
+                continue
+            if not node.children_loaded:
+                unread.add(node.id)
+                continue
+            order[node.id] = [child.id for child in node.children.values()]
+            stack.extend((node.id, child) for child in reversed(node.children.values()))
+        return records, order, unread
+
+    @staticmethod
+    def _subtree(records, order, folder_id):
+        """Потомки папки из плоского описания: их (records, order)"""
+        sub_records, sub_order = {}, {}
+        stack = [folder_id]
+        while stack:
+            parent_id = stack.pop()
+            child_ids = order.get(parent_id)
+            if child_ids is None:
+                continue
+            sub_order[parent_id] = child_ids
+            for node_id in child_ids:
+                if node_id in records:
+                    sub_records[node_id] = records[node_id]
+                    stack.append(node_id)
+        return sub_records, sub_order
+
+    @classmethod
+    def _cut_subtree(cls, records, order, folder_id):
+        """Как _subtree, но потомки из описания убираются"""
+        sub_records, sub_order = cls._subtree(records, order, folder_id)
+        for node_id in sub_records:
+            del records[node_id]
+        for node_id in sub_order:
+            del order[node_id]
+        return sub_records, sub_order
+
+    def read_external(self, path=None):
+        """Прочитать файл шаблонов, изменённый снаружи, в плоском виде.
+
+        Не трогает дерево, поэтому безопасно вызывается из фонового потока;
+        результат передаётся в apply_external() в потоке, меняющем дерево.
+        Файлы папок, которые в запомненном состоянии не прочитаны и с тех
+        пор не менялись, не читаются и здесь.
+        """
+        path = path or self.data_file
+        unread = set()
+        with self._write_cond:
+            state = self._disk_state
+        if state is not None and state[1] is not None and path == self.data_file:
+            shard_signatures = dict(state[1][1])
+            shards = shard_directory(path)
+            for folder_id in state[0][2]:
+                shard = self._shard_files.get(folder_id)
+                if (shard in shard_signatures
+                        and file_signature(os.path.join(shards, shard)) == shard_signatures[shard]):
+                    unread.add((folder_id, shard))
+        return self._flatten(self._read_tree(path, unread=unread))
+
+    def apply_external(self, external, signature=None):
+        """Слить внешние изменения файла с деревом одной транзакцией.
+
+        Трёхстороннее слияние: для каждого поля узла (папка, название, текст)
+        берётся внешнее значение, если локально оно не менялось с последней
+        записи, и локальное, если не менялось снаружи. Если поменялись оба —
+        это конфликт: остаётся локальная версия, а внешний файл копируется
+        в {data_file}.conflict-ДАТА. Порядок папки берётся из файла, только
+        если локально его не меняли. Слияние не отменяется; если оно что-то
+        изменило, история отмены и повтора очищается.
+
+        Возвращает (число применённых правок, список описаний конфликтов,
+        путь копии файла или None).
+        """
+        if self._disk_state is None:
+            raise RuntimeError("Слияние доступно после track_disk_state()")
+        if self._batch_log:
+            raise RuntimeError("Слияние нельзя выполнить внутри незавершённой транзакции")
+        with self._write_cond:
+            (base, base_order, base_unread), _ = self._disk_state
+        live, live_order, live_unread = self._flatten(self.root)
+        incoming, incoming_order, incoming_unread = external
+        # Описания дополняются ниже, а состояние файла хранит их как есть
+        base, base_order = dict(base), dict(base_order)
+        incoming, incoming_order, incoming_unread = dict(incoming), dict(incoming_order), set(incoming_unread)
+        # Папка, прочитанная здесь после записи, в описаниях файла без детей:
+        # в файле лежит то, что было прочитано
+        for folder_id in (base_unread | incoming_unread) - live_unread:
+            if folder_id in base_unread:
+                loaded = self._loaded_shards.get(folder_id)
+                if loaded is None:
+                    continue
+                base.update(loaded[0])
+                base_order.update(loaded[1])
+            if folder_id in incoming_unread:
+                incoming_unread.discard(folder_id)
+                sub_records, sub_order = self._subtree(base, base_order, folder_id)
+                incoming.update(sub_records)
+                incoming_order.update(sub_order)
+        external = (dict(incoming), dict(incoming_order), set(incoming_unread))
+        # Папки, не прочитанные здесь, в слиянии не участвуют: их содержимое —
+        # сам файл. Если файл изменился, папка после слияния заполняется
+        # прочитанным из него
+        unread_contents = {}
+        for folder_id in live_unread:
+            self._cut_subtree(base, base_order, folder_id)
+            contents = self._cut_subtree(incoming, incoming_order, folder_id)
+            if folder_id not in incoming_unread:
+                unread_contents[folder_id] = contents
+        nodes = {node.id: node for node in self._iter_loaded()}
+        nodes[""] = self.root
+        conflicts = []
+
+        def describe(node_id):
+            node = nodes.get(node_id)
+            if node is not None:
+                return node.get_path()
+            return (incoming.get(node_id) or base.get(node_id))[1]
+
+        # Что сделать с каждым узлом
+        added, removed, relocated, contents = [], [], {}, {}
+        for node_id, theirs in incoming.items():
+            mine = live.get(node_id)
+            old = base.get(node_id)
+            if mine is None:
+                if old is None:
+                    added.append(node_id)
+                elif theirs != old:
+                    conflicts.append(f"{describe(node_id)}: изменён в файле, но удалён здесь")
+                continue
+            if old is None:
+                old = mine  # Добавлен с обеих сторон: для слияния считаем локальную версию исходной
+            merged = []
+            for field, (base_value, my_value, their_value) in enumerate(zip(old, mine, theirs)):
+                if field == 3 or my_value == their_value or their_value == base_value:
+                    merged.append(my_value)
+                elif my_value == base_value:
+                    merged.append(their_value)
+                else:
+                    merged.append(my_value)
+                    conflicts.append(f"{describe(node_id)}: изменён и здесь, и в файле")
+            parent_id, name, content, _ = merged
+            if (parent_id, name) != mine[:2]:
+                relocated[node_id] = (parent_id, name)
+            if content != mine[2]:
+                contents[node_id] = content
+        for node_id, mine in live.items():
+            old = base.get(node_id)
+            if node_id in incoming or old is None:
+                continue
+            if mine == old:
+                removed.append(node_id)
+            else:
+                conflicts.append(f"{describe(node_id)}: удалён в файле, но изменён здесь")
+
+        # Папку нельзя удалить, если в ней остаётся что-то, что сохраняется
+        removed_set = set(removed)
+        kept = set()
+        for node_id in live:
+            if node_id in removed_set:
+                continue
+            parent_id = relocated.get(node_id, live[node_id])[0]
+            while parent_id in removed_set:
+                kept.add(parent_id)
+                parent_id = live[parent_id][0]
+        for node_id in kept:
+            conflicts.append(f"{describe(node_id)}: удалена в файле, но в ней есть локальные изменения")
+        removed = [node_id for node_id in removed if node_id not in kept and
+                   not any(ancestor in kept for ancestor in self._ancestor_ids(node_id, live))]
+        removed_set = set(removed)
+
+        conflict_copy = self._save_conflict_copy() if conflicts else None
+
+        applied = 0
+        self._suppress_save = True
+        self._merging_external = True
+        try:
+            with self.batch():
+                # Новые и перемещаемые узлы сначала получают временные уникальные
+                # имена: так обмен названиями и переносы не натыкаются друг на друга
+                for node_id in relocated:
+                    self.rename(nodes[node_id], f"\x00{node_id}")
+                for node_id in added:
+                    parent_id, _, content, is_folder = incoming[node_id]
+                    parent = nodes.get(parent_id)
+                    if parent is None or not parent.is_folder or parent_id in removed_set:
+                        conflicts.append(f"{incoming[node_id][1]}: папка для нового элемента удалена здесь")
+                        continue
+                    nodes[node_id] = self.add(parent, TemplateNode(f"\x00{node_id}", content, is_folder, node_id))
+                    relocated[node_id] = incoming[node_id][:2]
+                    applied += 1
+                for node_id, (parent_id, _) in relocated.items():
+                    node, parent = nodes[node_id], nodes.get(parent_id)
+                    if parent is node.parent:
+                        continue
+                    try:
+                        if parent is None or parent_id in removed_set:
+                            raise ValueError("папка назначения удалена")
+                        self.move(node, parent)
+                        applied += 1
+                    except ValueError as e:
+                        conflicts.append(f"{describe(node_id)}: не перемещён ({e})")
+                for node in self.outermost_nodes([nodes[node_id] for node_id in removed]):
+                    self.remove(node)
+                    applied += 1
+                for node_id, (_, name) in relocated.items():
+                    node = nodes[node_id]
+                    unique, counter = name, 2
+                    while unique in node.parent.children and node.parent.children[unique] is not node:
+                        unique = f"{name} ({counter})"
+                        counter += 1
+                    try:
+                        self.rename(node, unique)
+                    except ValueError as e:
+                        conflicts.append(f"{name}: {e}")
+                        self.rename(node, live[node_id][1] if node_id in live else f"Без названия ({node_id[:8]})")
+                    if node_id in live and name != live[node_id][1]:
+                        applied += 1
+                for node_id, content in contents.items():
+                    if node_id not in removed_set:
+                        self.set_content(nodes[node_id], content)
+                        applied += 1
+                applied += self._merge_order(nodes, base_order, live_order, incoming_order, removed_set)
+        finally:
+            self._suppress_save = False
+            self._merging_external = False
+        if applied:
+            # Слияние не отменяется, а прежние шаги истории рассчитаны на дерево
+            # до него: воспроизведённые поверх чужих правок, они вернули бы
+            # удалённые в файле узлы или старый порядок папок
+            self.clear_history()
+        if unread_contents:
+            self._fill_unread(nodes, unread_contents)
+
+        # Файл теперь совпадает с внешней версией; если локальные правки
+        # остались, дерево записывается поверх неё
+        with self._write_cond:
+            self._disk_state = (external, signature if signature is not None else library_signature(self.data_file))
+        if self._flatten(self.root) != external:
+            self._save_committed()
+        elif self._changed_shards is not None:
+            self._changed_shards.clear()  # Папки на диске уже такие же
+        return applied, conflicts, conflict_copy
+
+    def _fill_unread(self, nodes, unread_contents):
+        """Заполнить непрочитанные папки из описаний их изменённых файлов.
+
+        Узел, который уже есть в дереве (оставлен здесь при конфликте), не
+        повторяется: папка тогда перезаписывается без него.
+        """
+        live_ids = {node.id for node in self._iter_loaded()}
+        for folder_id, (records, order) in unread_contents.items():
+            folder = nodes.get(folder_id)
+            if folder is None or folder.children_loaded or not self.contains(folder):
+                continue
+            fill = partial(self._fill_from_records, records=records, order=order, skip=live_ids)
+            folder.load_children_lazily(partial(self._load_lazily, fill))
+            folder.load_children()
+            if self._changed_shards is not None and not live_ids.isdisjoint(records):
+                top = folder
+                while top.parent is not self.root:
+                    top = top.parent
+                self._changed_shards.add(top.id)
+
+    @staticmethod
+    def _fill_from_records(folder, records, order, skip=()):
+        """Заполнить детей папки из плоского описания (см. _flatten) без узлов из skip"""
+        pending = [folder]
+        while pending:
+            parent = pending.pop()
+            for node_id in order.get(parent.id, ()):
+                if node_id in skip:
+                    continue
+                _, name, content, is_folder = records[node_id]
+                child = TemplateNode(name, content, is_folder, node_id)
+                parent.add_child(child)
+                if is_folder:
+                    pending.append(child)
+
+    def _save_conflict_copy(self):
+        """Скопировать файл шаблонов (и файлы папок) в {data_file}.conflict-ДАТА; вернуть путь или None.
+
+        Если за ту же секунду копия уже есть, к имени добавляется номер.
+        """
+        base = f"{self.data_file}.conflict-{time.strftime('%Y%m%d-%H%M%S')}"
+        conflict_copy, counter = base, 2
+        while os.path.exists(conflict_copy) or os.path.exists(shard_directory(conflict_copy)):
+            conflict_copy = f"{base}-{counter}"
+            counter += 1
+        try:
+            shutil.copy2(self.data_file, conflict_copy)
+            if os.path.isdir(shard_directory(self.data_file)):
+                shutil.copytree(shard_directory(self.data_file), shard_directory(conflict_copy))
+        except OSError as e:
+            print(f"Ошибка сохранения копии конфликтующего файла: {e}")
+            return None
+        return conflict_copy
+
+    @staticmethod
+    def _ancestor_ids(node_id, records):
+        parent_id = records[node_id][0]
+        while parent_id:
+            yield parent_id
+            parent_id = records[parent_id][0]
+
+    def _merge_order(self, nodes, base_order, live_order, incoming_order, removed):
+        """Взять порядок папок из файла там, где локально его не меняли"""
+        reordered = 0
+        for folder_id, their_order in incoming_order.items():
+            folder = nodes.get(folder_id)
+            if folder is None or folder_id in removed or folder_id not in live_order:
+                continue
+            base_ids = set(base_order.get(folder_id, ()))
+            mine = [node_id for node_id in live_order[folder_id] if node_id in base_ids]
+            live_ids = set(live_order[folder_id])
+            if mine != [node_id for node_id in base_order.get(folder_id, ()) if node_id in live_ids]:
+                continue
+            current = list(folder.children.values())
+            position = {node_id: index for index, node_id in enumerate(their_order)}
+            # Элементы, которых нет в файле (добавленные здесь), остаются после упорядоченных
+            ordered = sorted(current, key=lambda node: position.get(node.id, len(position)))
+            if ordered != current:
+                self.reorder(folder, [node.name for node in ordered])
+                reordered += 1
+        return reordered
+
+    def _write(self, root=None, dirty=None, records=None):
+        """Записать дерево; dirty — id изменённых папок верхнего уровня (None — все).
+
+        records — плоское описание записываемого дерева (см. _flatten): оно
+        запоминается как состояние файла вместе с сигнатурой сразу после
+        замены файла, пока наблюдатель не принял запись за чужую.
+        """
+        root = root or self.root
+        shards = shard_directory(self.data_file)
+        if not self.sharded and self._broken_shards:
+            print("Файлы некоторых папок не прочитаны: раскладка по папкам сохраняется")
+        if not self.sharded and not self._broken_shards:
+            self._write_data_file(node_to_dict(root), records, self._shard_files.values())
+            if self._shard_files:
+                self._shard_files = {}
+                try:
+                    os.rmdir(shards)
+                except OSError:
+                    pass
+            return
+        os.makedirs(shards, exist_ok=True)
+        # Сначала папки, потом оглавление: оно не ссылается на недописанные файлы
+        children = OrderedDict()
+        shard_files = {}
+        for name, child in root.children.items():
+            if not child.is_folder:
+                children[name] = node_to_dict(child)
+                continue
+            shard = self._shard_files.get(child.id)
+            if child.id in self._broken_shards:
+                shard = self._broken_shards[child.id]
+            elif not child.children_loaded and shard is not None:
+                pass  # Папку не читали: её файл и есть её содержимое
+            elif shard is None or dirty is None or child.id in dirty:
+                shard = shard_file_name(child.id)
+                write_json_atomic(node_to_dict(child), os.path.join(shards, shard))
+            if child.id in self._shard_files or child.id not in self._broken_shards:
+                shard_files[child.id] = shard
+            children[name] = {
+                "id": child.id,
+                "name": child.name,
+                "content": child.content,
+                "is_folder": True,
+                "shard": shard,
+            }
+        self._write_data_file({
+            "layout": SHARD_LAYOUT,
+            "id": root.id,
+            "name": root.name,
+            "content": root.content,
+            "is_folder": True,
+            "children": children,
+        }, records, set(self._shard_files.values()) - set(shard_files.values()))
+        self._shard_files = shard_files
+
+    def _write_data_file(self, data, records=None, stale_shards=()):
+        """Заменить файл шаблонов и удалить файлы папок, на которые он больше не ссылается.
+
+        Сигнатура библиотеки запоминается под тем же замком, когда на диске
+        уже всё записанное.
+        """
+        temp_path = f"{self.data_file}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        with self._write_cond:
+            os.replace(temp_path, self.data_file)
+            self._remove_shards(shard_directory(self.data_file), stale_shards)
+            if records is not None:
+                self._disk_state = (records, library_signature(self.data_file))
+
+    @staticmethod
+    def _remove_shards(shards, shard_files):
+        """Удалить файлы папок, на которые оглавление больше не ссылается"""
+        for shard in shard_files:
+            try:
+                os.remove(os.path.join(shards, shard))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Ошибка удаления файла папки: {e}")
+
+    def snapshot(self):
+        """Неизменяемый снимок текущего дерева (TemplateSnapshot).
+
+        Вызывать в потоке, который меняет дерево; сам снимок можно читать
+        из любого потока. Неизменённые поддеревья общие с предыдущими
+        снимками, поэтому после небольшой правки снимок стоит O(глубина).
+        Снимок читают целиком (поиск, выгрузка), поэтому ещё не прочитанные
+        папки раскладки по папкам читаются здесь.
+        """
+        for folder in self._unloaded_folders():
+            folder.load_children()
+        return self._snapshot()
+
+    def _snapshot(self):
+        """Снимок без чтения отложенных папок: для записи файла и его состояния"""
+        if self._batch_log:
+            raise RuntimeError("Снимок нельзя взять внутри незавершённой транзакции")
+        if self._frozen_version != self.version:
+            self._frozen.clear()
+            self._frozen_version = self.version
+        return TemplateSnapshot(self._freeze(self.root), self.version)
+
+    def _freeze(self, node):
+        frozen = self._frozen.get(node.id)
+        if frozen is None:
+            children = {}
+            if node.children_loaded:
+                children = {name: self._freeze(child) for name, child in node.children.items()}
+            frozen = self._frozen[node.id] = FrozenTemplateNode(node, children)
+        return frozen
+
+    def _invalidate_frozen(self, changes):
+        """Выбросить из кэша снимков изменённые узлы и их предков"""
+        def drop_branch(node):
+            while node is not None and self._frozen.pop(node.id, None) is not None:
+                node = node.parent
+
+        for change in changes:
+            node = change.node
+            if change.kind == TemplateChange.REMOVED:
+                for removed in [node, *self._iter_loaded(node)]:
+                    self._frozen.pop(removed.id, None)
+            elif change.kind in (TemplateChange.RENAMED, TemplateChange.CONTENT,
+                                 TemplateChange.REORDERED):
+                self._frozen.pop(node.id, None)
+            # Копия самого перенесённого или добавленного узла верна: родителя она не хранит
+            drop_branch(node.parent)
+            drop_branch(change.old_parent)
+
+    def _save_in_background(self, snapshot):
+        with self._write_cond:
+            # Снимок и его изменённые папки передаются вместе: иначе поток
+            # записи мог бы взять новые id со старым снимком
+            self._unwritten = self._merge_dirty(self._unwritten, self._changed_shards)
+            self._changed_shards = set()
+            self._write_pending = snapshot
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+                self._writer.start()
+            self._write_cond.notify_all()
+
+    def _writer_loop(self):
+        while True:
+            with self._write_cond:
+                while self._write_pending is None:
+                    self._write_cond.wait()
+                # Несколько транзакций подряд записываются одним последним снимком
+                snapshot, self._write_pending = self._write_pending, None
+                dirty, self._unwritten = self._unwritten, set()
+                self._writing = True
+            written = False
+            try:
+                if snapshot is not False:
+                    written = self._write_snapshot(snapshot, dirty=dirty)
+            except Exception as e:
+                print(f"Ошибка сохранения шаблонов: {e}")
+            finally:
+                with self._write_cond:
+                    if not written:
+                        self._unwritten = self._merge_dirty(self._unwritten, dirty)
+                    self._writing = False
+                    self._write_cond.notify_all()
+            if snapshot is False:
+                return
+
+    def flush(self, timeout=None):
+        """Дождаться фоновой записи; True, если всё записано"""
+        with self._write_cond:
+            return self._write_cond.wait_for(
+                lambda: self._write_pending is None and not self._writing, timeout
+            )
+
+    def close(self):
+        """Дописать ожидающие изменения и остановить поток записи"""
+        if self._writer is None:
+            return
+        self.flush()
+        with self._write_cond:
+            self._write_pending = False
+            self._write_cond.notify_all()
+        self._writer.join()
+        self._writer = None
+    
+    def load_templates(self):
+        """Загрузить шаблоны из файла"""
+        self.version += 1
+        self.clear_history()
+        self._changed_shards = set()
+        self._unwritten = set()
+        self._shard_files = {}
+        self._broken_shards = {}
+        self._loaded_shards = {}
+        if os.path.exists(self.data_file):
+            try:
+                # Папки из отдельных файлов читаются при первом обращении
+                shard_files = {}
+                self.root = self._read_tree(self.data_file, lazy=True, shard_files=shard_files)
+                self._shard_files = shard_files
+            except Exception as e:
+                if self.read_only:
+                    raise
+                print(f"Ошибка загрузки шаблонов: {e}")
+                self._create_sample_templates()
+        elif self.read_only:
+            raise FileNotFoundError(f"Файл шаблонов не найден: {self.data_file}")
+        else:
+            self._create_sample_templates()
+        if self.sharded is None:
+            self.sharded = bool(self._shard_files)
+        elif self.sharded != bool(self._shard_files):
+            self._changed_shards = None  # Раскладка меняется: при записи переписать всё
+            if not self.sharded:
+                for folder in self._unloaded_folders():
+                    folder.load_children()
+        if self._disk_state is not None:
+            self.track_disk_state()
+        change = TemplateChange(TemplateChange.RELOADED, self.root)
+        change.version = self.version
+        self._notify([change])
+    
+    def _create_sample_templates(self):
+        """Создать примеры шаблонов"""
+        # Папка приветствий
+        greetings = TemplateNode("Приветствия", "", True)
+        greetings.add_child(TemplateNode("Доброе утро", "Доброе утро! Как дела?"))
+        greetings.add_child(TemplateNode("Добрый день", "Добрый день! Надеюсь, у вас все хорошо."))
+        greetings.add_child(TemplateNode("Добрый вечер", "Добрый вечер! Хорошего отдыха."))
+        self.root.add_child(greetings)
+        
+        # Папка подписей
+        signatures = TemplateNode("Подписи", "", True)
+        signatures.add_child(TemplateNode("Официальная", "С уважением,\nИван Иванов\nТел: +7-123-456-7890"))
+        signatures.add_child(TemplateNode("Дружественная", "Всего наилучшего!\nИван"))
+        self.root.add_child(signatures)
+        
+        # Папка программирования
+        programming = TemplateNode("Программирование", "", True)
+        python_folder = TemplateNode("Python", "", True)
+        python_folder.add_child(TemplateNode("Импорты", "import os\nimport sys\nimport json"))
+        python_folder.add_child(TemplateNode("Main функция", "if __name__ == '__main__':\n    main()"))
+        programming.add_child(python_folder)
+        self.root.add_child(programming)
+        
+        self.save_templates()
+    
+    def _read_tree(self, path, lazy=False, shard_files=None, unread=()):
+        """Прочитать дерево из файла шаблонов в любой раскладке.
+
+        shard_files, если передан, заполняется как id папки -> имя её файла.
+        С lazy=True папки из своих файлов читаются при первом обращении к их
+        детям. unread — пары (id папки, имя файла), которые не читаются
+        вовсе: в дереве они остаются непрочитанными (children_loaded=False).
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("layout") != SHARD_LAYOUT:
+            return self._dict_to_node(data)
+        shards = shard_directory(path)
+        root = TemplateNode(data['name'], data.get('content', ''), True, self._file_node_id(data, ""))
+        for child_data in data.get('children', {}).values():
+            shard = child_data.get('shard')
+            if shard is None:
+                root.add_child(self._dict_to_node(child_data, child_data['name']))
+                continue
+            child = TemplateNode(child_data['name'], child_data.get('content', ''), True,
+                                 self._file_node_id(child_data, child_data['name']))
+            shard_path = None  # Имя не по формату: файл не читается, чтобы не выйти из папки
+            if isinstance(shard, str) and SHARD_FILE_PATTERN.fullmatch(shard) is not None:
+                shard_path = os.path.join(shards, shard)
+                if shard_files is not None:
+                    shard_files[child.id] = shard
+            # Дерево приложения помечает непрочитанную папку, чужой файл — ошибка чтения
+            loader = partial(self._load_shard, path=shard_path, shard=shard, strict=not lazy)
+            if shard_path is None:
+                loader(child)  # Читать нечего: папка сразу помечается
+            elif lazy:
+                child.load_children_lazily(partial(self._load_lazily, loader))
+            elif (child.id, shard) in unread:
+                child.load_children_lazily(loader)
+            else:
+                loader(child)
+            root.add_child(child)
+        return root
+
+    def _load_shard(self, folder, path, shard=None, strict=False):
+        """Заполнить детей папки верхнего уровня из её файла.
+
+        Если файл не читается: при strict — ValueError, иначе папка остаётся
+        пустой и помечается непрочитанной (см. _broken_shards).
+        """
+        try:
+            if path is None:
+                raise ValueError("недопустимое имя файла папки")
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            children = [self._dict_to_node(child_data, f"{folder.name}/{child_data['name']}")
+                        for child_data in data.get('children', {}).values()]
+        except Exception as e:
+            if strict:
+                raise ValueError(f"папка '{folder.name}': {e}") from e
+            print(f"Ошибка загрузки папки '{folder.name}': {e}. Её файл не будет перезаписан")
+            self._broken_shards[folder.id] = shard
+            return
+        for child in children:
+            folder.add_child(child)
+
+    def _load_lazily(self, loader, folder):
+        """Прочитать папку, отложенную при загрузке, и учесть её узлы в кэшах"""
+        loader(folder)
+        # Копии папки и её предков в снимках сделаны без её детей
+        node = folder
+        while node is not None:
+            self._frozen.pop(node.id, None)
+            node = node.parent
+        if self._id_index_version == self.version:
+            for node in self._iter_loaded(folder):
+                self._id_index[node.id] = node
+        if self._disk_state is not None:
+            # В файле сейчас ровно прочитанное: для слияния это исходная
+            # версия папки, если её состояние запомнено без детей
+            self._loaded_shards[folder.id] = self._flatten(folder, folder.id)[:2]
+
+    def _unloaded_folders(self):
+        """Папки верхнего уровня, чьи файлы ещё не читались"""
+        return [child for child in self.root.children.values()
+                if child.is_folder and not child.children_loaded]
+
+    @staticmethod
+    def _file_node_id(data, path):
+        """id узла из файла; отсутствующий или чужого формата выводится из пути"""
+        node_id = data.get('id')
+        return node_id if is_node_id(node_id) else legacy_node_id(path)
+
+    def _dict_to_node(self, data, path=""):
+        """Преобразовать словарь в узел"""
+        node = TemplateNode(
+            data['name'],
+            data.get('content', ''),
+            data.get('is_folder', False),
+            self._file_node_id(data, path),
+        )
+        # Использовать OrderedDict для сохранения порядка при загрузке
+        children_data = data.get('children', {})
+        # Если это обычный dict, преобразуем в OrderedDict
+        if children_data:
+            for child_name in children_data:
+                child_data = children_data[child_name]
+                child_path = f"{path}/{child_data['name']}" if path else child_data['name']
+                child = self._dict_to_node(child_data, child_path)
+                node.add_child(child)
+        return node
+
+    def iter_nodes(self, node=None):
+        """Все узлы поддерева (без самого node) в порядке дерева"""
+        stack = [iter((node or self.root).children.values())]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            yield child
+            if child.is_folder:
+                stack.append(iter(child.children.values()))
+
+    def _iter_loaded(self, node=None):
+        """Как iter_nodes, но без чтения отложенных папок (их дети пропускаются)"""
+        stack = [iter((node or self.root)._children.values())]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            yield child
+            if child.is_folder and child.children_loaded:
+                stack.append(iter(child._children.values()))
+
+    def get_node_by_id(self, node_id):
+        """Найти узел по постоянному идентификатору.
+
+        Индекс строится по прочитанным узлам; отложенные папки читаются по
+        одной, только если среди прочитанных такого узла нет.
+        """
+        if self._batch_log:
+            # Внутри незавершённой транзакции индекс ещё не обновлён
+            node = next((node for node in self._iter_loaded() if node.id == node_id), None)
+        else:
+            if self._id_index_version != self.version:
+                self._id_index = {node.id: node for node in self._iter_loaded()}
+                self._id_index_version = self.version
+            node = self._id_index.get(node_id)
+        if node is None:
+            for folder in self._unloaded_folders():
+                folder.load_children()
+                node = next((node for node in self._iter_loaded(folder) if node.id == node_id), None)
+                if node is not None:
+                    break
+        return node
+
+    def _update_id_index(self, changes):
+        """Обновить индекс идентификаторов по изменениям транзакции"""
+        if self._id_index_version != self.version - 1:
+            return
+        for change in changes:
+            if change.kind == TemplateChange.ADDED:
+                for node in [change.node, *self._iter_loaded(change.node)]:
+                    self._id_index[node.id] = node
+            elif change.kind == TemplateChange.REMOVED:
+                for node in [change.node, *self._iter_loaded(change.node)]:
+                    self._id_index.pop(node.id, None)
+        self._id_index_version = self.version
+
+    def contains(self, node):
+        """Проверить, что узел всё ещё в дереве (не удалён вместе с предком)"""
+        while node.parent is not None:
+            node = node.parent
+        return node is self.root
+
+    def resolve(self, ref):
+        """Найти узел по пути или по идентификатору"""
+        node = self.get_node_by_path(ref)
+        if node is None:
+            node = self.get_node_by_id(ref)
+        return node
+
+    def get_node_by_path(self, path):
+        """Найти узел по пути вида 'Папка/Подпапка/Шаблон'"""
+        if not path:
+            return self.root
+
+        parts = [p for p in path.split('/') if p]
+        current = self.root
+        for part in parts:
+            if part in current.children:
+                current = current.children[part]
+            else:
+                return None
+        return current
+    
+    def export_tree(self, node=None):
+        """Поддерево в формате templates.json (node — узел дерева или снимка)"""
+        return node_to_dict(node or self.root)
+
+    def import_tree(self, data, target=None, on_conflict="skip", merge_folders=False):
+        """Добавить узлы из словаря формата templates.json в папку target.
+
+        Если в данных папка — импортируется её содержимое, если шаблон — он сам.
+        on_conflict: "skip", "replace" или "rename" для совпадающих имён.
+        Всё добавляется одной транзакцией. Возвращает (добавлено, пропущено).
+        """
+        return self.import_nodes(self._dict_to_node(data), target, on_conflict, merge_folders)
+
+    def import_nodes(self, imported, target=None, on_conflict="skip", merge_folders=False):
+        """Добавить отсоединённое дерево (см. import_tree, read_import) в папку target.
+
+        С merge_folders=True папка, совпадающая по имени с существующей
+        папкой, не конфликт: её содержимое добавляется в существующую.
+        Новые поддеревья добавляются целиком, поэтому транзакция содержит
+        по одному изменению на каждый добавленный верхний элемент.
+        """
+        target = target or self.root
+        children = list(imported.children.values()) if imported.is_folder else [imported]
+        existing_ids = {node.id for node in self._iter_loaded()}
+        # Ради проверки id непрочитанные папки не читаются: пока они есть,
+        # импортированные узлы получают новые id
+        keep_ids = not self._unloaded_folders()
+
+        added = skipped = 0
+        with self.batch():
+            pending = [(target, children)]
+            while pending:
+                folder, children = pending.pop()
+                for child in children:
+                    child.parent = None
+                    child.invalidate_path()
+                    existing = folder.children.get(child.name)
+                    if existing is not None:
+                        if merge_folders and existing.is_folder and child.is_folder:
+                            pending.append((existing, list(child.children.values())))
+                            continue
+                        if on_conflict == "skip":
+                            skipped += 1
+                            continue
+                        if on_conflict == "replace":
+                            existing_ids.difference_update(node.id for node in [existing, *self.iter_nodes(existing)])
+                            self.remove(existing)
+                        else:
+                            counter = 2
+                            while f"{child.name} ({counter})" in folder.children:
+                                counter += 1
+                            child.name = f"{child.name} ({counter})"
+                    # Идентификаторы должны оставаться уникальными в пределах библиотеки
+                    for node in [child, *self.iter_nodes(child)]:
+                        if node.id in existing_ids or not keep_ids:
+                            node.id = new_node_id()
+                        existing_ids.add(node.id)
+                    self.add(folder, child)
+                    added += 1
+        return added, skipped
+
+    def read_import(self, path, fmt=None, progress=None):
+        """Прочитать файл или папку для импорта в отсоединённое дерево.
+
+        path может быть и открытым текстовым файлом (например, stdin), тогда
+        fmt обязателен и не может быть "dir". fmt — "json" (формат
+        templates.json) или один из TRANSFER_FORMATS; по умолчанию
+        определяется по пути. Дерево библиотеки не трогается, поэтому
+        вызывать можно из фонового потока, а результат передать
+        в import_nodes() в потоке, меняющем дерево.
+        """
+        fmt = fmt or detect_transfer_format(path)
+        if fmt == "json":
+            if isinstance(path, str):
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            else:
+                data = json.load(path)
+            if not isinstance(data, dict) or "name" not in data:
+                raise ValueError("неверный формат файла шаблонов")
+            return self._dict_to_node(data)
+        if not isinstance(path, str):
+            return records_to_tree(read_records(path, fmt), progress)
+        return read_import_tree(path, fmt, progress)
+
+    def export_file(self, node, path, fmt=None, progress=None):
+        """Выгрузить поддерево node в файл или папку path.
+
+        node лучше брать из snapshot(): тогда выгрузку можно выполнять
+        в фоновом потоке, пока дерево правится. Возвращает число узлов.
+        """
+        fmt = fmt or detect_transfer_format(path)
+        if fmt == "json":
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(node_to_dict(node), f, ensure_ascii=False, indent=2)
+            return sum(1 for _ in iter_export_records(node))
+        if fmt == "dir":
+            return write_directory(node, path, progress)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            return write_records(node, f, fmt, progress)
+
+    def add_listener(self, callback):
+        """Подписаться на изменения: callback(список TemplateChange).
+
+        Вызывается после каждой завершённой транзакции и после загрузки
+        дерева (RELOADED), в порядке подписки.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    @contextmanager
+    def batch(self):
+        """Транзакция: одно сохранение и одно уведомление на все изменения.
+
+        Вложенные batch() входят во внешнюю транзакцию; исключение внутри
+        откатывает изменения этого блока и пробрасывается дальше.
+        """
+        mark = len(self._batch_log)
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._rollback(mark)
+            raise
+        finally:
+            self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self._commit()
+
+    def _record(self, change, undo, redo):
+        """Записать шаг транзакции: undo возвращает прежнее состояние, redo повторяет шаг"""
+        self._batch_log.append(([change], undo, redo))
+
+    def _record_group(self, changes, snapshots, redo):
+        """Записать групповую операцию; откат возвращает запомненные папки целиком"""
+        snapshots = list(snapshots)
+
+        def undo():
+            for parent, items in reversed(snapshots):
+                self._restore_children(parent, items)
+
+        self._batch_log.append((changes, undo, redo))
+
+    def _rollback(self, mark):
+        while len(self._batch_log) > mark:
+            _, undo, _ = self._batch_log.pop()
+            undo()
+        # Откат редок: проще собрать следующий снимок заново
+        self._frozen_version = None
+
+    def _commit(self):
+        if not self._batch_log:
+            return
+        steps, self._batch_log = self._batch_log, []
+        if not self._merging_external:
+            self._redo_stack.clear()
+            self._push_undo(steps)
+        self._publish([change for group, _, _ in steps for change in group])
+
+    def _publish(self, changes):
+        """Завершить изменение дерева: кэши, версия, запись файла, слушатели"""
+        if not self._merging_external:
+            # Непрочитанная папка, которая перестала быть верхней (удалена или
+            # перенесена в другую), лишится своего файла: её дети читаются,
+            # пока он на месте (слияние заполняет такие папки само)
+            for change in changes:
+                node = change.node
+                if node.is_folder and not node.children_loaded and node.parent is not self.root:
+                    node.load_children()
+        if self._frozen_version == self.version:
+            self._invalidate_frozen(changes)
+            self._frozen_version = self.version + 1
+        self.version += 1
+        for change in changes:
+            change.version = self.version
+        self._update_id_index(changes)
+        self._mark_changed_shards(changes)
+        try:
+            if not self._suppress_save:
+                self._save_committed()
+        finally:
+            # Дерево уже изменено: индексы и окна должны узнать об этом,
+            # даже если запись не удалась (ошибка уйдёт вызывающему)
+            self._notify(changes)
+
+    # Отмена и повтор. Шаги воспроизводятся строго в порядке стеков: каждый
+    # рассчитан на состояние дерева сразу после (или до) своей транзакции,
+    # а любые другие правки идут через этот же класс и попадают в историю.
+    _INVERSE_KINDS = {TemplateChange.ADDED: TemplateChange.REMOVED, TemplateChange.REMOVED: TemplateChange.ADDED}
+
+    def can_undo(self):
+        return bool(self._undo_stack)
+
+    def can_redo(self):
+        return bool(self._redo_stack)
+
+    def undo(self):
+        """Отменить последнюю транзакцию; вернуть её изменения или None"""
+        if self._batch_log:
+            raise RuntimeError("Отмена невозможна внутри незавершённой транзакции")
+        if not self._undo_stack:
+            return None
+        steps, size = self._undo_stack.pop()
+        self._undo_memory -= size
+        self._redo_stack.append((steps, size))
+        changes = []
+        for group, undo, _ in reversed(steps):
+            changes.extend(self._replayed(change, self._INVERSE_KINDS.get(change.kind, change.kind))
+                           for change in reversed(group))
+            undo()
+        self._publish(changes)
+        return [change for group, _, _ in steps for change in group]
+
+    def redo(self):
+        """Повторить отменённую транзакцию; вернуть её изменения или None"""
+        if self._batch_log:
+            raise RuntimeError("Повтор невозможен внутри незавершённой транзакции")
+        if not self._redo_stack:
+            return None
+        steps, size = self._redo_stack.pop()
+        self._undo_stack.append((steps, size))
+        self._undo_memory += size
+        changes = []
+        for group, _, redo in steps:
+            changes.extend(self._replayed(change, change.kind) for change in group)
+            redo()
+        self._publish(changes)
+        return [change for group, _, _ in steps for change in group]
+
+    @staticmethod
+    def _replayed(change, kind):
+        """Изменение для слушателей при воспроизведении: «было» — текущее состояние узла"""
+        node = change.node
+        old_content = node.content if kind == TemplateChange.CONTENT else None
+        return TemplateChange(kind, node, old_parent=node.parent, old_name=node.name, old_content=old_content)
+
+    def clear_history(self):
+        """Забыть историю отмены и повтора"""
+        self._undo_stack.clear()
+        self._redo_stack.clear()
+        self._undo_memory = 0
+
+    def _push_undo(self, steps):
+        """Положить транзакцию в историю, вытесняя самые старые сверх лимита памяти"""
+        size = sum(self._change_size(change) for group, _, _ in steps for change in group)
+        if size > self.undo_memory_limit:
+            # Правка больше всей истории (например, удаление всей библиотеки)
+            # не запоминается, но и не вытесняет то, что уже есть
+            return
+        self._undo_stack.append((steps, size))
+        self._undo_memory += size
+        while self._undo_memory > self.undo_memory_limit:
+            _, dropped = self._undo_stack.popleft()
+            self._undo_memory -= dropped
+
+    def _change_size(self, change):
+        """Примерная память, которую удерживает шаг истории"""
+        node = change.node
+        if change.kind == TemplateChange.REMOVED:
+            # Удалённое поддерево живёт только в истории
+            return sum(self.UNDO_NODE_OVERHEAD + sys.getsizeof(item.content)
+                       for item in [node, *self.iter_nodes(node)])
+        if change.kind == TemplateChange.CONTENT:
+            # Прежний текст хранится в замыкании отката (оценка по текущему)
+            return self.UNDO_NODE_OVERHEAD + sys.getsizeof(node.content)
+        if change.kind == TemplateChange.REORDERED:
+            return self.UNDO_NODE_OVERHEAD * (1 + len(node.children))
+        return self.UNDO_NODE_OVERHEAD
+
+    def _notify(self, changes):
+        for callback in list(self._listeners):
+            try:
+                callback(changes)
+            except Exception as e:
+                print(f"Ошибка обработчика изменений шаблонов: {e}")
+
+    @staticmethod
+    def _attach(parent, node, index=None):
+        """Вставить узел в parent на позицию index (None — в конец)"""
+        if index is None or index >= len(parent.children):
+            parent.add_child(node)
+            return
+        items = list(parent.children.items())
+        items.insert(index, (node.name, node))
+        parent.children = OrderedDict(items)
+        parent._sorted = None
+        node.parent = parent
+        node.invalidate_path()
+
+    @staticmethod
+    def _detach(node):
+        """Убрать узел из родителя; вернуть его прежнюю позицию"""
+        parent = node.parent
+        index = list(parent.children).index(node.name)
+        parent.remove_child(node.name)
+        return index
+
+    def validate_name(self, folder, name, node=None):
+        """Проверить, что name можно использовать в folder (иначе ValueError)"""
+        if not folder.is_folder:
+            raise ValueError(f"'{folder.name}' не является папкой")
+        if not name or not name.strip():
+            raise ValueError("Название не может быть пустым")
+        if "/" in name:
+            raise ValueError("Название не может содержать '/'")
+        existing = folder.children.get(name)
+        if existing is not None and existing is not node:
+            kind = "Папка" if existing.is_folder else "Шаблон"
+            raise ValueError(f"{kind} с названием '{name}' уже есть в этой папке")
+
+    def add(self, parent, node, index=None):
+        """Добавить узел в папку parent"""
+        self.validate_name(parent, node.name)
+        with self.batch():
+            self._attach(parent, node, index)
+            self._record(
+                TemplateChange(TemplateChange.ADDED, node),
+                lambda: self._detach(node),
+                lambda: self._attach(parent, node, index),
+            )
+        return node
+
+    def remove(self, node):
+        """Удалить узел (вместе с поддеревом)"""
+        parent = node.parent
+        if parent is None:
+            raise ValueError("Нельзя удалить корневую папку")
+        with self.batch():
+            index = self._detach(node)
+            self._record(
+                TemplateChange(TemplateChange.REMOVED, node, old_parent=parent),
+                lambda: self._attach(parent, node, index),
+                lambda: self._detach(node),
+            )
+
+    def rename(self, node, new_name):
+        """Переименовать узел, не меняя его позицию в папке"""
+        if new_name == node.name:
+            return
+        parent = node.parent
+        if parent is not None:
+            self.validate_name(parent, new_name, node)
+        old_name = node.name
+
+        def set_name(name):
+            if parent is None:
+                node.name = name
+                return
+            index = self._detach(node)
+            node.name = name
+            self._attach(parent, node, index)
+
+        with self.batch():
+            set_name(new_name)
+            self._record(
+                TemplateChange(TemplateChange.RENAMED, node, old_name=old_name),
+                lambda: set_name(old_name),
+                lambda: set_name(new_name),
+            )
+
+    def set_content(self, node, content):
+        """Изменить текст шаблона"""
+        if content == node.content:
+            return
+        old_content = node.content
+        with self.batch():
+            node.content = content
+            self._record(
+                TemplateChange(TemplateChange.CONTENT, node, old_content=old_content),
+                lambda: setattr(node, "content", old_content),
+                lambda: setattr(node, "content", content),
+            )
+
+    def move(self, node, new_parent, index=None):
+        """Перенести узел в другую папку (index — позиция, None — в конец)"""
+        old_parent = node.parent
+        if old_parent is None:
+            raise ValueError("Нельзя переместить корневую папку")
+        ancestor = new_parent
+        while ancestor is not None:
+            if ancestor is node:
+                raise ValueError("Нельзя переместить папку внутрь самой себя")
+            ancestor = ancestor.parent
+        if new_parent is old_parent:
+            return
+        self.validate_name(new_parent, node.name)
+        with self.batch():
+            old_index = self._detach(node)
+            self._attach(new_parent, node, index)
+
+            def undo():
+                self._detach(node)
+                self._attach(old_parent, node, old_index)
+
+            def redo():
+                self._detach(node)
+                self._attach(new_parent, node, index)
+
+            self._record(TemplateChange(TemplateChange.MOVED, node, old_parent=old_parent), undo, redo)
+
+    @staticmethod
+    def outermost_nodes(nodes):
+        """Убрать узлы, чьи предки тоже в списке (порядок сохраняется)"""
+        selected = {id(node) for node in nodes}
+        result = []
+        seen = set()
+        for node in nodes:
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            ancestor = node.parent
+            while ancestor is not None and id(ancestor) not in selected:
+                ancestor = ancestor.parent
+            if ancestor is None:
+                result.append(node)
+        return result
+
+    @staticmethod
+    def _restore_children(parent, items):
+        parent.children = OrderedDict(items)
+        parent._sorted = None
+        for _, child in items:
+            if child.parent is not parent:
+                child.parent = parent
+                child.invalidate_path()
+
+    def remove_many(self, nodes):
+        """Удалить несколько узлов одной транзакцией; вернуть число удалённых"""
+        nodes = [node for node in self.outermost_nodes(nodes) if node.parent is not None]
+        if not nodes:
+            return 0
+        # Состояние папок запоминается целиком: откат за O(размер папки), а не O(n^2)
+        snapshots = {}
+        for node in nodes:
+            parent = node.parent
+            if id(parent) not in snapshots:
+                snapshots[id(parent)] = (parent, list(parent.children.items()))
+        changes = []
+
+        def redo():
+            for node in nodes:
+                node.parent.remove_child(node.name)
+
+        with self.batch():
+            # Запись до изменений: при сбое посередине откат вернёт папки целиком
+            self._record_group(changes, snapshots.values(), redo)
+            for node in nodes:
+                parent = node.parent
+                parent.remove_child(node.name)
+                changes.append(TemplateChange(TemplateChange.REMOVED, node, old_parent=parent))
+        return len(nodes)
+
+    def move_many(self, nodes, new_parent):
+        """Перенести несколько узлов в папку new_parent одной транзакцией.
+
+        Все проверки выполняются до изменений; вернуть число перенесённых.
+        """
+        nodes = [
+            node for node in self.outermost_nodes(nodes)
+            if node.parent is not None and node.parent is not new_parent
+        ]
+        if not nodes:
+            return 0
+        names = set()
+        for node in nodes:
+            ancestor = new_parent
+            while ancestor is not None:
+                if ancestor is node:
+                    raise ValueError(f"Нельзя переместить папку '{node.name}' внутрь самой себя")
+                ancestor = ancestor.parent
+            self.validate_name(new_parent, node.name)
+            if node.name in names:
+                raise ValueError(f"Среди перемещаемых несколько элементов с названием '{node.name}'")
+            names.add(node.name)
+
+        snapshots = {id(new_parent): (new_parent, list(new_parent.children.items()))}
+        for node in nodes:
+            parent = node.parent
+            if id(parent) not in snapshots:
+                snapshots[id(parent)] = (parent, list(parent.children.items()))
+        changes = []
+
+        def redo():
+            for node in nodes:
+                node.parent.remove_child(node.name)
+                new_parent.add_child(node)
+
+        with self.batch():
+            self._record_group(changes, snapshots.values(), redo)
+            for node in nodes:
+                old_parent = node.parent
+                old_parent.remove_child(node.name)
+                new_parent.add_child(node)
+                changes.append(TemplateChange(TemplateChange.MOVED, node, old_parent=old_parent))
+        return len(nodes)
+
+    def reorder(self, parent, names):
+        """Задать порядок детей папки (names — все их названия в новом порядке)"""
+        old_items = list(parent.children.items())
+        if list(names) == [name for name, _ in old_items]:
+            return
+        if sorted(names) != sorted(parent.children):
+            raise ValueError("Новый порядок должен содержать все элементы папки")
+        with self.batch():
+            parent.children = OrderedDict((name, parent.children[name]) for name in names)
+            new_items = list(parent.children.items())
+            self._record(
+                TemplateChange(TemplateChange.REORDERED, parent),
+                lambda: self._restore_children(parent, old_items),
+                lambda: self._restore_children(parent, new_items),
+            )
+
+    def move_up(self, node):
+        """Переместить узел вверх среди соседей; False, если он уже первый"""
+        parent = node.parent
+        if parent is None:
+            return False
+        with self.batch():
+            if not parent.move_child_up(node.name):
+                return False
+            self._record(
+                TemplateChange(TemplateChange.REORDERED, parent),
+                lambda: parent.move_child_down(node.name),
+                lambda: parent.move_child_up(node.name),
+            )
+        return True
+
+    def move_down(self, node):
+        """Переместить узел вниз среди соседей; False, если он уже последний"""
+        parent = node.parent
+        if parent is None:
+            return False
+        with self.batch():
+            if not parent.move_child_down(node.name):
+                return False
+            self._record(
+                TemplateChange(TemplateChange.REORDERED, parent),
+                lambda: parent.move_child_up(node.name),
+                lambda: parent.move_child_down(node.name),
+            )
+        return True
+
+    def search_templates(self, query, node=None):
+        """Поиск шаблонов и папок по названию"""
+        query_lower = query.lower()
+        return [child for child in self.iter_nodes(node) if query_lower in child.name.lower()]
+
+class TemplateSearchIndex:
+    """Плоский индекс шаблонов для поиска по названию и содержимому.
+
+    Хранит шаблоны в порядке дерева вместе с заранее приведёнными к нижнему
+    регистру названием и содержимым, а папки — с названием (для фильтра
+    главного окна, см. search_folders). Перестраивается только при смене
+    версии дерева в TemplateManager; если индекс подписан на изменения
+    (apply_changes), правки названий и текста применяются на месте.
+    """
+    def __init__(self, template_manager):
+        self.template_manager = template_manager
+        self._entries = []  # [шаблон, название в нижнем регистре, содержимое в нижнем регистре]
+        self._positions = {}  # id(шаблон) -> позиция в _entries
+        self._folders = []  # [папка, название в нижнем регистре]
+        self._folder_positions = {}  # id(папка) -> позиция в _folders
+        self._version = None
+
+    def is_fresh(self):
+        """Проверить, что индекс соответствует текущей версии дерева"""
+        return self._version == self.template_manager.version
+
+    def refresh(self):
+        """Перестроить индекс, если дерево изменилось"""
+        if not self.is_fresh():
+            self.rebuild()
+
+    def rebuild(self):
+        """Полностью перестроить индекс"""
+        entries = []
+        folders = []
+        stack = [iter(self.template_manager.root.children.values())]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                continue
+            if child.is_folder:
+                folders.append([child, child.name.lower()])
+                stack.append(iter(child.children.values()))
+            else:
+                entries.append([child, child.name.lower(), (child.content or "").lower()])
+        self._entries = entries
+        self._positions = {id(entry[0]): position for position, entry in enumerate(entries)}
+        self._folders = folders
+        self._folder_positions = {id(entry[0]): position for position, entry in enumerate(folders)}
+        self._version = self.template_manager.version
+
+    def apply_changes(self, changes):
+        """Слушатель TemplateManager: обновить индекс без полной перестройки.
+
+        Переименование и смена текста правят одну запись; после изменений
+        состава или порядка индекс перестроится при следующем поиске.
+        """
+        if not changes or self._version != changes[0].version - 1:
+            return
+        if any(change.kind in TemplateChange.STRUCTURAL for change in changes):
+            return
+        for change in changes:
+            node = change.node
+            position = self._positions.get(id(node))
+            if position is not None:
+                self._entries[position][1:] = [node.name.lower(), (node.content or "").lower()]
+            position = self._folder_positions.get(id(node))
+            if position is not None:
+                self._folders[position][1] = node.name.lower()
+        self._version = changes[0].version
+
+    def all_templates(self):
+        """Получить все шаблоны (не папки) в порядке дерева"""
+        self.refresh()
+        return [entry[0] for entry in self._entries]
+
+    def search(self, query):
+        """Поиск шаблонов по названию и содержимому"""
+        if not query.strip():
+            return []
+
+        self.refresh()
+        query_lower = query.lower()
+        return [
+            template for template, name_lower, content_lower in self._entries
+            if query_lower in name_lower or query_lower in content_lower
+        ]
+
+    def search_folders(self, query):
+        """Папки, в названии которых есть query, в порядке дерева"""
+        if not query.strip():
+            return []
+
+        self.refresh()
+        query_lower = query.lower()
+        return [folder for folder, name_lower in self._folders if query_lower in name_lower]
+
+class FileWatcher:
+    """Вызывает callback(сигнатура) в своём потоке, когда файл изменился.
+
+    На Linux поток ждёт событий inotify для папки файла (так видна и запись
+    через временный файл с os.replace), а по таймауту всё равно сверяет
+    сигнатуру файла: это запасной опрос для Windows, macOS и сетевых
+    дисков, где события не приходят. Callback вызывается, когда файл
+    перестал меняться (запись по сети идёт частями).
+
+    signature_of(path) считает сигнатуру (по умолчанию file_signature);
+    directories — ещё папки, события в которых будят поток (например,
+    папка файлов папок библиотеки для library_signature).
+    """
+    SETTLE_SECONDS = 0.2
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    INOTIFY_MASK = 0x2 | 0x8 | 0x80 | 0x100
+
+    def __init__(self, path, callback, interval=1.0, signature_of=file_signature, directories=()):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.signature_of = signature_of
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self._watched = set()  # Папки из directories, на которые уже стоит inotify
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._libc = None
+        self._wakeup = None
+
+    def start(self):
+        if self._thread is None:
+            self._signature = self.signature_of(self.path)
+            self._inotify = self._open_inotify()
+            if self._inotify is not None:
+                self._wakeup = os.pipe()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _open_inotify(self):
+        """Дескриптор inotify на папку файла или None (тогда только опрос)"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            if libc.inotify_add_watch(fd, os.fsencode(os.path.dirname(self.path)), self.INOTIFY_MASK) < 0:
+                os.close(fd)
+                return None
+            self._libc = libc
+            self._watch_directories(fd)
+            return fd
+        except (OSError, AttributeError) as e:
+            print(f"inotify недоступен, изменения файла отслеживаются опросом: {e}")
+            return None
+
+    def _watch_directories(self, fd):
+        """Поставить inotify на появившиеся папки из directories (пока их нет — опрос)"""
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                self._watched.discard(directory)  # Удалённая папка снимается с inotify сама
+            elif directory not in self._watched:
+                # IN_DELETE: удаление ненужного файла папки тоже правка
+                if self._libc.inotify_add_watch(fd, os.fsencode(directory), self.INOTIFY_MASK | 0x200) >= 0:
+                    self._watched.add(directory)
+
+    def _wait(self):
+        """Дождаться события в папке файла или таймаута опроса"""
+        if self._inotify is None:
+            self._stop.wait(self.interval)
+            return
+        ready, _, _ = select.select([self._inotify, self._wakeup[0]], [], [], self.interval)
+        if self._inotify in ready:
+            # Сами события не разбираются: после любого из них сверяется сигнатура
+            try:
+                os.read(self._inotify, 65536)
+            except BlockingIOError:
+                pass
+        self._watch_directories(self._inotify)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wait()
+            signature = self.signature_of(self.path)
+            if signature == self._signature:
+                continue
+            while not self._stop.wait(self.SETTLE_SECONDS):
+                settled = self.signature_of(self.path)
+                if settled == signature:
+                    break
+                signature = settled
+            if self._stop.is_set():
+                break
+            self._signature = signature
+            if signature is None:
+                continue
+            try:
+                self.callback(signature)
+            except Exception as e:
+                print(f"Ошибка обработчика изменения файла: {e}")
+
+    def close(self):
+        """Остановить поток наблюдения"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b"\0")
+        self._thread.join()
+        self._thread = None
+        for fd in (self._inotify, *(self._wakeup or ())):
+            if fd is not None:
+                os.close(fd)
+        self._inotify = self._wakeup = None
+        self._watched.clear()
+
+# Массовый импорт и экспорт: папка с текстовыми файлами (папки — каталоги,
+# шаблоны — файлы .txt), NDJSON (по объекту на строку, как
+# `textpaster_cli.py --json list -r --content`) и CSV со столбцами
+# path,type,content,id. Записи читаются и пишутся по одной, поэтому память
+# не зависит от размера файла; пути записей — относительно выгружаемой папки.
+TRANSFER_FORMATS = ("dir", "ndjson", "csv")
+TEMPLATE_FILE_SUFFIX = ".txt"
+CSV_FIELDS = ("path", "type", "content", "id")
+PROGRESS_EVERY = 1000
+# Символы, недопустимые в именах файлов Windows, кодируются как %XX
+_UNSAFE_FILE_CHARS = set('%<>:"\\|?*')
+
+def detect_transfer_format(path):
+    """Формат импорта/экспорта по пути: "dir" (папка или путь с / в конце), "ndjson", "csv" или "json" """
+    if os.path.isdir(path) or path.endswith(("/", os.sep)):
+        return "dir"
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    if extension == ".csv":
+        return "csv"
+    return "json"
+
+def _encode_file_name(name):
+    encoded = "".join(f"%{ord(char):02X}" if char in _UNSAFE_FILE_CHARS or ord(char) < 32 else char
+                      for char in name)
+    # Windows отбрасывает точку и пробел в конце имени
+    if encoded.endswith((".", " ")):
+        encoded = encoded[:-1] + f"%{ord(encoded[-1]):02X}"
+    return encoded
+
+def _decode_file_name(name):
+    parts = name.split("%")
+    decoded = [parts[0]]
+    for part in parts[1:]:
+        try:
+            decoded.append(chr(int(part[:2], 16)) + part[2:])
+        except ValueError:
+            decoded.append("%" + part)
+    return "".join(decoded)
+
+def iter_export_records(node):
+    """Записи выгрузки поддерева node в порядке дерева (пути — относительно node)"""
+    stack = [("", iter(node.children.values()))] if node.is_folder else [("", iter([node]))]
+    while stack:
+        prefix, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            continue
+        path = f"{prefix}/{child.name}" if prefix else child.name
+        record = {"id": child.id, "path": path, "name": child.name,
+                  "type": "folder" if child.is_folder else "template"}
+        if not child.is_folder:
+            record["content"] = child.content
+        yield record
+        if child.is_folder:
+            stack.append((path, iter(child.children.values())))
+
+def write_records(node, stream, fmt, progress=None):
+    """Записать поддерево в поток в формате "ndjson" или "csv"; вернуть число записей"""
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        write = writer.writerow
+    elif fmt == "ndjson":
+        def write(record):
+            stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    count = 0
+    for count, record in enumerate(iter_export_records(node), 1):
+        write(record)
+        if progress is not None and count % PROGRESS_EVERY == 0:
+            progress(count)
+    return count
+
+def write_directory(node, path, progress=None):
+    """Выгрузить поддерево в папку: подпапки — каталоги, шаблоны — файлы .txt"""
+    os.makedirs(path, exist_ok=True)
+    count = 0
+    for count, record in enumerate(iter_export_records(node), 1):
+        target = os.path.join(path, *(_encode_file_name(part) for part in record["path"].split("/")))
+        if record["type"] == "folder":
+            os.makedirs(target, exist_ok=True)
+        else:
+            with open(target + TEMPLATE_FILE_SUFFIX, 'w', encoding='utf-8', newline='') as f:
+                f.write(record["content"])
+        if progress is not None and count % PROGRESS_EVERY == 0:
+            progress(count)
+    return count
+
+def iter_directory_records(path):
+    """Записи импорта из папки: каталоги — папки, файлы — шаблоны.
+
+    Расширение .txt у шаблонов отбрасывается, остальные файлы берутся
+    с полным именем; файлы не в UTF-8 пропускаются с сообщением.
+    """
+    for current, dirs, files in os.walk(path):
+        dirs.sort()
+        relative = os.path.relpath(current, path)
+        prefix = "" if relative == "." else "/".join(
+            _decode_file_name(part) for part in relative.split(os.sep)
+        )
+        for name in dirs:
+            yield {"path": f"{prefix}/{_decode_file_name(name)}".lstrip("/"), "type": "folder"}
+        for name in sorted(files):
+            title = name[:-len(TEMPLATE_FILE_SUFFIX)] if name.endswith(TEMPLATE_FILE_SUFFIX) else name
+            try:
+                with open(os.path.join(current, name), 'r', encoding='utf-8-sig', newline='') as f:
+                    content = f.read()
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"Ошибка чтения {os.path.join(current, name)}: {e}")
+                continue
+            yield {"path": f"{prefix}/{_decode_file_name(title)}".lstrip("/"),
+                   "type": "template", "content": content}
+
+def read_records(stream, fmt):
+    """Записи импорта из потока в формате "ndjson" или "csv" """
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    elif fmt == "ndjson":
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"строка {number}: {e}") from None
+            if not isinstance(record, dict):
+                raise ValueError(f"строка {number}: ожидался объект JSON")
+            yield record
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+def records_to_tree(records, progress=None):
+    """Собрать отсоединённое дерево из записей импорта.
+
+    Недостающие папки из путей создаются сами; повтор пути у шаблона
+    заменяет текст, у папки ничего не меняет.
+    """
+    root = TemplateNode("Root", "", True)
+    folders = {"": root}
+
+    def folder_at(parts, node_id=None):
+        key = "/".join(parts)
+        folder = folders.get(key)
+        if folder is None:
+            parent = folder_at(parts[:-1])
+            folder = parent.children.get(parts[-1])
+            if folder is None:
+                folder = TemplateNode(parts[-1], "", True, node_id)
+                parent.add_child(folder)
+            elif not folder.is_folder:
+                raise ValueError(f"'{key}' — шаблон, а не папка")
+            folders[key] = folder
+        return folder
+
+    count = 0
+    for count, record in enumerate(records, 1):
+        parts = [part for part in str(record.get("path") or "").split("/") if part.strip()]
+        if not parts:
+            raise ValueError(f"запись {count}: не указан путь")
+        is_folder = record.get("type") == "folder"
+        node_id = record.get("id") if is_node_id(record.get("id")) else None
+        if is_folder:
+            folder_at(parts, node_id)
+        else:
+            parent = folder_at(parts[:-1])
+            content = record.get("content") or ""
+            existing = parent.children.get(parts[-1])
+            if existing is None:
+                parent.add_child(TemplateNode(parts[-1], str(content), False, node_id))
+            elif existing.is_folder:
+                raise ValueError(f"запись {count}: '{'/'.join(parts)}' — папка, а не шаблон")
+            else:
+                existing.content = str(content)
+        if progress is not None and count % PROGRESS_EVERY == 0:
+            progress(count)
+    return root
+
+def read_import_tree(path, fmt, progress=None):
+    """Прочитать папку, NDJSON или CSV в отсоединённое дерево (потоково)"""
+    if fmt == "dir":
+        return records_to_tree(iter_directory_records(path), progress)
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        return records_to_tree(read_records(f, fmt), progress)
+
+class FrecencyStore:
+    """Частота и давность использования шаблонов (frecency) по их id.
+
+    Счёт шаблона затухает вдвое за HALF_LIFE секунд; каждое использование
+    добавляет к нему единицу. Использование дописывается одной строкой в
+    журнал (<имя>.log), а раз в COMPACT_EVERY записей журнал сворачивается
+    в снимок <имя>.json — поэтому запись дешёвая и файл не растёт.
+    """
+    HALF_LIFE = 7 * 24 * 3600
+    COMPACT_EVERY = 500
+    MIN_SCORE = 0.01  # Почти забытые шаблоны выбрасываются при сворачивании
+
+    def __init__(self, path="usage.json", half_life=HALF_LIFE):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + ".log"
+        self.half_life = half_life
+        self._scores = {}  # id -> (счёт на момент last_used, last_used)
+        self._log = None
+        self._log_lines = 0
+        self.load()
+
+    @classmethod
+    def for_library(cls, data_file):
+        """Хранилище рядом с файлом шаблонов"""
+        return cls(os.path.join(os.path.dirname(os.path.abspath(data_file)), "usage.json"))
+
+    def _bump(self, node_id, when):
+        score, last_used = self._scores.get(node_id, (0.0, when))
+        self._scores[node_id] = (score * 2 ** ((last_used - when) / self.half_life) + 1.0, when)
+
+    def load(self):
+        """Загрузить снимок и дописанный после него журнал"""
+        self._scores = {}
+        self._log_lines = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._scores = {node_id: (score, last_used) for node_id, (score, last_used) in data.get("scores", {}).items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка загрузки статистики использования: {e}")
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    when, _, node_id = line.strip().partition(" ")
+                    if node_id:
+                        self._bump(node_id, float(when))
+                        self._log_lines += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка чтения журнала использования: {e}")
+
+    def record(self, node_id, when=None):
+        """Отметить использование шаблона"""
+        when = time.time() if when is None else when
+        self._bump(node_id, when)
+        try:
+            if self._log is None:
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+            self._log.write(f"{when:.3f} {node_id}\n")
+            self._log.flush()
+            self._log_lines += 1
+        except Exception as e:
+            print(f"Ошибка записи журнала использования: {e}")
+        if self._log_lines >= self.COMPACT_EVERY:
+            self.compact()
+
+    def score(self, node_id, now=None):
+        """Текущий (затухший) счёт шаблона; 0, если он не использовался"""
+        entry = self._scores.get(node_id)
+        if entry is None:
+            return 0.0
+        now = time.time() if now is None else now
+        return entry[0] * 2 ** ((entry[1] - now) / self.half_life)
+
+    def rank(self, nodes, now=None):
+        """Использованные узлы — по убыванию счёта, остальные — в исходном порядке"""
+        if not self._scores:
+            return list(nodes)
+        now = time.time() if now is None else now
+        used = []
+        rest = []
+        for node in nodes:
+            (used if node.id in self._scores else rest).append(node)
+        if not used:
+            return rest
+        used.sort(key=lambda node: -self.score(node.id, now))
+        return used + rest
+
+    def compact(self):
+        """Свернуть журнал в снимок (атомарная замена файла)"""
+        now = time.time()
+        self._scores = {
+            node_id: entry for node_id, entry in self._scores.items()
+            if self.score(node_id, now) >= self.MIN_SCORE
+        }
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"half_life": self.half_life, "scores": self._scores}, f)
+            os.replace(temp_path, self.path)
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            open(self.log_path, 'w', encoding='utf-8').close()
+            self._log_lines = 0
+        except Exception as e:
+            print(f"Ошибка сохранения статистики использования: {e}")
+
+    def close(self):
+        if self._log_lines:
+            self.compact()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+class RecentTemplates:
+    """Последние вставленные шаблоны (MRU), новые — первыми.
+
+    Хранит id, а не узлы: после перезагрузки или слияния файла дерево
+    состоит из новых объектов, и шаблоны находятся заново через индекс
+    идентификаторов менеджера. Удалённые шаблоны просто не находятся.
+    На диск id пишутся при выходе.
+    """
+    DEFAULT_CAPACITY = 9
+
+    def __init__(self, template_manager, path="recent.json", capacity=DEFAULT_CAPACITY):
+        self.template_manager = template_manager
+        self.path = path
+        self.capacity = capacity
+        self._ids = deque(maxlen=capacity)
+        self.load()
+
+    @classmethod
+    def for_library(cls, template_manager, capacity=DEFAULT_CAPACITY):
+        """Список рядом с файлом шаблонов"""
+        directory = os.path.dirname(os.path.abspath(template_manager.data_file))
+        return cls(template_manager, os.path.join(directory, "recent.json"), capacity)
+
+    def push(self, node):
+        """Отметить вставку шаблона"""
+        try:
+            self._ids.remove(node.id)
+        except ValueError:
+            pass
+        self._ids.appendleft(node.id)
+
+    def items(self):
+        """Шаблоны, которые всё ещё есть в библиотеке"""
+        nodes = []
+        for node_id in self._ids:
+            node = self.template_manager.get_node_by_id(node_id)
+            if node is not None and not node.is_folder:
+                nodes.append(node)
+        return nodes
+
+    def load(self):
+        self._ids.clear()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                ids = json.load(f).get("ids", [])
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Ошибка загрузки последних шаблонов: {e}")
+            return
+        self._ids.extend(node_id for node_id in ids[:self.capacity] if isinstance(node_id, str))
+
+    def save(self):
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({"ids": [node.id for node in self.items()]}, f)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Ошибка сохранения последних шаблонов: {e}")
+
+class TemplateHistory:
+    """История версий текста шаблонов с хранением по содержимому.
+
+    Каждый текст сжимается zlib и лежит в objects/<2 символа>/<остаток
+    sha256> — одинаковые версии разных шаблонов и повторы хранятся один
+    раз. Какие версии были у шаблона, записано в журнале log строками
+    «время sha256 длина id»: список версий строится без чтения самих
+    текстов, текст версии читается только при просмотре.
+    """
+    def __init__(self, path="history"):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        self.log_path = os.path.join(path, "log")
+        self._versions = None  # id -> [(время, sha256, длина), ...] по возрастанию времени
+        self._log = None
+
+    @classmethod
+    def for_library(cls, data_file):
+        """История рядом с файлом шаблонов"""
+        return cls(os.path.join(os.path.dirname(os.path.abspath(data_file)), "history"))
+
+    @staticmethod
+    def digest(content):
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def load(self):
+        """Прочитать журнал версий (тексты не читаются)"""
+        self._versions = {}
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split(" ", 3)
+                    if len(parts) == 4:
+                        when, digest, length, node_id = parts
+                        self._versions.setdefault(node_id.rstrip("\n"), []).append((float(when), digest, int(length)))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ошибка чтения журнала версий: {e}")
+
+    def versions(self, node_id):
+        """Версии шаблона, новые первыми: [(время, sha256, длина текста), ...]"""
+        if self._versions is None:
+            self.load()
+        return list(reversed(self._versions.get(node_id, ())))
+
+    def read(self, digest):
+        """Текст версии по её sha256"""
+        with open(self._object_path(digest), 'rb') as f:
+            return zlib.decompress(f.read()).decode('utf-8')
+
+    def record(self, node_id, content, when=None):
+        """Запомнить версию текста шаблона; вернуть её sha256.
+
+        Если текст совпадает с последней версией шаблона, ничего не пишется.
+        """
+        if self._versions is None:
+            self.load()
+        digest = self.digest(content)
+        history = self._versions.setdefault(node_id, [])
+        if history and history[-1][1] == digest:
+            return digest
+        when = round(time.time() if when is None else when, 3)  # Как в журнале
+        path = self._object_path(digest)
+        try:
+            # Сначала текст, потом строка журнала: журнал не ссылается на отсутствующее
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = path + ".tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(zlib.compress(content.encode('utf-8')))
+                os.replace(temp_path, path)
+            if self._log is None:
+                self._log = open(self.log_path, 'a', encoding='utf-8')
+            self._log.write(f"{when:.3f} {digest} {len(content)} {node_id}\n")
+            self._log.flush()
+        except Exception as e:
+            print(f"Ошибка записи истории версий: {e}")
+            return None
+        history.append((when, digest, len(content)))
+        return digest
+
+    def on_templates_changed(self, changes):
+        """Слушатель TemplateManager: запомнить новые тексты шаблонов.
+
+        Версии до первой правки в истории нет — её текст берётся из
+        old_content изменения.
+        """
+        when = time.time()
+        for change in changes:
+            node = change.node
+            if change.kind != TemplateChange.CONTENT or node.is_folder:
+                continue
+            if self._versions is None:
+                self.load()
+            if change.old_content is not None and node.id not in self._versions:
+                self.record(node.id, change.old_content, when)
+            self.record(node.id, node.content, when)
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+class LatencyStats:
+    """Замеры задержек (в секундах) для диагностики и бенчмарков"""
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.samples = {}
+
+    def record(self, name, seconds):
+        """Добавить замер в серию name"""
+        bucket = self.samples.get(name)
+        if bucket is None:
+            bucket = self.samples[name] = deque(maxlen=self.max_samples)
+        bucket.append(seconds)
+
+    def percentile(self, name, percent):
+        """Получить перцентиль серии (в секундах) или None, если замеров нет"""
+        values = sorted(self.samples.get(name, ()))
+        if not values:
+            return None
+        # Метод ближайшего ранга
+        index = min(len(values) - 1, max(0, math.ceil(percent / 100.0 * len(values)) - 1))
+        return values[index]
+
+    def summary(self):
+        """Сводка по всем сериям в миллисекундах"""
+        result = {}
+        for name, values in self.samples.items():
+            if not values:
+                continue
+            result[name] = {
+                "count": len(values),
+                "p50_ms": round(self.percentile(name, 50) * 1000, 3),
+                "p99_ms": round(self.percentile(name, 99) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+            }
+        return result
+
+    def save_report(self, path):
+        """Записать сводку в JSON-файл"""
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+        except Exception as e:
+            print(f"Ошибка записи отчета о задержках: {e}")
+
+class ClipboardBackend:
+    """Базовый способ записи в буфер обмена"""
+    name = "base"
+
+    def copy(self, text):
+        raise NotImplementedError
+
+    def paste(self):
+        """Прочитать текст из буфера (нужно для проверки и калибровки)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class PyperclipClipboardBackend(ClipboardBackend):
+    """Буфер обмена через pyperclip (на Linux — запуск xclip/xsel на каждую запись)"""
+    name = "pyperclip"
+
+    @staticmethod
+    def _module():
+        # Импорт по требованию: консольной утилите он нужен только для copy
+        try:
+            import pyperclip
+        except ImportError:
+            raise RuntimeError("pyperclip не установлен")
+        return pyperclip
+
+    def copy(self, text):
+        self._module().copy(text)
+
+    def paste(self):
+        return self._module().paste()
+
+class HelperProcessClipboardBackend(ClipboardBackend):
+    """Буфер обмена через долгоживущий вспомогательный процесс.
+
+    Процесс запускается один раз (``--clipboard-helper``) и держит владение
+    буфером обмена. Протокол: строка ``КОМАНДА <размер>``, затем тело в UTF-8;
+    ответ ``OK|ERR <размер>`` и тело. Ответы читает отдельный поток, поэтому
+    зависший процесс не держит вызывающего дольше REQUEST_TIMEOUT: он
+    завершается и при следующем запросе запускается заново.
+    """
+    name = "helper"
+    REQUEST_TIMEOUT = 2.0
+
+    def __init__(self, command=None):
+        self.command = command or self.default_command()
+        self._process = None
+        self._responses = None  # Очередь ответов текущего процесса (None — процесс завершился)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_command():
+        if getattr(sys, "frozen", False):
+            return [sys.executable, "--clipboard-helper"]
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "textpaster.py")
+        return [sys.executable, script, "--clipboard-helper"]
+
+    def _ensure_process(self):
+        if self._process is not None and self._process.poll() is None:
+            return self._process
+        creationflags = getattr(subprocess, "CREATE_NO_WINDOW", 0) if os.name == "nt" else 0
+        self._process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            creationflags=creationflags,
+        )
+        self._responses = queue.Queue()
+        threading.Thread(
+            target=self._read_responses, args=(self._process, self._responses), daemon=True
+        ).start()
+        return self._process
+
+    @staticmethod
+    def _read_responses(process, responses):
+        """Поток чтения ответов процесса: (статус, тело), None — процесс завершился"""
+        try:
+            while True:
+                line = process.stdout.readline()
+                if not line:
+                    break
+                status, _, size = line.decode("ascii").strip().partition(" ")
+                data = process.stdout.read(int(size)) if size and int(size) else b""
+                responses.put((status, data))
+        except (OSError, ValueError):
+            pass
+        responses.put(None)
+
+    def _kill(self):
+        try:
+            self._process.kill()
+        except Exception:
+            pass
+        self._process = None
+
+    def _request(self, command, payload=b""):
+        with self._lock:
+            process = self._ensure_process()
+            try:
+                process.stdin.write(f"{command} {len(payload)}\n".encode("ascii") + payload)
+                process.stdin.flush()
+                response = self._responses.get(timeout=self.REQUEST_TIMEOUT)
+            except (BrokenPipeError, OSError):
+                response = None
+            except queue.Empty:
+                self._kill()
+                raise RuntimeError("вспомогательный процесс буфера обмена не отвечает")
+            if response is None:
+                self._kill()
+                raise RuntimeError("вспомогательный процесс буфера обмена завершился")
+            status, data = response
+            if status != "OK":
+                raise RuntimeError(data.decode("utf-8", "replace"))
+            return data
+
+    def copy(self, text):
+        self._request("COPY", text.encode("utf-8"))
+
+    def paste(self):
+        return self._request("PASTE").decode("utf-8")
+
+    def close(self):
+        with self._lock:
+            if self._process is None:
+                return
+            try:
+                self._process.stdin.close()
+                self._process.wait(timeout=1)
+            except Exception:
+                try:
+                    self._process.kill()
+                except Exception:
+                    pass
+            self._process = None
+
+class ClipboardService:
+    """Выбор способа записи в буфер обмена с замером задержек.
+
+    preferred — имя backend'а или "auto". В режиме auto используется самый
+    быстрый по медиане backend из тех, что уже замерены (см. calibrate()),
+    иначе — порядок по умолчанию для платформы. При ошибке берётся следующий.
+    """
+    MIN_SAMPLES = 3
+
+    def __init__(self, backends, latency_stats=None, preferred="auto"):
+        self.backends = OrderedDict((backend.name, backend) for backend in backends)
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats()
+        self.preferred = preferred
+        self.last_backend = None
+
+    @staticmethod
+    def default_order():
+        """Порядок backend'ов по умолчанию для текущей платформы"""
+        if sys.platform.startswith("linux"):
+            return ["tk", "helper", "pyperclip"]
+        return ["tk", "pyperclip", "helper"]
+
+    def ordered_backends(self):
+        """Backend'ы в порядке попыток"""
+        order = [name for name in self.default_order() if name in self.backends]
+        order += [name for name in self.backends if name not in order]
+        if self.preferred in self.backends:
+            order.remove(self.preferred)
+            order.insert(0, self.preferred)
+        else:
+            measured = [
+                name for name in order
+                if len(self.latency_stats.samples.get(f"clipboard.copy.{name}", ())) >= self.MIN_SAMPLES
+            ]
+            if measured:
+                fastest = min(measured, key=lambda name: self.latency_stats.percentile(f"clipboard.copy.{name}", 50))
+                order.remove(fastest)
+                order.insert(0, fastest)
+        return [self.backends[name] for name in order]
+
+    def copy(self, text):
+        """Записать текст в буфер; вернуть использованный backend или None"""
+        for backend in self.ordered_backends():
+            started = time.perf_counter()
+            try:
+                backend.copy(text)
+            except Exception as e:
+                print(f"Ошибка копирования в буфер ({backend.name}): {e}")
+                continue
+            elapsed = time.perf_counter() - started
+            self.latency_stats.record(f"clipboard.copy.{backend.name}", elapsed)
+            self.latency_stats.record("clipboard.copy", elapsed)
+            self.last_backend = backend
+            return backend
+        return None
+
+    def verify(self, text):
+        """Проверить, что буфер обмена уже содержит text.
+
+        Чтение идёт через Tk (в процессе, без запуска xclip), если он есть.
+        """
+        backend = self.backends.get("tk") or self.last_backend
+        if backend is None:
+            return True
+        try:
+            return backend.paste() == text
+        except Exception:
+            return False
+
+    CALIBRATION_TEXT = "TextPaster clipboard calibration"
+
+    def current_text(self):
+        """Текст в буфере обмена или None, если его не удалось прочитать"""
+        for backend in self.ordered_backends():
+            try:
+                return backend.paste()
+            except Exception:
+                continue
+        return None
+
+    def time_copies(self, name, rounds=5):
+        """Замерить rounds записей в буфер одним backend'ом; вернуть секунды.
+
+        Общие данные не трогает, поэтому backend'ы без Tk можно замерять из
+        фонового потока, а результат передать в add_calibration().
+        """
+        backend = self.backends[name]
+        timings = []
+        for i in range(rounds):
+            started = time.perf_counter()
+            backend.copy(f"{self.CALIBRATION_TEXT} {i}")
+            timings.append(time.perf_counter() - started)
+        return timings
+
+    def add_calibration(self, name, timings):
+        """Учесть замеры backend'а; вернуть {p50_ms, p99_ms}"""
+        metric = f"clipboard.copy.{name}"
+        for seconds in timings:
+            self.latency_stats.record(metric, seconds)
+        return {
+            "p50_ms": round(self.latency_stats.percentile(metric, 50) * 1000, 3),
+            "p99_ms": round(self.latency_stats.percentile(metric, 99) * 1000, 3),
+        }
+
+    def calibrate(self, rounds=5):
+        """Замерить все backend'ы в текущем потоке; вернуть {имя: {p50_ms, p99_ms}}.
+
+        Текущее содержимое буфера обмена восстанавливается после замеров.
+        """
+        original = self.current_text()
+        report = {}
+        try:
+            for name in self.backends:
+                try:
+                    report[name] = self.add_calibration(name, self.time_copies(name, rounds))
+                except Exception as e:
+                    report[name] = {"error": str(e)}
+        finally:
+            if original is not None:
+                self.copy(original)
+        return report
+
+    def close(self):
+        for backend in self.backends.values():
+            try:
+                backend.close()
+            except Exception:
+                pass
+
+class AutoPasteJob:
+    """Одна автовставка: текст, способ и отметки времени"""
+    def __init__(self, text, method, hotkey_time=None):
+        self.text = text
+        self.method = method
+        self.hotkey_time = hotkey_time
+        self.selected_time = time.perf_counter()
+        self.polls = 0
+
+class AutoPastePipeline:
+    """Автовставка после выбора шаблона.
+
+    Вместо фиксированных пауз: сначала (в потоке Tk) проверяется, что буфер
+    обмена уже содержит нужный текст, а фокус вернулся в целевое окно, затем
+    ввод клавиш выполняется в фоновом потоке. Задержки подстраиваются только
+    по настоящим сигналам: пауза перед вставкой опускается ниже
+    FOCUS_SETTLE_DELAY, лишь если focus_ready() подтвердил готовность окна, а пауза
+    между нажатиями растёт при ошибках ввода и не опускается ниже начальной —
+    успешный вызов inject() не доказывает, что вставка дошла до окна.
+    """
+    MIN_SETTLE_DELAY = 0.015
+    FOCUS_SETTLE_DELAY = 0.05  # Нижняя граница, пока возврат фокуса не подтверждён
+    MAX_SETTLE_DELAY = 0.5
+    MAX_KEY_DELAY = 0.05
+    POLL_INTERVAL_MS = 10
+    MAX_POLLS = 50
+
+    def __init__(self, root_window, clipboard, inject, latency_stats=None,
+                 settle_delay=0.05, key_delay=0.02, focus_ready=None):
+        self.root_window = root_window
+        self.clipboard = clipboard
+        self.inject = inject  # inject(method, key_delay) -> bool, вызывается в фоновом потоке
+        # focus_ready(method) -> True/False, или None, если проверить нельзя; вызывается в потоке Tk
+        self.focus_ready = focus_ready
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats()
+        self.settle_delay = settle_delay
+        self.key_delay = key_delay
+        self.base_key_delay = key_delay
+        self._jobs = queue.Queue()
+        self._worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self._worker.start()
+
+    def schedule(self, text, method, hotkey_time=None):
+        """Запланировать вставку (вызывать в потоке Tk после копирования в буфер)"""
+        job = AutoPasteJob(text, method, hotkey_time)
+        self.root_window.after(int(self.settle_delay * 1000), self._check_clipboard, job)
+        return job
+
+    def _check_clipboard(self, job):
+        if not self.clipboard.verify(job.text):
+            if job.polls < self.MAX_POLLS:
+                job.polls += 1
+                self.root_window.after(self.POLL_INTERVAL_MS, self._check_clipboard, job)
+                return
+            print("Быстрая вставка отменена: буфер обмена не содержит выбранный шаблон")
+            self.settle_delay = self.MAX_SETTLE_DELAY
+            return
+        focused = self.focus_ready(job.method) if self.focus_ready is not None else None
+        if focused is False:
+            if job.polls < self.MAX_POLLS:
+                job.polls += 1
+                self.root_window.after(self.POLL_INTERVAL_MS, self._check_clipboard, job)
+                return
+            print("Быстрая вставка отменена: фокус не вернулся в целевое окно")
+            self.settle_delay = self.MAX_SETTLE_DELAY
+            return
+
+        waited = time.perf_counter() - job.selected_time
+        self.latency_stats.record("auto_paste.clipboard_ready", waited)
+        floor = self.MIN_SETTLE_DELAY if focused else self.FOCUS_SETTLE_DELAY
+        if job.polls == 0:
+            self.settle_delay = max(floor, self.settle_delay * 0.8)
+        else:
+            self.settle_delay = min(self.MAX_SETTLE_DELAY, max(floor, waited * 1.25))
+        self._jobs.put(job)
+
+    def _worker_loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                ok = bool(self.inject(job.method, self.key_delay))
+            except Exception as e:
+                print(f"Ошибка быстрой вставки: {e}")
+                ok = False
+            if ok:
+                # После ошибок пауза постепенно возвращается к начальной, но не ниже
+                self.key_delay = max(self.base_key_delay, self.key_delay * 0.9)
+                finished = time.perf_counter()
+                self.latency_stats.record("auto_paste.select_to_paste", finished - job.selected_time)
+                if job.hotkey_time is not None:
+                    self.latency_stats.record("auto_paste.hotkey_to_paste", finished - job.hotkey_time)
+            else:
+                self.key_delay = min(self.MAX_KEY_DELAY, self.key_delay * 2)
+
+    def close(self):
+        self._jobs.put(None)
+
+def instance_address(data_file):
+    """Адрес локального канала и файл ключа для библиотеки data_file.
+
+    Один экземпляр приложения на файл шаблонов: два процесса, сохраняющие
+    один и тот же templates.json, затирали бы изменения друг друга.
+    """
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(data_file)).encode("utf-8")).hexdigest()[:16]
+    if os.name == "nt":
+        return rf"\\.\pipe\textpaster-{key}", os.path.join(tempfile.gettempdir(), f"textpaster-{key}.key")
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    address = os.path.join(runtime_dir, f"textpaster-{os.getuid()}-{key}.sock")
+    return address, address + ".key"
+
+class InstanceClient:
+    """Отправка команд работающему экземпляру приложения.
+
+    Сообщения — JSON-объекты: запрос {"command": ..., ...},
+    ответ {"ok": true|false, ...}.
+    """
+    def __init__(self, data_file="templates.json", timeout=5.0):
+        self.address, self.key_file = instance_address(data_file)
+        self.timeout = timeout
+
+    def _authkey(self):
+        try:
+            with open(self.key_file, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def request(self, command, **fields):
+        """Отправить команду; вернуть ответ или None, если приложение не запущено"""
+        from multiprocessing.connection import Client
+
+        authkey = self._authkey()
+        if authkey is None:
+            return None
+        try:
+            conn = Client(self.address, authkey=authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        with conn:
+            fields["command"] = command
+            conn.send_bytes(json.dumps(fields, ensure_ascii=False).encode("utf-8"))
+            if not conn.poll(self.timeout):
+                return {"ok": False, "error": "нет ответа от TextPaster"}
+            return json.loads(conn.recv_bytes().decode("utf-8"))
+
+class InstanceServer:
+    """Канал для команд от повторных запусков и консольной утилиты.
+
+    handler(request) -> response вызывается в потоке канала; запросы
+    обрабатываются по одному.
+    """
+    def __init__(self, data_file, handler):
+        self.data_file = data_file
+        self.handler = handler
+        self.address, self.key_file = instance_address(data_file)
+        self.lock_file = os.path.splitext(self.key_file)[0] + ".lock"
+        self._lock_fd = None
+        self._listener = None
+        self._authkey = None
+        self._closing = False
+        self._thread = None
+
+    def _acquire_lock(self):
+        """Захватить блокировку файла lock_file; False, если её держит другой процесс.
+
+        Блокировку снимает ОС при завершении процесса, поэтому после сбоя
+        она не остаётся занятой, а захват атомарен: из двух одновременных
+        запусков её получит только один.
+        """
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.name == "nt":
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _release_lock(self):
+        if self._lock_fd is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+            try:
+                os.lseek(self._lock_fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._lock_fd, msvcrt.LK_UNLCK, 1)
+            except OSError:
+                pass
+        os.close(self._lock_fd)  # flock снимается вместе с дескриптором
+        self._lock_fd = None
+
+    def start(self):
+        """Занять канал; вернуть False, если уже запущен другой экземпляр.
+
+        Сокет и файл ключа трогает только владелец блокировки, поэтому
+        второй запуск не может удалить живой сокет или подменить ключ.
+        """
+        from multiprocessing.connection import Listener
+
+        try:
+            if not self._acquire_lock():
+                return False
+        except OSError as e:
+            print(f"Ошибка запуска канала команд: {e}")
+            return False
+        self._authkey = os.urandom(32)
+        try:
+            if os.name != "nt" and os.path.exists(self.address):
+                os.unlink(self.address)  # Сокет от завершившегося аварийно процесса
+            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self._authkey)
+            self._listener = Listener(self.address, authkey=self._authkey)
+        except OSError as e:
+            print(f"Ошибка запуска канала команд: {e}")
+            self._release_lock()
+            return False
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return True
+
+    def _serve(self):
+        while not self._closing:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                # Неверный ключ, оборванное соединение или закрытие канала
+                continue
+            with conn:
+                if self._closing:
+                    return
+                try:
+                    request = json.loads(conn.recv_bytes().decode("utf-8"))
+                    response = self.handler(request)
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                try:
+                    conn.send_bytes(json.dumps(response, ensure_ascii=False).encode("utf-8"))
+                except OSError:
+                    pass
+
+    def close(self):
+        if self._listener is None:
+            return
+        self._closing = True
+        # Разбудить поток, ждущий в accept()
+        try:
+            from multiprocessing.connection import Client
+            Client(self.address, authkey=self._authkey).close()
+        except Exception:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        try:
+            self._listener.close()
+        except Exception:
+            pass
+        self._listener = None
+        try:
+            os.unlink(self.key_file)
+        except OSError:
+            pass
+        # Последним: после этого сокет и ключ может создать следующий экземпляр
+        self._release_lock()